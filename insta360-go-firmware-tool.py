@@ -4,13 +4,42 @@ import sys
 import argparse
 from pathlib import Path
 import textwrap
-import io
 import mmap
-import tempfile
 import zlib
 import hashlib
 import re
 import shutil
+import concurrent.futures
+import functools
+import itertools
+import io
+import stat
+import errno
+import contextlib
+import json
+import struct
+import array
+import glob
+import time
+import asyncio
+import urllib.parse
+import sqlite3
+import random
+import tempfile
+import tracemalloc
+import platform
+import threading
+import atexit
+import signal
+import bisect
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
 # import mount
 
 MD5_SIZE = 0x10  # 16
@@ -28,6 +57,11 @@ EXT2_MAGIC_NUMBER = b'\x53\xEF'
 EXT2_MAGIC_NUMBER_POSITION = 0x438
 DTB_MAGIC_NUMBER = b'\xD0\x0D\xFE\xED'
 DTB_MAGIC_NUMBER_POSITION = 0x00
+GZIP_MAGIC_NUMBER = b'\x1F\x8B\x08'  # Followed by the deflate compression method, the only one there is
+LZ4_MAGIC_NUMBER = b'\x04\x22\x4D\x18'  # LZ4 frame
+ELF_MAGIC_NUMBER = b'\x7F\x45\x4C\x46'  # \x7FELF
+UIMAGE_MAGIC_NUMBER = b'\x27\x05\x19\x56'  # U-Boot legacy image
+SQUASHFS_MAGIC_NUMBER = b'\x68\x73\x71\x73'  # hsqs
 
 FIRMWARE_FOOTER_GO2_SIGNATURE = b'\x57\x46\x4E\x49\x54\x58\x4E\x4F\x02\x00\x00\x00\x00\x00\x00\x00'
 FIRMWARE_FOOTER_GO3_SIGNATURE = b'\x57\x46\x4E\x49\x55\x58\x4E\x4F\x04\x00\x01\x00\x00\x00\x09\x00'
@@ -172,6 +206,19 @@ FIRMWARE_FOOTER_GO3S_SIZE = FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_SIZE +\
                             FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_MD5_SIZE + \
                             FIRMWARE_FOOTER_GO3S_SIGNATURE_SIZE  # 436
 
+FIRMWARE_FOOTER_SIGNATURE_SIZE = FIRMWARE_FOOTER_GO2_SIGNATURE_SIZE  # 16, all the signatures have the same size
+FIRMWARE_FOOTER_FIRMWARE_NAMES = ['camera', 'box', 'camera_bluetooth', 'box_bluetooth', 'camera_bluetooth_app']  # In footer order
+FIRMWARE_FOOTER_FIRMWARE_FORMAT = 'I32s32s16s'  # Length, file name, version and MD5 of each firmware
+FIRMWARE_FOOTER_GO2_STRUCT = struct.Struct('<' + FIRMWARE_FOOTER_FIRMWARE_FORMAT * 2 + '16s')  # 184, camera and box firmwares and signature
+FIRMWARE_FOOTER_GO3_STRUCT = struct.Struct('<' + FIRMWARE_FOOTER_FIRMWARE_FORMAT * 4 + '16s')  # 352, plus both bluetooth firmwares
+FIRMWARE_FOOTER_GO3S_STRUCT = struct.Struct('<' + FIRMWARE_FOOTER_FIRMWARE_FORMAT * 5 + '16s')  # 436, plus the bluetooth app firmware
+# Model name and footer layout by the first 8 bytes of the signature
+FIRMWARE_FOOTER_MODELS = {FIRMWARE_FOOTER_GO2_SIGNATURE[:8]: ('GO 2', FIRMWARE_FOOTER_GO2_STRUCT),
+                          FIRMWARE_FOOTER_GO3_SIGNATURE[:8]: ('GO 3', FIRMWARE_FOOTER_GO3_STRUCT),
+                          FIRMWARE_FOOTER_GO3S_SIGNATURE[:8]: ('GO 3S', FIRMWARE_FOOTER_GO3S_STRUCT)}
+FIRMWARE_HEADER_STRUCT = struct.Struct('<32s4s4s8s' + '4s4s' * FIRMWARE_HEADER_SECTIONS_COUNT)  # Name, magic number, CRC32, zeros and the length and CRC32 of each section
+SECTION_HEADER_STRUCT = struct.Struct('<4s4s4s4s4s4s4s')  # CRC32, version, date, length, loading address, flags and magic number
+
 ROMFS_HEADER_SIZE = 0x0000A000  # 40960
 ROMFS_FILECOUNT_POSITION = len(ROMFS_MAGIC_NUMBER)  # 4
 ROMFS_FILECOUNT_SIZE = 0x04
@@ -184,37 +231,831 @@ ROMFS_FILE_OFFSET_SIZE = 0x04
 ROMFS_FILE_CRC32_POSITION = ROMFS_FILE_OFFSET_POSITION + ROMFS_FILE_OFFSET_SIZE
 ROMFS_FILE_CRC32_SIZE = CRC32_SIZE
 ROMFS_FILE_ENTRY_SIZE = ROMFS_FILE_FILENAME_SIZE + ROMFS_FILE_LENGTH_SIZE + ROMFS_FILE_OFFSET_SIZE + ROMFS_FILE_CRC32_SIZE  # File name length plus file size, file offset and crc32 = 76
+ROMFS_BLOCK_SIZE = 0x800  # 2048
+ROMFS_PADDING = memoryview(bytes(ROMFS_BLOCK_SIZE))
+ROMFS_FILE_ENTRY_STRUCT = struct.Struct('<' + str(ROMFS_FILE_FILENAME_SIZE) + 'sIII')  # File name, size, offset and CRC32
 ROMFS_MAX_FILE_COUNT = int(ROMFS_HEADER_SIZE / ROMFS_FILE_ENTRY_SIZE // 1)  # 40960 header size divided by 64+4+4+4 entry per file in header and rounded down = 538
 
+KERNEL_HEADER_STRUCT = struct.Struct('<2I3Q')  # ARM64 Image code, text offset, image size and flags
+UIMAGE_HEADER_STRUCT = struct.Struct('>7I4B32s')  # Magic number, header CRC32, time, data size, load address, entry point, data CRC32, OS, architecture, type, compression and name
+SQUASHFS_SUPERBLOCK_STRUCT = struct.Struct('<5I6H2Q')  # Magic number, inodes, time, block size, fragments, compression, block log, flags, ids, major and minor versions, root inode and bytes used
+ELF_HEADER_FORMATS = {1: 'HHIIIIIHHHHHH', 2: 'HHIQQQIHHHHHH'}  # After the identification, for 32 and 64 bit: type, machine, version, entry, program and section header offsets, flags, header size and size and count of the program and section headers
+ELF_PROGRAM_HEADER_FORMATS = {1: 'IIIIIIII', 2: 'IIQQQQQQ'}  # Type, offset, addresses, file size... for 32 bit, type, flags, offset, addresses, file size... for 64 bit
+ELF_IDENTIFICATION_SIZE = 0x10  # 16
+LZ4_BLOCK_UNCOMPRESSED = 0x80000000  # Flag of the block size of blocks stored as they are
+SECTION_TYPES = ['RTOS', 'ROMFS', 'KERNEL', 'EXT2', 'DTB']  # Types a section can have, checked in this order
+
+DTB_HEADER_STRUCT = struct.Struct('>10I')  # Magic number, total size, structure, strings and memory reservation offsets, version, last compatible version, boot CPU, strings and structure sizes
+DTB_MEMORY_RESERVATION_STRUCT = struct.Struct('>2Q')  # Address and size, the list ends with an empty one
+DTB_VERSION = 17
+DTB_LAST_COMPATIBLE_VERSION = 16
+DTB_BEGIN_NODE = 0x00000001
+DTB_END_NODE = 0x00000002
+DTB_PROP = 0x00000003
+DTB_NOP = 0x00000004
+DTB_END = 0x00000009
+DTB_TOKEN_STRUCT = struct.Struct('>I')  # Structure block token, nodes and properties are aligned to it
+DTB_PROP_STRUCT = struct.Struct('>2I')  # Value length and name offset in the strings block, after a DTB_PROP token
+DTB_MEMORY_RESERVATION_ALIGNMENT = 0x08  # 8
+DTS_TOKEN = re.compile(r'''(?P<skip>\s+|//[^\n]*|/\*.*?\*/)
+                          |(?P<string>"(?:[^"\\]|\\.)*")
+                          |(?P<cells><[^>]*>)
+                          |(?P<bytes>\[[^\]]*\])
+                          |(?P<punctuation>[{};=,])
+                          |(?P<word>[A-Za-z0-9,._+*\#?@/-]+)''', re.S | re.X)  # The DTS subset written by dtc -O dts
+DTS_STRING_ESCAPES = {'a': 7, 'b': 8, 't': 9, 'n': 10, 'v': 11, 'f': 12, 'r': 13, '\\': 0x5C, '"': 0x22, "'": 0x27}
+
+MANIFEST_FILENAME = 'firmware.manifest'
+MANIFEST_VERSION = 1
+
+STORE_OBJECTS_FOLDER = 'objects'
+STORE_OBJECT_MODE = 0o444  # Objects are shared by every folder linked to them so they are read only
+FICLONE = 0x40049409  # Linux ioctl to clone a whole file sharing its blocks (copy on write)
+
+FIRMWARE_FILE_EXTENSION = '.pkg'  # Files searched in the folders given to batch action
+
+CATALOG_VERSION = 1  # Catalogs with another version are built again
+CATALOG_SCHEMA = """
+CREATE TABLE firmwares (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                        model TEXT, version TEXT, header_crc32 TEXT, error TEXT);
+CREATE TABLE firmware_parts (firmware_id INTEGER NOT NULL REFERENCES firmwares (id) ON DELETE CASCADE, name TEXT NOT NULL,
+                             file_name TEXT, version TEXT, size INTEGER, md5 TEXT);
+CREATE TABLE sections (firmware_id INTEGER NOT NULL REFERENCES firmwares (id) ON DELETE CASCADE, name TEXT NOT NULL, type TEXT,
+                       start INTEGER, length INTEGER, crc32 TEXT, version TEXT, date TEXT, loading_address INTEGER, flags INTEGER);
+CREATE TABLE romfs_files (firmware_id INTEGER NOT NULL REFERENCES firmwares (id) ON DELETE CASCADE, section TEXT NOT NULL,
+                          name TEXT NOT NULL, length INTEGER, offset INTEGER, crc32 TEXT);
+CREATE INDEX firmware_parts_firmware ON firmware_parts (firmware_id);
+CREATE INDEX firmware_parts_version ON firmware_parts (name, version);
+CREATE INDEX sections_firmware ON sections (firmware_id);
+CREATE INDEX sections_crc32 ON sections (crc32);
+CREATE INDEX romfs_files_firmware ON romfs_files (firmware_id);
+CREATE INDEX romfs_files_name ON romfs_files (name, crc32);
+"""
+CATALOG_DROP_SCHEMA = """
+DROP TABLE IF EXISTS romfs_files;
+DROP TABLE IF EXISTS sections;
+DROP TABLE IF EXISTS firmware_parts;
+DROP TABLE IF EXISTS firmwares;
+"""
+
+EXT2_SUPERBLOCK_POSITION = 0x400  # 1024
+EXT2_SUPERBLOCK_STRUCT = struct.Struct('<11I2I6H4I2HI2H3I')  # Superblock fields up to the feature flags
+EXT2_GROUP_DESCRIPTOR_STRUCT = struct.Struct('<3I3H14x')  # Block bitmap, inode bitmap, inode table, free blocks, free inodes and directories count
+EXT2_INODE_STRUCT = struct.Struct('<2H5I2H3I15I4I12s')  # 128 bytes
+EXT2_DIRECTORY_ENTRY_STRUCT = struct.Struct('<IHBB')  # Inode, record length, name length and file type
+EXT2_ROOT_INODE = 2
+EXT2_GOOD_OLD_FIRST_INODE = 11
+EXT2_GOOD_OLD_INODE_SIZE = 0x80  # 128
+EXT2_DIRECT_BLOCKS = 12
+EXT2_BLOCK_POINTERS = 15  # 12 direct, indirect, double indirect and triple indirect
+EXT2_FAST_SYMLINK_SIZE = 0x3C  # 60, the size of the block pointers in the inode
+EXT2_MAX_SYMLINKS = 8
+EXT2_CACHE_SIZE = 4096
+EXT2_FEATURE_INCOMPAT_FILETYPE = 0x0002
+EXT2_FEATURE_INCOMPAT_SUPPORTED = EXT2_FEATURE_INCOMPAT_FILETYPE
+EXT2_FEATURE_RO_COMPAT_WRITABLE = 0x0001 | 0x0002 | 0x0004  # Sparse superblocks, large files and B-tree directories
+EXT2_SUPERBLOCK_FREE_BLOCKS_COUNT_POSITION = EXT2_SUPERBLOCK_POSITION + 0x0C
+EXT2_SUPERBLOCK_FREE_INODES_COUNT_POSITION = EXT2_SUPERBLOCK_POSITION + 0x10
+EXT2_GROUP_DESCRIPTOR_COUNTS_STRUCT = struct.Struct('<3I3H')  # The group descriptor without the padding
+EXT2_INODE_EXTRA_SIZE_SIZE = 0x02  # 2, size of the extra fields of large inodes
+EXT2_INDEX_FLAG = 0x1000  # Hash indexed directory, rebuilt directories are always linear
+EXT2_MAX_NAME_LENGTH = 0xFF  # 255
+EXT2_FILE_TYPES = {stat.S_IFREG: 1, stat.S_IFDIR: 2, stat.S_IFCHR: 3, stat.S_IFBLK: 4, stat.S_IFIFO: 5, stat.S_IFSOCK: 6, stat.S_IFLNK: 7}
+# Bits of every byte of a bitmap as one byte per bit, and back
+EXT2_BITMAP_BYTES = [bytes((value >> bit) & 1 for bit in range(0, 8)) for value in range(0, 256)]
+EXT2_BITMAP_VALUES = {bits: value for value, bits in enumerate(EXT2_BITMAP_BYTES)}
+
+HASH_CHUNK_SIZE = 0x100000  # 1 MiB
+HASH_PARALLEL_SPLIT_SIZE = 0x800000  # 8 MiB
+SCAN_CHUNK_SIZE = HASH_CHUNK_SIZE  # Scanned for the magic numbers between progress events
+CRC32_POLYNOMIAL = 0xEDB88320  # Reversed 0x04C11DB7
+PROGRESS_CHUNK_SIZE = 0x800000  # 8 MiB copied inside the kernel between progress events
+PROGRESS_INTERVAL = 0.2  # Seconds between the progress lines of the command line
+SPARSE_BLOCK_SIZE = 0x1000  # 4 KiB, holes are made of whole file system blocks
+SPARSE_MIN_SIZE = 0x10000  # 64 KiB, shorter zero runs are written as data
+SPARSE_ZERO_CHUNK = bytes(HASH_CHUNK_SIZE)  # Compared against the content to find zero runs, and hashed in place of holes
+
+STREAM_TAIL_SIZE = 0x400000  # 4 MiB kept from the end of a streamed firmware, the bluetooth firmwares and the footer must fit
+STREAM_SNAPSHOT_SIZE = 0x10000  # 64 KiB between the copies of the hash of the firmwares after the camera firmware
+
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8360
+SERVE_CHUNK_SIZE = HASH_CHUNK_SIZE  # Read from the upload and hashed at once, two per upload are in memory at most
+SERVE_PART_SUFFIX = '.part'  # Uploads are written with this suffix and renamed when they are valid
+
+DIFF_COMPARE_SIZE = 0x10000  # 64 KiB compared at once looking for the first and last changed bytes
+DIFF_BLOCK_SIZE = 0x1000  # 4 KiB blocks compared in place when the changed region keeps its size
+DIFF_CHUNK_MIN_SIZE = 0x800  # 2 KiB
+DIFF_CHUNK_MAX_SIZE = 0x10000  # 64 KiB
+DIFF_CHUNK_MASK = 0x1FFF  # A chunk ends where the low 13 bits of the rolling hash are 0, 8 KiB on average after the minimum size
+DIFF_CHUNK_WINDOW = 0x20  # 32, the rolling hash only depends on the last 32 bytes
+DIFF_GEAR = [int.from_bytes(hashlib.md5(bytes([value])).digest()[:4], 'little') for value in range(0, 256)]
+PATCH_MAGIC_NUMBER = b'I360DIFF'
+PATCH_VERSION = 1
+PATCH_HEADER_STRUCT = struct.Struct('<8sIQQ16s16s')  # Magic number, version, old and new file sizes, old and new camera firmware MD5
+PATCH_OPERATION_STRUCT = struct.Struct('<BQQ')  # Operation, offset and length
+PATCH_COPY = 0  # Copy length bytes from the old file at offset
+PATCH_INSERT = 1  # Insert the length bytes that follow, offset is where they go in the new file
+
+# Section sizes of the real firmwares, in order: RTOS, DSP uCode ROMFS, ROMFS, kernel, ext2 and DTB
+GENERATE_SECTION_SIZES = {'go2': [12556192, 3833856, 7022592, 5969928, 38241280, 23105],
+                          'go3': [22645664, 3852288, 13234176, 5969928, 38666240, 23101],
+                          'go3s': [23173464, 3856384, 15863808, 5969928, 46898176, 23101]}
+# Box and bluetooth firmware sizes of the real firmwares, only the box one is scaled
+GENERATE_FIRMWARE_SIZES = {'go2': [123808],
+                           'go3': [0x1000000, 177032, 54872],
+                           'go3s': [0x1000000, 176444, 54976, 160692]}
+GENERATE_SIGNATURES = {'go2': FIRMWARE_FOOTER_GO2_SIGNATURE, 'go3': FIRMWARE_FOOTER_GO3_SIGNATURE, 'go3s': FIRMWARE_FOOTER_GO3S_SIGNATURE}
+GENERATE_FOOTER_STRUCTS = {'go2': FIRMWARE_FOOTER_GO2_STRUCT, 'go3': FIRMWARE_FOOTER_GO3_STRUCT, 'go3s': FIRMWARE_FOOTER_GO3S_STRUCT}
+GENERATE_LOADING_ADDRESSES = [0x00000000, 0x00000000, 0x00000000, 0x00208000, 0x00000000, 0x00100000]
+GENERATE_TIME = 1700000000  # Fixed modification time of the generated files so the same seed gives the same firmware
+GENERATE_DSP_FILES = [('orccode.bin', 0.55), ('orcme.bin', 0.35), ('default_binary.bin', 0.10)]  # Name and share of the section
+GENERATE_ROMFS_FILES = ['calib6.bin', 'calib13.bin', 'fonts.bin', 'strings.bin', 'bitmaps.bin', 'clut.bin']
+GENERATE_ROMFS_FILE_COUNT = 320  # Named files plus res_NNN.bin up to this count
+GENERATE_EXT2_BLOCK_SIZE = 0x1000  # 4 KiB
+GENERATE_EXT2_INODES = 0x400  # 1024, a single group
+GENERATE_EXT2_MAX_FILE_SIZE = 0x200000  # 2 MiB
+GENERATE_EXT2_USAGE = 0.4  # Share of the file system used by files, the rest is free
+
+BENCHMARK_MODELS = ['go2', 'go3', 'go3s']
+BENCHMARK_SCALES = [0.25, 1.0]
+BENCHMARK_REPEAT = 3
+BENCHMARK_TOLERANCE = 0.25  # A benchmark is a regression when it is this much slower than the baseline
+BENCHMARK_MIN_SECONDS = 0.05  # Differences under this are noise, not regressions
+BENCHMARK_MIN_MEMORY = 0x100000  # 1 MiB
+BENCHMARK_VERSION = 2
+BENCHMARK_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.json')  # Baseline kept with the tool
+
 
 def read(f, offset, length):
     f.seek(offset)
     return f.read(length)
 
 
+def has_magic_number(mm, start, length, magic_number, position):
+    # Check for a magic number inside a section without reading the section
+    if position + len(magic_number) > length:
+        return False
+    return read(mm, start + position, len(magic_number)) == magic_number
+
+
 def write(file_path, content, offset=0):
     file = open(file_path, 'wb')
     file.seek(offset)
     file.write(content)
     file.close()
+    profile_bytes(written=len(content))
+
+
+def copy_fd(source_fd, target_fd, offset, end, progress=None):
+    # Copy from the source file to the current position of the target file inside the kernel, returns where it stopped.
+    # With a progress callback it's copied in chunks and the callback gets the bytes done and the total after each one
+    start = offset
+    step = end - offset if progress is None else PROGRESS_CHUNK_SIZE
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(source_fd, target_fd, min(step, end - offset), offset)
+                if copied == 0:
+                    break
+                offset += copied
+                if progress is not None:
+                    progress(offset - start, end - start)
+        except OSError:
+            pass
+    if offset < end and hasattr(os, 'sendfile'):
+        try:
+            while offset < end:
+                copied = os.sendfile(target_fd, source_fd, offset, min(step, end - offset))
+                if copied == 0:
+                    break
+                offset += copied
+                if progress is not None:
+                    progress(offset - start, end - start)
+        except OSError:
+            pass
+    return offset
+
+
+def zero_runs(mm, start, end, min_size=SPARSE_MIN_SIZE, block_size=SPARSE_BLOCK_SIZE):
+    # Start and end of the runs of zeros between start and end at least min_size long. The runs are made
+    # of whole blocks aligned to start, so they can be holes of a file that begins at start. The next candidate is
+    # found with mm.find and the run grows comparing whole chunks with startswith (memoryview comparisons go byte by
+    # byte), so the bytes are never looked at one by one in Python
+    zeros = SPARSE_ZERO_CHUNK
+    block = zeros[:block_size]
+    runs = []
+    position = start
+    with memoryview(mm) as view:
+        while position + block_size <= end:
+            found = mm.find(block, position, end)
+            if found < 0:
+                break
+            run_start = start + -(-(found - start) // block_size) * block_size
+            run_end = run_start
+            step = len(zeros)
+            while step >= block_size:
+                length = min(step, (end - run_end) // block_size * block_size)
+                if length > 0 and zeros.startswith(view[run_end:run_end + length]):
+                    run_end += length
+                else:
+                    step //= 2
+            if run_end - run_start >= min_size:
+                runs.append((run_start, run_end))
+            position = max(run_end, run_start + 1)
+    return runs
+
+
+def copy_range(f, mm, offset, length, file_path, chunk_size=HASH_CHUNK_SIZE, progress=None):
+    # Copy a range of the source file to a new file inside the kernel if possible, falling back to chunked writes
+    # from the mmap. Long runs of zeros are left as holes so the new file is sparse, f can be None to always write
+    # from the mmap
+    start = offset
+    end = min(offset + length, mm.size())
+    target = open(file_path, 'wb')
+    extents = []
+    for run_start, run_end in zero_runs(mm, start, end):
+        extents.append((offset, run_start))
+        offset = run_end
+    extents.append((offset, end))
+    written = 0
+    with memoryview(mm) as view:
+        for extent_start, extent_end in extents:
+            target.seek(extent_start - start)
+            offset = extent_start
+            if f is not None and offset < extent_end:
+                offset = copy_fd(f.fileno(), target.fileno(), offset, extent_end, (lambda done, total: progress(extent_start - start + done, end - start)) if progress is not None else None)
+                target.seek(offset - start)
+            while offset < extent_end:
+                chunk = view[offset:min(offset + chunk_size, extent_end)]
+                target.write(chunk)
+                offset += len(chunk)
+                chunk.release()
+                if progress is not None:
+                    progress(offset - start, end - start)
+            written += extent_end - extent_start
+    # A hole at the end only counts once the size is set
+    target.truncate(max(0, end - start))
+    target.close()
+    profile_bytes(written, written)
+
+
+def clone_file(source_path, target_path):
+    # Copy on write clone of a whole file, only on file systems that support it like Btrfs or XFS
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    source = open(source_path, 'rb')
+    target = open(target_path, 'wb')
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        cloned = True
+    except OSError:
+        cloned = False
+    target.close()
+    source.close()
+    if not cloned:
+        os.unlink(target_path)
+    return cloned
+
+
+def replace_file(file_path):
+    # Unpacked files can be links to a store object, so they are removed before writing them again instead of
+    # overwriting the shared content
+    if os.path.lexists(file_path):
+        os.unlink(file_path)
+
+
+def file_extents(fd, offset, end):
+    # Start, end and whether there is data of the parts of a file between offset and end, holes are found with
+    # SEEK_DATA and SEEK_HOLE where the file system supports them and the whole file is data otherwise
+    if not hasattr(os, 'SEEK_DATA'):
+        yield offset, end, True
+        return
+    while offset < end:
+        try:
+            data = min(os.lseek(fd, offset, os.SEEK_DATA), end)
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end) if data < end else end
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                yield offset, end, True
+                return
+            # Only a hole up to the end of the file
+            data = hole = end
+        if data > offset:
+            yield offset, data, False
+        if hole > data:
+            yield data, hole, True
+        offset = hole
+
+
+def stream_file(file_path, target=None, hashers=(), chunk_size=HASH_CHUNK_SIZE, offset=0, progress=None):
+    # Feed a file to the hashers chunk by chunk, copying it to the target file at the same time if there is one.
+    # Holes are not read, the hashers get zeros from a precomputed chunk instead and the target gets a hole too
+    size = 0
+    bytes_read = 0
+    buffer = bytearray(chunk_size)
+    zeros = memoryview(SPARSE_ZERO_CHUNK)[:chunk_size]
+    source = open(file_path, 'rb')
+    end = os.fstat(source.fileno()).st_size
+    total = end - offset if progress is not None else None
+    hole = False
+    with memoryview(buffer) as view:
+        for extent_start, extent_end, is_data in file_extents(source.fileno(), offset, end):
+            source.seek(extent_start)
+            hole = not is_data
+            while extent_start < extent_end:
+                if is_data:
+                    length = source.readinto(view[:min(chunk_size, extent_end - extent_start)])
+                    if not length:
+                        break
+                    bytes_read += length
+                    chunk = view[:length]
+                else:
+                    length = min(chunk_size, extent_end - extent_start)
+                    chunk = zeros[:length]
+                for hasher in hashers:
+                    hasher.update(chunk)
+                if target is None:
+                    pass
+                elif is_data:
+                    target.write(chunk)
+                else:
+                    target.seek(length, os.SEEK_CUR)
+                chunk.release()
+                extent_start += length
+                size += length
+                if progress is not None:
+                    progress(size, total)
+    # A hole at the end only counts once the size is set
+    if target is not None and hole:
+        target.truncate()
+    source.close()
+    zeros.release()
+    profile_bytes(bytes_read, bytes_read if target is not None else 0)
+    return size
+
+
+def append_file(file_path, target, progress=None):
+    # Append a whole file to the target file inside the kernel if possible, falling back to chunked writes. Holes
+    # are skipped so they stay holes in the target
+    target.flush()
+    base = target.tell()
+    source = open(file_path, 'rb')
+    size = os.fstat(source.fileno()).st_size
+    copied = 0
+    bytes_read = 0
+    for extent_start, extent_end, is_data in file_extents(source.fileno(), 0, size):
+        if is_data:
+            os.lseek(target.fileno(), base + extent_start, os.SEEK_SET)
+            copied = copy_fd(source.fileno(), target.fileno(), extent_start, extent_end, (lambda done, total: progress(extent_start + done, size)) if progress is not None else None)
+            bytes_read += copied - extent_start
+            if copied < extent_end:
+                break
+        else:
+            copied = extent_end
+    source.close()
+    profile_bytes(bytes_read, bytes_read)
+    target.seek(base + copied)
+    if copied < size:
+        stream_file(file_path, target, offset=copied, progress=(lambda done, total: progress(copied + done, size)) if progress is not None else None)
+    else:
+        target.truncate()
+    return size
 
 
-def append_line(file_path, content):
-    file = open(file_path, 'a')
-    file.write(content + '\n')
-    file.close()
+def patch(buffer, position, content):
+    buffer[position:position + len(content)] = content
+
+
+def crc32_multiply(a, b):
+    # Multiply a by b modulo the CRC32 polynomial, a must not be zero
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLYNOMIAL if b & 1 else b >> 1
+    return p
+
+
+# x^(2^n) modulo the CRC32 polynomial for n = 0..31
+CRC32_X2N_TABLE = [1 << 30]
+for _ in range(1, 32):
+    CRC32_X2N_TABLE.append(crc32_multiply(CRC32_X2N_TABLE[-1], CRC32_X2N_TABLE[-1]))
+
+
+def crc32_x8n(length):
+    # x^(8 * length) modulo the CRC32 polynomial, that is the effect of appending length zero bytes
+    p = 1 << 31
+    k = 3
+    while length:
+        if length & 1:
+            p = crc32_multiply(CRC32_X2N_TABLE[k & 31], p)
+        length >>= 1
+        k += 1
+    return p
+
+
+def crc32_combine(crc1, crc2, length2):
+    # CRC32 of A + B from the CRC32 of A, the CRC32 of B and the length of B without reading any data
+    return crc32_multiply(crc32_x8n(length2), crc1) ^ crc2
+
+
+def crc32_replace(crc, old, new, length_after):
+    # CRC32 of some data once the old bytes are replaced by the new ones of the same length, followed by length_after
+    # bytes up to the end of the data. CRC32 is linear, so the change only depends on the XOR of the old and new bytes
+    # and the data around them is never read
+    length = len(old)
+    difference = (int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little')).to_bytes(length, 'little')
+    return crc ^ crc32_combine(zlib.crc32(difference) ^ zlib.crc32(bytes(length)), 0, length_after)
+
+
+class Crc32:
+    # Accumulator with the same update()/digest() interface as hashlib objects
+    def __init__(self, value=0):
+        self.value = value
 
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
 
-def calculate_md5(f, start, length):
-    f.seek(start)
-    content = f.read(length)
-    return hashlib.md5(content).digest()
+    def digest(self):
+        return self.value.to_bytes(CRC32_SIZE, 'little')
 
+    def copy(self):
+        return Crc32(self.value)
 
-def calculate_crc32(f, start, length, value=0):
-    f.seek(start)
-    content = f.read(length)
-    return zlib.crc32(content, value).to_bytes(CRC32_SIZE, 'little')
+
+class HashRange:
+    # A hasher fed with the bytes from start to end, digests are also stored at every checkpoint offset
+    def __init__(self, start, end, hasher, checkpoints=()):
+        self.start = start
+        self.end = max(start, end)
+        self.hasher = hasher
+        self.checkpoints = set(checkpoints)
+        self.snapshots = {start: hasher.digest()}
+
+    def digest(self):
+        return self.hasher.digest()
+
+
+def hash_ranges(mm, ranges, chunk_size=HASH_CHUNK_SIZE, progress=None):
+    # Read every byte once and feed it to all the hashers whose range covers it, chunk by chunk so the data is
+    # still in the CPU cache for every hasher and without copying it out of the mmap
+    boundaries = set()
+    for r in ranges:
+        boundaries.update((r.start, r.end))
+        boundaries.update(c for c in r.checkpoints if r.start <= c <= r.end)
+    boundaries = sorted(boundaries)
+    segments = [(segment_start, segment_end, [r for r in ranges if r.start <= segment_start and segment_end <= r.end])
+                for segment_start, segment_end in zip(boundaries, boundaries[1:])]
+    total = sum(segment_end - segment_start for segment_start, segment_end, active in segments if len(active) > 0)
+    done = 0
+    with memoryview(mm) as view:
+        for segment_start, segment_end, active in segments:
+            if len(active) > 0:
+                profile_bytes(segment_end - segment_start)
+            for offset in range(segment_start, segment_end, chunk_size):
+                chunk = view[offset:min(offset + chunk_size, segment_end)]
+                for r in active:
+                    r.hasher.update(chunk)
+                if progress is not None and len(active) > 0:
+                    done += len(chunk)
+                    progress(done, total)
+                chunk.release()
+            for r in active:
+                if segment_end in r.checkpoints:
+                    r.snapshots[segment_end] = r.hasher.digest()
+    return ranges
+
+
+def hash_ranges_parallel(mm, ranges, jobs, split_size=HASH_PARALLEL_SPLIT_SIZE, progress=None):
+    # CRC32 ranges are cut into independent pieces at every boundary that are calculated concurrently and then
+    # joined back with crc32_combine, other hashes can't be combined so each one is calculated as a whole
+    crc32_ranges = [r for r in ranges if isinstance(r.hasher, Crc32)]
+    other_ranges = [r for r in ranges if not isinstance(r.hasher, Crc32)]
+    boundaries = set()
+    for r in crc32_ranges:
+        boundaries.update(range(r.start, r.end, split_size))
+        boundaries.add(r.end)
+        boundaries.update(c for c in r.checkpoints if r.start <= c <= r.end)
+    boundaries = sorted(boundaries)
+    pieces = [HashRange(piece_start, piece_end, Crc32()) for piece_start, piece_end in zip(boundaries, boundaries[1:])
+              if any(r.start <= piece_start and piece_end <= r.end for r in crc32_ranges)]
+    # Longest first so the hashes that can't be split don't end up running alone at the end
+    tasks = sorted(other_ranges + pieces, key=lambda r: r.end - r.start, reverse=True)
+    # Progress is reported from this thread as the tasks finish, counting the bytes of every task
+    total = sum(task.end - task.start for task in tasks)
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(hash_ranges, mm, [task]): task for task in tasks}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                if progress is not None:
+                    done += futures[future].end - futures[future].start
+                    progress(done, total)
+        except OperationCancelled:
+            for future in futures:
+                future.cancel()
+            raise
+    for r in crc32_ranges:
+        for piece in pieces:
+            if r.start <= piece.start and piece.end <= r.end:
+                r.hasher.value = crc32_combine(r.hasher.value, piece.hasher.value, piece.end - piece.start)
+                if piece.end in r.checkpoints:
+                    r.snapshots[piece.end] = r.hasher.digest()
+    return ranges
+
+
+def matching_length(old_mm, old_offset, new_mm, new_offset, length, step=1):
+    # Number of equal bytes from the given offsets forwards, or backwards from them when step is -1
+    matched = 0
+    while matched < length:
+        size = min(DIFF_COMPARE_SIZE, length - matched)
+        if step > 0:
+            old_content = old_mm[old_offset + matched:old_offset + matched + size]
+            new_content = new_mm[new_offset + matched:new_offset + matched + size]
+        else:
+            old_content = old_mm[old_offset - matched - size:old_offset - matched][::-1]
+            new_content = new_mm[new_offset - matched - size:new_offset - matched][::-1]
+        if old_content != new_content:
+            return matched + len(os.path.commonprefix([old_content, new_content]))
+        matched += size
+    return matched
+
+
+def content_defined_chunks(mm, start, end):
+    # Chunks ending where a rolling hash of the last bytes matches, so inserted or removed bytes only change the
+    # chunks around them and the rest are found again at their new offsets
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + DIFF_CHUNK_MAX_SIZE, end)
+        scan_start = chunk_start + DIFF_CHUNK_MIN_SIZE - DIFF_CHUNK_WINDOW
+        position = scan_start
+        rolling_hash = 0
+        for value in mm[scan_start:chunk_end]:
+            rolling_hash = ((rolling_hash << 1) + DIFF_GEAR[value]) & 0xFFFFFFFF
+            position += 1
+            if rolling_hash & DIFF_CHUNK_MASK == 0 and position - chunk_start >= DIFF_CHUNK_MIN_SIZE:
+                chunk_end = position
+                break
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+def delta(old_mm, old_start, old_end, new_mm, new_start, new_end):
+    # Operations to build the new range from the old one: (new offset, length, old offset) copies and
+    # (new offset, length, None) inserts. Only the bytes between the first and the last change are looked at
+    operations = []
+    length = min(old_end - old_start, new_end - new_start)
+    prefix = matching_length(old_mm, old_start, new_mm, new_start, length)
+    suffix = matching_length(old_mm, old_end, new_mm, new_end, length - prefix, -1)
+    operations.append((new_start, prefix, old_start))
+    old_start += prefix
+    new_start += prefix
+    old_end -= suffix
+    new_end -= suffix
+    if old_end - old_start == new_end - new_start:
+        # Changed in place, compare block by block and keep only the changed bytes of each block
+        for offset in range(0, new_end - new_start, DIFF_BLOCK_SIZE):
+            size = min(DIFF_BLOCK_SIZE, new_end - new_start - offset)
+            block_prefix = matching_length(old_mm, old_start + offset, new_mm, new_start + offset, size)
+            block_suffix = matching_length(old_mm, old_start + offset + size, new_mm, new_start + offset + size, size - block_prefix, -1)
+            operations.append((new_start + offset, block_prefix, old_start + offset))
+            operations.append((new_start + offset + block_prefix, size - block_prefix - block_suffix, None))
+            operations.append((new_start + offset + size - block_suffix, block_suffix, old_start + offset + size - block_suffix))
+    elif new_end > new_start:
+        old_chunks = {}
+        for chunk_start, chunk_end in content_defined_chunks(old_mm, old_start, old_end):
+            old_chunks.setdefault(hashlib.md5(old_mm[chunk_start:chunk_end]).digest(), chunk_start)
+        for chunk_start, chunk_end in content_defined_chunks(new_mm, new_start, new_end):
+            operations.append((chunk_start, chunk_end - chunk_start, old_chunks.get(hashlib.md5(new_mm[chunk_start:chunk_end]).digest())))
+    operations.append((new_end, suffix, old_end))
+    return merge_operations(operations)
+
+
+def merge_operations(operations):
+    # Join consecutive inserts and copies of consecutive old bytes, and drop the empty ones
+    merged = []
+    for new_offset, length, old_offset in operations:
+        if length == 0:
+            continue
+        if len(merged) > 0:
+            last_new_offset, last_length, last_old_offset = merged[-1]
+            if (last_old_offset is None and old_offset is None) or \
+                    (last_old_offset is not None and old_offset is not None and last_old_offset + last_length == old_offset):
+                merged[-1] = (last_new_offset, last_length + length, last_old_offset)
+                continue
+        merged.append((new_offset, length, old_offset))
+    return merged
+
+
+def peak_rss():
+    # Peak resident set size of the process in bytes so far, None where it can't be known
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class ProfileSpan:
+    def __init__(self, name, parent, args):
+        self.name = name
+        self.parent = parent
+        self.path = name if parent is None else parent.path + '/' + name
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.args = args
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.end = None
+        self.cpu_end = None
+        self.peak_rss = None
+
+
+class Profiler:
+    # Nested named spans for the phases of an action, with their wall and CPU times, the bytes read and written and
+    # the peak RSS of the process when they end. Nothing is recorded while there is no active profiler
+    active = None
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.stack = []
+        # Bytes can be counted from the hashing threads
+        self.lock = threading.Lock()
+
+    def begin(self, name, args):
+        span = ProfileSpan(name, self.stack[-1] if len(self.stack) > 0 else None, args)
+        self.spans.append(span)
+        self.stack.append(span)
+
+    def end(self):
+        span = self.stack.pop()
+        span.end = time.perf_counter()
+        span.cpu_end = time.process_time()
+        span.peak_rss = peak_rss()
+        # Parents include the bytes of their children
+        if span.parent is not None:
+            with self.lock:
+                span.parent.bytes_read += span.bytes_read
+                span.parent.bytes_written += span.bytes_written
+
+    def add_bytes(self, read, written):
+        if len(self.stack) > 0:
+            with self.lock:
+                self.stack[-1].bytes_read += read
+                self.stack[-1].bytes_written += written
+
+    def report(self):
+        # The spans as JSON in the Chrome trace event format, so the same file can be opened in chrome://tracing or
+        # Perfetto, and with every span and its throughput in the spans list. Spans left open by an error end now
+        while len(self.stack) > 0:
+            self.end()
+        spans = []
+        events = []
+        for span in self.spans:
+            seconds = span.end - span.start
+            spans.append({'name': span.name, 'path': span.path, 'depth': span.depth, 'args': span.args,
+                          'start': round(span.start - self.origin, 6), 'seconds': round(seconds, 6), 'cpu_seconds': round(span.cpu_end - span.cpu_start, 6),
+                          'bytes_read': span.bytes_read, 'bytes_written': span.bytes_written,
+                          'read_bytes_per_second': round(span.bytes_read / seconds) if seconds > 0 else None,
+                          'written_bytes_per_second': round(span.bytes_written / seconds) if seconds > 0 else None,
+                          'peak_rss': span.peak_rss})
+            events.append({'name': span.name, 'cat': span.path.split('/')[0], 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                           'ts': round((span.start - self.origin) * 1000000, 3), 'dur': round(seconds * 1000000, 3),
+                           'args': dict(span.args, cpu_seconds=spans[-1]['cpu_seconds'], bytes_read=span.bytes_read, bytes_written=span.bytes_written, peak_rss=span.peak_rss)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'spans': spans}
+
+    def save(self, profile_path):
+        profile_file = open(profile_path, 'w')
+        json.dump(self.report(), profile_file, indent=1)
+        profile_file.close()
+
+
+@contextlib.contextmanager
+def profile_span(name, **args):
+    # Record a phase in the active profiler, if there is one
+    profiler = Profiler.active
+    if profiler is None:
+        yield
+        return
+    profiler.begin(name, args)
+    try:
+        yield
+    finally:
+        profiler.end()
+
+
+def profiled(name):
+    # Record every call of a function as a span of the active profiler
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if Profiler.active is None:
+                return function(*args, **kwargs)
+            with profile_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_bytes(read=0, written=0):
+    if Profiler.active is not None:
+        Profiler.active.add_bytes(read, written)
+
+
+class FirmwareEvent:
+    # What a long operation is doing: kind is start, progress or end, region is the part of the firmware, the unpacked
+    # file or the ROMFS file being processed (None for the whole operation) and done and total are byte counts
+    def __init__(self, kind, operation, region, done, total, description):
+        self.kind = kind
+        self.operation = operation
+        self.region = region
+        self.done = done
+        self.total = total
+        self.description = description
+        self.time = time.perf_counter()
+
+
+class CancellationToken:
+    # Shared with a running operation, which stops with OperationCancelled the next time it checks it
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise OperationCancelled('Operation cancelled')
+
+
+class Observable:
+    # Start, progress and end events of the long operations for every subscribed observer, a callable getting a
+    # FirmwareEvent, and a cancellation token checked between chunks. With no observers and no token the chunked
+    # helpers get no progress callback at all
+    observers = ()
+    cancellation = None
+
+    def subscribe(self, observer):
+        if self.observers == ():
+            self.observers = []
+        self.observers.append(observer)
+
+    def unsubscribe(self, observer):
+        self.observers.remove(observer)
+
+    def observe(self, other):
+        # Share the observers and the cancellation token with another object, like the ROMFS of a firmware
+        other.observers = self.observers
+        other.cancellation = self.cancellation
+        return other
+
+    def emit(self, kind, operation, region=None, done=0, total=None, description=None):
+        if self.cancellation is not None:
+            self.cancellation.check()
+        if len(self.observers) > 0:
+            event = FirmwareEvent(kind, operation, region, done, total, description)
+            for observer in self.observers:
+                observer(event)
+
+    def progress(self, operation, region=None):
+        # Callback for the chunked helpers, called with the bytes done and the total after every chunk
+        if len(self.observers) == 0 and self.cancellation is None:
+            return None
+        return lambda done, total: self.emit('progress', operation, region, done, total)
+
+
+class ConsoleObserver:
+    # The command line subscriber: the description of every step goes to stdout, and the progress with the
+    # throughput and the time left to stderr if asked for
+    def __init__(self, show_progress=False, interval=PROGRESS_INTERVAL):
+        self.show_progress = show_progress
+        self.interval = interval
+        self.starts = {}
+        self.last_time = 0
+
+    def __call__(self, event):
+        if event.kind == 'start':
+            self.starts[(event.operation, event.region)] = event.time
+            if event.description is not None:
+                print(event.description)
+        elif event.kind == 'progress' and self.show_progress and event.total and event.time - self.last_time >= self.interval:
+            self.last_time = event.time
+            # Regions without a start event of their own are timed from the start of the operation
+            start = self.starts.get((event.operation, event.region), self.starts.get((event.operation, None), event.time))
+            speed = event.done / (event.time - start) if event.time > start else 0
+            left = ', {:.0f} s left'.format((event.total - event.done) / speed) if speed > 0 else ''
+            print('\r{}{}: {:3.0f}% {:.1f} MB/s{}\033[K'.format(event.operation, ' ' + event.region if event.region is not None else '', 100 * event.done / event.total, speed / 1000000, left), end='', file=sys.stderr, flush=True)
+        elif event.kind == 'end' and self.show_progress and event.region is None:
+            print('\r\033[K', end='', file=sys.stderr, flush=True)
 
 
 class HeaderSection:
@@ -246,7 +1087,22 @@ class Box:
         self.end = end
 
 
-class RomFs:
+class RomFsTable:
+    # File entries of a ROMFS header, the names in a list and the numbers in arrays
+    def __init__(self):
+        self.names = []
+        self.lengths = array.array('I')
+        self.offsets = array.array('I')
+        self.crc32s = array.array('I')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return zip(self.names, self.lengths, self.offsets, self.crc32s)
+
+
+class RomFs(Observable):
     def __init__(self):
         self.files = []
 
@@ -254,7 +1110,7 @@ class RomFs:
         self.files.append([file_name, content])
 
     def remove_file(self, file_name):
-        for index, f in self.files:
+        for index, f in enumerate(self.files):
             if f[0] == file_name:
                 self.files.pop(index)
                 break
@@ -262,37 +1118,71 @@ class RomFs:
     def remove_files(self):
         self.files.clear()
 
-    def extract(self, source, target):
-        romfs = open(source, 'r+b')
-        romfs_mm = mmap.mmap(romfs.fileno(), 0)
-        romfs_mm.seek(0)
-        romfs_magic_number = read(romfs_mm, ROMFS_MAGIC_NUMBER_POSITION, len(ROMFS_MAGIC_NUMBER))
-        if romfs_magic_number != ROMFS_MAGIC_NUMBER:
+    def read_table(self, mm):
+        # Parse all the file entries of the ROMFS header at once, mm can be an mmap or a memoryview
+        if mm[ROMFS_MAGIC_NUMBER_POSITION:ROMFS_MAGIC_NUMBER_POSITION + len(ROMFS_MAGIC_NUMBER)] != ROMFS_MAGIC_NUMBER:
+            return None
+        file_count = int.from_bytes(mm[ROMFS_FILECOUNT_POSITION:ROMFS_FILECOUNT_POSITION + ROMFS_FILECOUNT_SIZE], 'little')
+        table_position = ROMFS_FILECOUNT_POSITION + ROMFS_FILECOUNT_SIZE
+        file_count = min(file_count, (len(mm) - table_position) // ROMFS_FILE_ENTRY_SIZE)
+        table = RomFsTable()
+        entries = mm[table_position:table_position + file_count * ROMFS_FILE_ENTRY_SIZE]
+        for file_name, file_length, file_offset, file_crc32 in ROMFS_FILE_ENTRY_STRUCT.iter_unpack(entries):
+            table.names.append(file_name.decode('utf-8').rstrip('\0'))
+            table.lengths.append(file_length)
+            table.offsets.append(file_offset)
+            table.crc32s.append(file_crc32)
+        return table
+
+    def list(self, source):
+        romfs = open(source, 'rb')
+        romfs_mm = mmap.mmap(romfs.fileno(), 0, access=mmap.ACCESS_READ)
+        table = self.read_table(romfs_mm)
+        romfs_mm.close()
+        romfs.close()
+        return table
+
+    @profiled('romfs.extract')
+    def extract(self, source, target, store=None):
+        # Returns the name, CRC32 and store object id (None without a store) of every extracted file
+        extracted = []
+        romfs = open(source, 'rb')
+        romfs_mm = mmap.mmap(romfs.fileno(), 0, access=mmap.ACCESS_READ)
+        table = self.read_table(romfs_mm)
+        if table is None:
             print('Invalid ROMFS magic number detected, skipping...')
         else:
             print('Detected ROMFS section, unpacking...')
-            romfs_file_count = read(romfs_mm, ROMFS_FILECOUNT_POSITION, ROMFS_FILECOUNT_SIZE)
-            romfs_file_count = int.from_bytes(romfs_file_count, 'little')
-            print('ROMFS contains ' + str(romfs_file_count) + ' files')
+            print('ROMFS contains ' + str(len(table)) + ' files')
             target.mkdir()
-            target_files_list_file = target.with_suffix('.files')
-            for i in range(0, romfs_file_count):
-                file_entry_base_position = (len(ROMFS_MAGIC_NUMBER) + ROMFS_FILECOUNT_SIZE) + i * ROMFS_FILE_ENTRY_SIZE
-                file_name = read(romfs_mm, file_entry_base_position + ROMFS_FILE_FILENAME_POSITION, ROMFS_FILE_FILENAME_SIZE).decode('utf-8').rstrip('\0')
-                # print('Extracting ' + file_name)
-                file_length = int.from_bytes(
-                    read(romfs_mm, file_entry_base_position + ROMFS_FILE_LENGTH_POSITION, ROMFS_FILE_LENGTH_SIZE), 'little')
-                file_offset = int.from_bytes(
-                    read(romfs_mm, file_entry_base_position + ROMFS_FILE_OFFSET_POSITION, ROMFS_FILE_OFFSET_SIZE), 'little')
-                file_crc32 = read(romfs_mm, file_entry_base_position + ROMFS_FILE_CRC32_POSITION, ROMFS_FILE_CRC32_SIZE)
-                file_content = read(romfs_mm, file_offset, file_length)
-                file_content_crc32 = calculate_crc32(romfs_mm, file_offset, file_length)
-                if file_crc32 != file_content_crc32:
-                    print('Invalid file CRC32, skipping...')
-                    continue
-                write(target / file_name, file_content)
-                append_line(target_files_list_file, file_name)
+            # Progress is reported once per file with the file name as region
+            total = sum(table.lengths)
+            done = 0
+            self.emit('start', 'extract', Path(source).name, total=total)
+            with memoryview(romfs_mm) as view:
+                for file_name, file_length, file_offset, file_crc32 in table:
+                    # print('Extracting ' + file_name)
+                    with view[file_offset:file_offset + file_length] as file_content:
+                        profile_bytes(file_length)
+                        if zlib.crc32(file_content) != file_crc32:
+                            print('Invalid file CRC32, skipping...')
+                            continue
+                        # Written from the mmap so long runs of zeros become holes
+                        write_file = functools.partial(copy_range, romfs, romfs_mm, file_offset, file_length)
+                        if store is not None:
+                            object_id = store.add(file_content, write_file)
+                            store.link(object_id, target / file_name)
+                        else:
+                            object_id = None
+                            write_file(target / file_name)
+                    extracted.append((file_name, file_crc32, object_id))
+                    done += file_length
+                    self.emit('progress', 'extract', file_name, done, total)
+            self.emit('end', 'extract', Path(source).name, done, total)
+            write(target.with_suffix('.files'), ''.join(file_name + '\n' for file_name, file_crc32, object_id in extracted).encode('utf-8'))
+        romfs_mm.close()
         romfs.close()
+        return extracted
 
     def write_files(self, files_list_file):
         self.remove_files()
@@ -303,151 +1193,1449 @@ class RomFs:
         for file_name in files:
             file_name = file_name.strip()
             # print(file_name)
-            file = open(folder / file_name, 'rb')
-            self.add_file(file_name, file.read())
-            file.close()
+            # Only the path is stored, the content is streamed when writing the ROMFS
+            self.add_file(file_name, folder / file_name)
         files_file.close()
-        self.write(folder.parent / (section_name + '.bin'))
+        return self.write(folder.parent / (section_name + '.bin'))
 
+    @profiled('romfs.write')
     def write(self, output):
         # Check file count is not more than 538
         if len(self.files) > ROMFS_MAX_FILE_COUNT:
-            print('Too much files. Max file count is {:d}'.format(ROMFS_MAX_FILE_COUNT))
-            return
+            raise FirmwareError('Too much files. Max file count is {:d}'.format(ROMFS_MAX_FILE_COUNT))
 
         # Check file names are max 64 characters in length
         for f in self.files:
-            if len(f[0]) > ROMFS_FILE_FILENAME_SIZE:
-                print('File name {} too long. Max file name length is {:d}'.format(f[1], ROMFS_FILE_FILENAME_SIZE))
-                return
+            if len(f[0].encode('utf-8')) > ROMFS_FILE_FILENAME_SIZE:
+                raise FirmwareError('File name {} too long. Max file name length is {:d}'.format(f[0], ROMFS_FILE_FILENAME_SIZE))
 
-        # Create ROMFS header
+        # Write ROMFS content with files content first, the header is written at the end once the sizes and CRC32s are known
+        replace_file(output)
+        self.emit('start', 'write', Path(output).name)
         output_file = open(output, 'wb')
-        output_file.write(ROMFS_MAGIC_NUMBER)
-        output_file.write(len(self.files).to_bytes(ROMFS_FILECOUNT_SIZE, 'little'))
+        output_file.seek(ROMFS_HEADER_SIZE)
+        content_crc32 = Crc32()
+        entries = []
         file_offset = ROMFS_HEADER_SIZE  # First file offset is header size
-        for f in self.files:
-            # File name with leading nulls up to 64 characters
-            file_name = f[0] + ('\0' * (ROMFS_FILE_FILENAME_SIZE - len(f[0])))
-            output_file.write(bytes(file_name, encoding='utf8'))
-            # File size
-            file_size = len(f[1])
-            output_file.write(file_size.to_bytes(ROMFS_FILE_LENGTH_SIZE, 'little'))
-            # File data offset
-            output_file.write(file_offset.to_bytes(ROMFS_FILE_OFFSET_SIZE, 'little'))
-            file_offset += file_size  # Prepare the offset for next file with current file size plus previous offset
-            file_offset += 2048 - (file_size % 2048)  # Round to the next 2048 block
-            # File CRC32
-            file_crc32 = zlib.crc32(f[1], 0)
-            output_file.write(file_crc32.to_bytes(ROMFS_FILE_CRC32_SIZE, 'little'))
-        header_leading_null = '\0' * (ROMFS_HEADER_SIZE - (8 + len(self.files) * ROMFS_FILE_ENTRY_SIZE))
-        output_file.write(bytes(header_leading_null, encoding='utf8'))
-        # Write ROMFS content with files content
-        for f in self.files:
-            file_content = f[1]
-            output_file.write(file_content)
+        for file_name, content in self.files:
+            file_crc32 = Crc32()
+            if isinstance(content, (bytes, bytearray)):
+                file_crc32.update(content)
+                content_crc32.update(content)
+                output_file.write(content)
+                profile_bytes(written=len(content))
+                file_size = len(content)
+            else:
+                # Files added by path are read in chunks
+                file_size = stream_file(content, output_file, [file_crc32, content_crc32])
             # Add leading nulls to fill the block up to 2048 bytes
-            file_size = len(f[1])
-            amount = 2048 - (file_size % 2048)
-            output_file.write(bytes('\0' * amount, encoding='utf8'))
+            padding = ROMFS_PADDING[:ROMFS_BLOCK_SIZE - (file_size % ROMFS_BLOCK_SIZE)]
+            content_crc32.update(padding)
+            output_file.write(padding)
+            # File name with leading nulls up to 64 characters, file size, file data offset and file CRC32
+            entries.append(ROMFS_FILE_ENTRY_STRUCT.pack(file_name.encode('utf-8'), file_size, file_offset, file_crc32.value))
+            file_offset += file_size + len(padding)  # Prepare the offset for next file rounded to the next 2048 block
+            self.emit('progress', 'write', file_name, file_offset - ROMFS_HEADER_SIZE)
+
+        # Create ROMFS header
+        header = ROMFS_MAGIC_NUMBER + len(self.files).to_bytes(ROMFS_FILECOUNT_SIZE, 'little') + b''.join(entries)
+        header += bytes(ROMFS_HEADER_SIZE - len(header))
+        output_file.seek(0)
+        output_file.write(header)
         output_file.close()
+        profile_bytes(written=len(header))
+        self.emit('end', 'write', Path(output).name, file_offset, file_offset)
+
+        # CRC32 and size of the whole ROMFS so it doesn't have to be read again
+        return crc32_combine(zlib.crc32(header), content_crc32.value, file_offset - ROMFS_HEADER_SIZE), file_offset
+
+
+class RomFsSection:
+    # A ROMFS section read in place from the firmware mmap, the files are returned as memoryviews without copying them
+    def __init__(self, mm, start, length):
+        self.view = memoryview(mm)[start:start + length]
+        self.table = RomFs().read_table(self.view)
+        self.index = {}
+        self.verified = set()
+        if self.table is not None:
+            for file_name, file_length, file_offset, file_crc32 in self.table:
+                self.index[file_name] = (file_offset, file_length, file_crc32)
+
+    def close(self):
+        self.view.release()
+
+    def names(self):
+        return list(self.index)
+
+    def get(self, file_name, verify=False):
+        if file_name not in self.index:
+            return None
+        file_offset, file_length, file_crc32 = self.index[file_name]
+        content = self.view[file_offset:file_offset + file_length]
+        # The CRC32 is only checked the first time the file is read
+        if verify and file_name not in self.verified:
+            if zlib.crc32(content) != file_crc32:
+                print('Invalid file CRC32 for ' + file_name, file=sys.stderr)
+                return None
+            self.verified.add(file_name)
+        return content
+
+
+class Ext2Inode:
+    def __init__(self, number, mode, uid, gid, size, atime, ctime, mtime, links_count, blocks, flags, block, file_acl):
+        self.number = number
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.atime = atime
+        self.ctime = ctime
+        self.mtime = mtime
+        self.links_count = links_count
+        self.blocks = blocks
+        self.flags = flags
+        self.block = block
+        self.file_acl = file_acl
+
+
+class Ext2File:
+    # A file of the directory an ext2 file system is rebuilt from, matched with the original inode at the same path
+    def __init__(self, source, file_stat, original):
+        self.source = source
+        self.stat = file_stat
+        self.original = original
+        self.mode = file_stat.st_mode if file_stat is not None else original.mode
+        self.number = None
+        self.links_count = 0
+        self.entries = []  # Name and file of each directory entry
+        self.keep = False  # The original inode and its blocks are used as they are
+        self.present = []  # Logical blocks with data, the rest are holes
+        self.content = None  # Data of directories and symbolic links
+        self.size = 0
+        self.block = None  # Block pointers of files that fit in the inode
+        self.blocks = []  # Physical blocks of rewritten files in allocation order
+        self.needed = 0
+        self.indirect_blocks = {}
+        self.data_blocks = []
+        self.parent = None
+
+
+class Ext2:
+    # Read only ext2 file system read in place from a memoryview, without mounting it
+    def __init__(self, view):
+        self.view = view
+        (self.inodes_count, self.blocks_count, self.r_blocks_count, self.free_blocks_count, self.free_inodes_count,
+         self.first_data_block, log_block_size, log_frag_size, self.blocks_per_group, self.frags_per_group,
+         self.inodes_per_group, self.mount_time, self.write_time, self.mount_count, self.max_mount_count, magic_number,
+         self.state, self.errors, self.minor_rev_level, self.last_check, self.check_interval, self.creator_os,
+         self.rev_level, self.default_reserved_uid, self.default_reserved_gid, self.first_inode, self.inode_size,
+         self.block_group_number, self.feature_compat, self.feature_incompat,
+         self.feature_ro_compat) = EXT2_SUPERBLOCK_STRUCT.unpack_from(view, EXT2_SUPERBLOCK_POSITION)
+        if magic_number.to_bytes(2, 'little') != EXT2_MAGIC_NUMBER:
+            raise ValueError('Invalid ext2 magic number')
+        if self.feature_incompat & ~EXT2_FEATURE_INCOMPAT_SUPPORTED:
+            raise ValueError('Unsupported ext2 features 0x{:08x}'.format(self.feature_incompat))
+        if self.rev_level == 0:
+            self.first_inode = EXT2_GOOD_OLD_FIRST_INODE
+            self.inode_size = EXT2_GOOD_OLD_INODE_SIZE
+        self.block_size = 1024 << log_block_size
+        self.group_count = (self.blocks_count - self.first_data_block + self.blocks_per_group - 1) // self.blocks_per_group
+        self.group_descriptors = []
+        group_descriptors_position = (self.first_data_block + 1) * self.block_size
+        for i in range(0, self.group_count):
+            self.group_descriptors.append(EXT2_GROUP_DESCRIPTOR_STRUCT.unpack_from(view, group_descriptors_position + i * EXT2_GROUP_DESCRIPTOR_STRUCT.size))
+        # Decoded inodes and indirect blocks are cached as they are used over and over while walking the tree
+        self.inode = functools.lru_cache(maxsize=EXT2_CACHE_SIZE)(self.read_inode)
+        self.indirect_block = functools.lru_cache(maxsize=EXT2_CACHE_SIZE)(self.read_indirect_block)
+
+    def block(self, number):
+        return self.view[number * self.block_size:(number + 1) * self.block_size]
+
+    def inode_position(self, number):
+        group, index = divmod(number - 1, self.inodes_per_group)
+        return self.group_descriptors[group][2] * self.block_size + index * self.inode_size
+
+    def read_inode(self, number):
+        (mode, uid, size, atime, ctime, mtime, dtime, gid, links_count, blocks, flags, osd1, *block,
+         generation, file_acl, size_high, fragment_address, osd2) = EXT2_INODE_STRUCT.unpack_from(self.view, self.inode_position(number))
+        if stat.S_ISREG(mode):
+            size |= size_high << 32
+        # The high 16 bits of the owner are in the Linux specific part of the inode
+        uid |= int.from_bytes(osd2[4:6], 'little') << 16
+        gid |= int.from_bytes(osd2[6:8], 'little') << 16
+        return Ext2Inode(number, mode, uid, gid, size, atime, ctime, mtime, links_count, blocks, flags, tuple(block), file_acl)
+
+    def read_indirect_block(self, number):
+        block_numbers = array.array('I')
+        block_numbers.frombytes(self.block(number))
+        return block_numbers
+
+    def data_blocks(self, inode):
+        # Block numbers of each block of the file in order, 0 for the holes of sparse files
+        count = (inode.size + self.block_size - 1) // self.block_size
+        pointers_per_block = self.block_size // 4
+        for logical in range(0, count):
+            if logical < EXT2_DIRECT_BLOCKS:
+                yield inode.block[logical]
+                continue
+            logical -= EXT2_DIRECT_BLOCKS
+            level = 0
+            while logical >= pointers_per_block ** (level + 1):
+                logical -= pointers_per_block ** (level + 1)
+                level += 1
+            number = inode.block[EXT2_DIRECT_BLOCKS + level]
+            for depth in range(level, -1, -1):
+                if number == 0:
+                    break
+                number = self.indirect_block(number)[(logical // pointers_per_block ** depth) % pointers_per_block]
+            yield number
+
+    def data_runs(self, inode):
+        # Contiguous runs of the file data as (first block, block count), first block 0 for holes
+        run_start = None
+        run_length = 0
+        for number in self.data_blocks(inode):
+            if run_start is not None and ((run_start == 0 and number == 0) or (run_start != 0 and number == run_start + run_length)):
+                run_length += 1
+            else:
+                if run_start is not None:
+                    yield run_start, run_length
+                run_start = number
+                run_length = 1
+        if run_start is not None:
+            yield run_start, run_length
+
+    def read(self, inode, target):
+        # Write the file content to the target file, the data comes straight from the memoryview
+        remaining = inode.size
+        for first_block, block_count in self.data_runs(inode):
+            length = min(remaining, block_count * self.block_size)
+            if first_block == 0 and target.seekable():
+                target.seek(length, os.SEEK_CUR)
+                target.truncate()
+            elif first_block == 0:
+                for offset in range(0, length, HASH_CHUNK_SIZE):
+                    target.write(bytes(min(HASH_CHUNK_SIZE, length - offset)))
+            else:
+                profile_bytes(length, length)
+                with self.view[first_block * self.block_size:first_block * self.block_size + length] as content:
+                    target.write(content)
+            remaining -= length
+
+    def is_fast_symlink(self, inode):
+        # Short symbolic links are stored in the inode block pointers
+        return stat.S_ISLNK(inode.mode) and inode.size < EXT2_FAST_SYMLINK_SIZE and inode.blocks == (self.block_size // 512 if inode.file_acl else 0)
+
+    def read_link(self, inode):
+        if self.is_fast_symlink(inode):
+            return struct.pack('<15I', *inode.block)[:inode.size].decode('utf-8', 'surrogateescape')
+        content = io.BytesIO()
+        self.read(inode, content)
+        return content.getvalue().decode('utf-8', 'surrogateescape')
+
+    def entries(self, inode):
+        # Name and inode number of every entry of a directory, without . and ..
+        for number in self.data_blocks(inode):
+            if number == 0:
+                continue
+            block = self.block(number)
+            position = 0
+            while position < self.block_size:
+                entry_inode, record_length, name_length, file_type = EXT2_DIRECTORY_ENTRY_STRUCT.unpack_from(block, position)
+                if record_length < EXT2_DIRECTORY_ENTRY_STRUCT.size:
+                    break
+                if not self.feature_incompat & EXT2_FEATURE_INCOMPAT_FILETYPE:
+                    name_length |= file_type << 8
+                if entry_inode != 0:
+                    name_position = position + EXT2_DIRECTORY_ENTRY_STRUCT.size
+                    name = bytes(block[name_position:name_position + name_length]).decode('utf-8', 'surrogateescape')
+                    if name != '.' and name != '..':
+                        yield name, entry_inode
+                position += record_length
+
+    def walk(self, path='/', inode=None):
+        # Path and inode of every file under the given directory, parents first
+        if inode is None:
+            inode = self.lookup(path)
+        for name, number in self.entries(inode):
+            child = self.inode(number)
+            child_path = path.rstrip('/') + '/' + name
+            yield child_path, child
+            if stat.S_ISDIR(child.mode):
+                yield from self.walk(child_path, child)
+
+    def lookup(self, path, follow_links=True, depth=0):
+        inode = self.inode(EXT2_ROOT_INODE)
+        current = '/'
+        names = [name for name in path.split('/') if name != '']
+        for i in range(0, len(names)):
+            if not stat.S_ISDIR(inode.mode):
+                return None
+            number = dict(self.entries(inode)).get(names[i])
+            if number is None:
+                return None
+            inode = self.inode(number)
+            # Symbolic links in the middle of the path are always followed
+            if stat.S_ISLNK(inode.mode) and (follow_links or i < len(names) - 1):
+                if depth > EXT2_MAX_SYMLINKS:
+                    return None
+                link = self.read_link(inode)
+                link_path = link if link.startswith('/') else current.rstrip('/') + '/' + link
+                inode = self.lookup(link_path, True, depth + 1)
+                if inode is None:
+                    return None
+            current = current.rstrip('/') + '/' + names[i]
+        return inode
+
+    def extract_file(self, inode, target):
+        # Extract one inode to the target path, keeping the permissions and the modification time
+        if stat.S_ISDIR(inode.mode):
+            # Permissions and times are set once all the directory files have been extracted
+            target.mkdir(exist_ok=True)
+            return
+        elif stat.S_ISREG(inode.mode):
+            target_file = open(target, 'wb')
+            self.read(inode, target_file)
+            target_file.close()
+        elif stat.S_ISLNK(inode.mode):
+            os.symlink(self.read_link(inode), target)
+            return
+        elif stat.S_ISFIFO(inode.mode) and hasattr(os, 'mkfifo'):
+            os.mkfifo(target)
+        else:
+            # Device nodes can't be created without root privileges
+            print('Special file {} skipped'.format(target))
+            return
+        os.chmod(target, stat.S_IMODE(inode.mode))
+        os.utime(target, (inode.atime, inode.mtime))
+
+    @profiled('ext2.extract')
+    def extract(self, target, path='/'):
+        # Extract a whole directory tree or a single file
+        target = Path(target)
+        inode = self.lookup(path, follow_links=False)
+        if inode is None:
+            print('{} not found in ext2 file system'.format(path))
+            return False
+        if not stat.S_ISDIR(inode.mode):
+            self.extract_file(inode, target)
+            return True
+        target.mkdir(exist_ok=True)
+        directories = [(target, inode)]
+        links = {}
+        for file_path, file_inode in self.walk(path, inode):
+            file_target = target / os.path.relpath(file_path, path)
+            # Hard links are kept so the files don't take more space when the file system is rebuilt
+            if stat.S_ISREG(file_inode.mode) and file_inode.links_count > 1:
+                if file_inode.number in links:
+                    os.link(links[file_inode.number], file_target)
+                    continue
+                links[file_inode.number] = file_target
+            self.extract_file(file_inode, file_target)
+            if stat.S_ISDIR(file_inode.mode):
+                directories.append((file_target, file_inode))
+        # Directory times and permissions are set at the end, after all their files have been created
+        for directory, directory_inode in reversed(directories):
+            os.chmod(directory, stat.S_IMODE(directory_inode.mode))
+            os.utime(directory, (directory_inode.atime, directory_inode.mtime))
+        return True
+
+    def bitmap(self, number, count):
+        # Bitmap block with one byte per bit
+        return b''.join(EXT2_BITMAP_BYTES[value] for value in self.block(number))[:count]
+
+    def inode_blocks(self, inode):
+        # Data and indirect blocks of an inode in allocation order, each indirect block before the blocks it points to
+        if not (stat.S_ISREG(inode.mode) or stat.S_ISDIR(inode.mode) or (stat.S_ISLNK(inode.mode) and not self.is_fast_symlink(inode))):
+            return
+        for number in inode.block[:EXT2_DIRECT_BLOCKS]:
+            if number != 0:
+                yield number
+        for level in range(0, 3):
+            yield from self.indirect_blocks(inode.block[EXT2_DIRECT_BLOCKS + level], level)
+
+    def indirect_blocks(self, number, level):
+        if number == 0:
+            return
+        yield number
+        for child in self.indirect_block(number):
+            if level > 0:
+                yield from self.indirect_blocks(child, level - 1)
+            elif child != 0:
+                yield child
+
+    def map_blocks(self, present, allocate):
+        # Block pointers, indirect blocks and data blocks for the logical blocks with data, allocated in the same order
+        # as inode_blocks() reads them
+        pointers_per_block = self.block_size // 4
+        block = [0] * EXT2_BLOCK_POINTERS
+        indirect_blocks = {}
+        data_blocks = []
+        for logical in present:
+            if logical < EXT2_DIRECT_BLOCKS:
+                block[logical] = allocate()
+                data_blocks.append((logical, block[logical]))
+                continue
+            relative = logical - EXT2_DIRECT_BLOCKS
+            level = 0
+            while relative >= pointers_per_block ** (level + 1):
+                relative -= pointers_per_block ** (level + 1)
+                level += 1
+            if block[EXT2_DIRECT_BLOCKS + level] == 0:
+                block[EXT2_DIRECT_BLOCKS + level] = allocate()
+                indirect_blocks[block[EXT2_DIRECT_BLOCKS + level]] = array.array('I', [0]) * pointers_per_block
+            number = block[EXT2_DIRECT_BLOCKS + level]
+            for depth in range(level, 0, -1):
+                pointers = indirect_blocks[number]
+                index = (relative // pointers_per_block ** depth) % pointers_per_block
+                if pointers[index] == 0:
+                    pointers[index] = allocate()
+                    indirect_blocks[pointers[index]] = array.array('I', [0]) * pointers_per_block
+                number = pointers[index]
+            indirect_blocks[number][relative % pointers_per_block] = allocate()
+            data_blocks.append((logical, indirect_blocks[number][relative % pointers_per_block]))
+        return block, indirect_blocks, data_blocks
+
+    def directory_content(self, file):
+        # Linear directory blocks, entries never cross a block boundary and the last one of each block fills it
+        entries = [('.', file), ('..', file.parent)] + file.entries
+        content = bytearray()
+        block_start = 0
+        last_entry = 0
+        for name, child in entries:
+            name = os.fsencode(name)
+            record_length = (EXT2_DIRECTORY_ENTRY_STRUCT.size + len(name) + 3) & ~3
+            if len(content) + record_length > block_start + self.block_size:
+                struct.pack_into('<H', content, last_entry + 4, block_start + self.block_size - last_entry)
+                content += bytes(block_start + self.block_size - len(content))
+                block_start += self.block_size
+            last_entry = len(content)
+            if self.feature_incompat & EXT2_FEATURE_INCOMPAT_FILETYPE:
+                file_type = EXT2_FILE_TYPES[stat.S_IFMT(child.mode)]
+            else:
+                file_type = len(name) >> 8
+            content += EXT2_DIRECTORY_ENTRY_STRUCT.pack(child.number, record_length, len(name) & 0xFF, file_type)
+            content += name + bytes(record_length - EXT2_DIRECTORY_ENTRY_STRUCT.size - len(name))
+        struct.pack_into('<H', content, last_entry + 4, block_start + self.block_size - last_entry)
+        content += bytes(block_start + self.block_size - len(content))
+        return content
+
+    def is_unchanged(self, file):
+        # Regular files are compared by size and modification time, both kept when the file system is extracted
+        original = file.original
+        if original is None or stat.S_ISDIR(file.mode) or stat.S_ISCHR(file.mode) or stat.S_ISBLK(file.mode):
+            return False
+        if stat.S_ISREG(file.mode):
+            return file.stat.st_size == original.size and int(file.stat.st_mtime) == original.mtime
+        if stat.S_ISLNK(file.mode):
+            return os.readlink(file.source) == self.read_link(original)
+        return True
+
+    def scan(self, source):
+        # Files of the source directory, parents first, matched with the original inodes at the same path
+        root = Ext2File(Path(source), os.lstat(source), self.inode(EXT2_ROOT_INODE))
+        root.parent = root
+        files = [root]
+        sources = {}
+        kept = {}
+        directories = [root]
+        while len(directories) > 0:
+            directory = directories.pop()
+            original_entries = dict(self.entries(directory.original)) if directory.original is not None else {}
+            names = os.listdir(directory.source)
+            # Device nodes and sockets can't be extracted without root privileges, so the original ones are kept
+            existing_names = set(names)
+            special_names = set(name for name, number in original_entries.items() if name not in existing_names and
+                                (stat.S_ISCHR(self.inode(number).mode) or stat.S_ISBLK(self.inode(number).mode) or stat.S_ISSOCK(self.inode(number).mode)))
+            # Files keep their original order and new ones are added at the end
+            order = {name: position for position, name in enumerate(original_entries)}
+            for name in sorted(names + list(special_names), key=lambda name: (order.get(name, len(order)), name)):
+                if len(os.fsencode(name)) > EXT2_MAX_NAME_LENGTH:
+                    raise FirmwareError('File name too long for ext2: {}'.format(directory.source / name))
+                original = self.inode(original_entries[name]) if name in original_entries else None
+                if name in special_names:
+                    file = kept.get(original.number)
+                    if file is None:
+                        file = Ext2File(None, None, original)
+                        file.keep = True
+                        kept[original.number] = file
+                else:
+                    file_stat = os.lstat(directory.source / name)
+                    file = sources.get((file_stat.st_dev, file_stat.st_ino))
+                    if file is None:
+                        if original is not None and stat.S_IFMT(original.mode) != stat.S_IFMT(file_stat.st_mode):
+                            original = None
+                        file = Ext2File(directory.source / name, file_stat, original)
+                        file.keep = self.is_unchanged(file)
+                        sources[(file_stat.st_dev, file_stat.st_ino)] = file
+                        if stat.S_ISDIR(file.mode):
+                            directories.append(file)
+                if file.links_count == 0:
+                    file.parent = directory
+                    files.append(file)
+                file.links_count += 1
+                directory.entries.append((name, file))
+        for file in files:
+            if stat.S_ISDIR(file.mode):
+                file.links_count = 2 + len([child for name, child in file.entries if stat.S_ISDIR(child.mode)])
+        return files
+
+    def prepare_file(self, file):
+        # Content and block pointers of a file to rewrite, and the blocks it needs including the indirect ones
+        file.block = [0] * EXT2_BLOCK_POINTERS
+        if stat.S_ISDIR(file.mode):
+            file.content = self.directory_content(file)
+            block_count = len(file.content) // self.block_size
+            # Directories don't shrink, lost+found has its blocks allocated in advance for e2fsck
+            if file.original is not None and file.original.size // self.block_size > block_count:
+                empty_block = EXT2_DIRECTORY_ENTRY_STRUCT.pack(0, self.block_size, 0, 0) + bytes(self.block_size - EXT2_DIRECTORY_ENTRY_STRUCT.size)
+                file.content += empty_block * (file.original.size // self.block_size - block_count)
+                block_count = file.original.size // self.block_size
+            file.present = range(0, block_count)
+            file.size = block_count * self.block_size
+        elif stat.S_ISREG(file.mode):
+            # Blocks full of zeros are left as holes
+            zeros = bytes(self.block_size)
+            source_file = open(file.source, 'rb')
+            file.present = [logical for logical, content in enumerate(iter(functools.partial(source_file.read, self.block_size), b'')) if content != zeros[:len(content)]]
+            source_file.close()
+            file.size = file.stat.st_size
+        elif stat.S_ISLNK(file.mode):
+            target = os.fsencode(os.readlink(file.source))
+            file.size = len(target)
+            if len(target) < EXT2_FAST_SYMLINK_SIZE:
+                file.block = list(struct.unpack('<15I', target.ljust(EXT2_FAST_SYMLINK_SIZE, b'\0')))
+            else:
+                file.content = target
+                file.present = range(0, (len(target) + self.block_size - 1) // self.block_size)
+        elif stat.S_ISCHR(file.mode) or stat.S_ISBLK(file.mode):
+            major = os.major(file.stat.st_rdev)
+            minor = os.minor(file.stat.st_rdev)
+            if major < 0x100 and minor < 0x100:
+                file.block[0] = major << 8 | minor
+            else:
+                file.block[1] = (minor & 0xFF) | (major << 8) | ((minor & ~0xFF) << 12)
+        block, indirect_blocks, data_blocks = self.map_blocks(file.present, itertools.count(1).__next__)
+        file.needed = len(indirect_blocks) + len(data_blocks)
+
+    def inode_content(self, file):
+        # The original inode updated with the new file, or a new inode owned by root
+        if file.original is not None:
+            content = bytearray(self.view[self.inode_position(file.original.number):self.inode_position(file.original.number) + self.inode_size])
+        else:
+            content = bytearray(self.inode_size)
+            extra_size_position = EXT2_INODE_STRUCT.size
+            if self.inode_size > EXT2_INODE_STRUCT.size:
+                root_position = self.inode_position(EXT2_ROOT_INODE) + extra_size_position
+                content[extra_size_position:extra_size_position + EXT2_INODE_EXTRA_SIZE_SIZE] = self.view[root_position:root_position + EXT2_INODE_EXTRA_SIZE_SIZE]
+        fields = list(EXT2_INODE_STRUCT.unpack_from(content))
+        fields[0] = file.mode
+        fields[8] = file.links_count
+        if not file.keep:
+            mtime = int(file.stat.st_mtime) & 0xFFFFFFFF
+            fields[2] = file.size & 0xFFFFFFFF  # Size
+            fields[3] = file.original.atime if file.original is not None else mtime  # Access time
+            fields[4] = max(file.original.ctime, mtime) if file.original is not None else mtime  # Change time
+            fields[5] = mtime  # Modification time
+            fields[6] = 0  # Deletion time
+            fields[9] = (len(file.blocks) + (1 if fields[28] != 0 else 0)) * (self.block_size // 512)  # Blocks
+            fields[10] &= ~EXT2_INDEX_FLAG  # Flags
+            fields[12:12 + EXT2_BLOCK_POINTERS] = file.block
+            if stat.S_ISREG(file.mode):
+                fields[29] = file.size >> 32  # Size high
+        EXT2_INODE_STRUCT.pack_into(content, 0, *fields)
+        return content
+
+    @profiled('ext2.write')
+    def write_files(self, source, output):
+        # Rebuild the file system from a directory into an image with the same size and layout. Unchanged files keep
+        # their inodes and blocks from the original image, and changed files reuse their own blocks first. Returns
+        # whether the image was written, it isn't when no file has changed
+        if self.feature_ro_compat & ~EXT2_FEATURE_RO_COMPAT_WRITABLE:
+            raise FirmwareError('Unsupported ext2 features 0x{:08x} for writing'.format(self.feature_ro_compat))
+        files = self.scan(source)
+
+        # Check the inodes first, reserved inodes are always in use
+        reserved_inodes = self.first_inode - 1
+        if len(files) - 1 > self.inodes_count - reserved_inodes:
+            raise FirmwareError('Not enough free inodes in the ext2 file system: {:d} needed, {:d} available'.format(len(files) - 1, self.inodes_count - reserved_inodes))
+        numbers = set(range(1, self.first_inode))
+        files[0].number = EXT2_ROOT_INODE
+        for file in files[1:]:
+            if file.original is not None and file.original.number >= self.first_inode and file.original.number not in numbers:
+                file.number = file.original.number
+                numbers.add(file.number)
+        next_number = self.first_inode
+        for file in files:
+            while file.number is None:
+                if next_number not in numbers:
+                    file.number = next_number
+                    numbers.add(file.number)
+                next_number += 1
+
+        # Blocks in use that no inode owns are the file system metadata: superblocks, group descriptors, bitmaps and
+        # inode tables. The reserved inodes are kept as they are
+        used = bytearray(self.blocks_count)
+        original_numbers = []
+        for group in range(0, self.group_count):
+            block_bitmap, inode_bitmap = self.group_descriptors[group][:2]
+            first_block = self.first_data_block + group * self.blocks_per_group
+            used[first_block:first_block + self.blocks_per_group] = self.bitmap(block_bitmap, min(self.blocks_per_group, self.blocks_count - first_block))
+            original_numbers += [group * self.inodes_per_group + index + 1 for index, bit in enumerate(self.bitmap(inode_bitmap, self.inodes_per_group)) if bit]
+        used[:self.first_data_block] = b'\1' * self.first_data_block
+        for number in original_numbers:
+            if number >= self.first_inode or number == EXT2_ROOT_INODE:
+                inode = self.inode(number)
+                for block_number in itertools.chain(self.inode_blocks(inode), [inode.file_acl] if inode.file_acl else []):
+                    used[block_number] = 0
+        for file in files:
+            if file.keep:
+                for block_number in self.inode_blocks(file.original):
+                    used[block_number] = 1
+            if file.original is not None and file.original.file_acl:
+                used[file.original.file_acl] = 1
+
+        rewritten = [file for file in files if not file.keep]
+        for file in rewritten:
+            self.prepare_file(file)
+        needed_blocks = sum(file.needed for file in rewritten)
+        free_blocks = used.count(0)
+        if needed_blocks > free_blocks:
+            raise FirmwareError('Not enough free space in the ext2 file system: {:d} blocks needed, {:d} available'.format(needed_blocks, free_blocks))
+
+        # Rewritten files take their original blocks first, so files that don't grow stay where they were
+        for file in rewritten:
+            if file.original is not None:
+                for block_number in self.inode_blocks(file.original):
+                    if len(file.blocks) == file.needed:
+                        break
+                    if not used[block_number]:
+                        used[block_number] = 1
+                        file.blocks.append(block_number)
+        block_number = self.first_data_block
+        for file in rewritten:
+            while len(file.blocks) < file.needed:
+                block_number = used.find(0, block_number)
+                used[block_number] = 1
+                file.blocks.append(block_number)
+            if file.needed > 0:
+                file.block, file.indirect_blocks, file.data_blocks = self.map_blocks(file.present, iter(file.blocks).__next__)
+
+        inodes = [(file.number, self.inode_content(file)) for file in files]
+        freed_numbers = [number for number in original_numbers if number not in numbers]
+        if len(freed_numbers) == 0 and \
+                all(file.keep or stat.S_ISDIR(file.mode) for file in files) and \
+                all(file.original is not None and [(name, child.number) for name, child in file.entries] == list(self.entries(file.original)) for file in files if stat.S_ISDIR(file.mode)) and \
+                all(content == self.view[self.inode_position(number):self.inode_position(number) + self.inode_size] for number, content in inodes):
+            return False
+
+        # Start from a copy of the original image and write only what changed over it
+        output_file = open(output, 'w+b')
+        output_file.write(self.view)
+        output_file.flush()
+        profile_bytes(len(self.view), len(self.view))
+        output_mm = mmap.mmap(output_file.fileno(), 0)
+        for file in rewritten:
+            if stat.S_ISREG(file.mode):
+                source_file = open(file.source, 'rb')
+                profile_bytes(len(file.data_blocks) * self.block_size, len(file.data_blocks) * self.block_size)
+                for logical, block_number in file.data_blocks:
+                    source_file.seek(logical * self.block_size)
+                    output_mm[block_number * self.block_size:(block_number + 1) * self.block_size] = source_file.read(self.block_size).ljust(self.block_size, b'\0')
+                source_file.close()
+            else:
+                for logical, block_number in file.data_blocks:
+                    output_mm[block_number * self.block_size:(block_number + 1) * self.block_size] = file.content[logical * self.block_size:(logical + 1) * self.block_size].ljust(self.block_size, b'\0')
+            for block_number, pointers in file.indirect_blocks.items():
+                output_mm[block_number * self.block_size:(block_number + 1) * self.block_size] = pointers.tobytes()
+        for number, content in inodes:
+            output_mm[self.inode_position(number):self.inode_position(number) + self.inode_size] = content
+        for number in freed_numbers:
+            output_mm[self.inode_position(number):self.inode_position(number) + self.inode_size] = bytes(self.inode_size)
+
+        # Bitmaps, group descriptors and superblock counters, the bits past the end of each bitmap are set
+        inodes_used = bytearray(self.inodes_count)
+        for number in numbers:
+            inodes_used[number - 1] = 1
+        directories = [(file.number - 1) // self.inodes_per_group for file in files if stat.S_ISDIR(file.mode)]
+        group_descriptors_position = (self.first_data_block + 1) * self.block_size
+        bitmap_size = self.block_size * 8
+        for group in range(0, self.group_count):
+            block_bitmap, inode_bitmap, inode_table = self.group_descriptors[group][:3]
+            first_block = self.first_data_block + group * self.blocks_per_group
+            group_blocks = used[first_block:first_block + self.blocks_per_group]
+            group_inodes = inodes_used[group * self.inodes_per_group:(group + 1) * self.inodes_per_group]
+            for number, bits in [(block_bitmap, group_blocks), (inode_bitmap, group_inodes)]:
+                bits = bits + b'\1' * (bitmap_size - len(bits))
+                output_mm[number * self.block_size:(number + 1) * self.block_size] = bytes(EXT2_BITMAP_VALUES[bytes(bits[i:i + 8])] for i in range(0, bitmap_size, 8))
+            EXT2_GROUP_DESCRIPTOR_COUNTS_STRUCT.pack_into(output_mm, group_descriptors_position + group * EXT2_GROUP_DESCRIPTOR_STRUCT.size,
+                                                          block_bitmap, inode_bitmap, inode_table,
+                                                          group_blocks.count(0), group_inodes.count(0), directories.count(group))
+        struct.pack_into('<I', output_mm, EXT2_SUPERBLOCK_FREE_BLOCKS_COUNT_POSITION, used.count(0))
+        struct.pack_into('<I', output_mm, EXT2_SUPERBLOCK_FREE_INODES_COUNT_POSITION, inodes_used.count(0))
+        output_mm.flush()
+        output_mm.close()
+        output_file.close()
+        return True
+
+
+class DtbNode:
+    # Device tree node with its properties as name and value pairs and its child nodes, both in order
+    def __init__(self, name, properties=None, children=None):
+        self.name = name
+        self.properties = properties if properties is not None else []
+        self.children = children if children is not None else []
+
+    def property(self, name):
+        for property_name, value in self.properties:
+            if property_name == name:
+                return value
+        return None
+
+    def set_property(self, name, value):
+        # Properties defined again replace the value in place like dtc does
+        for i, (property_name, old_value) in enumerate(self.properties):
+            if property_name == name:
+                self.properties[i] = (name, value)
+                return
+        self.properties.append((name, value))
+
+    def child(self, name):
+        # Nodes defined again are merged like dtc does
+        for child in self.children:
+            if child.name == name:
+                return child
+        child = DtbNode(name)
+        self.children.append(child)
+        return child
+
+
+class Dtb:
+    # Flattened device tree decoded into a tree of nodes, converted from and to DTS in process with the same output as
+    # dtc, so there is no need to have it installed
+    def __init__(self):
+        self.root = DtbNode('')
+        self.memory_reservations = []  # Address and size of each reserved memory region
+        self.boot_cpu = None  # Guessed from the /cpus node like dtc does when it's not read from a blob
+
+    def read(self, data):
+        (magic_number, total_size, structure_position, strings_position, memory_reservation_position, version,
+         last_compatible_version, self.boot_cpu, strings_size, structure_size) = DTB_HEADER_STRUCT.unpack_from(data, 0)
+        if magic_number.to_bytes(4, 'big') != DTB_MAGIC_NUMBER:
+            raise ValueError('Invalid DTB magic number')
+        if last_compatible_version > DTB_VERSION or version < DTB_LAST_COMPATIBLE_VERSION:
+            raise ValueError('Unsupported DTB version {:d}'.format(version))
+        if total_size > len(data):
+            raise ValueError('Truncated DTB, {:d} bytes of {:d}'.format(len(data), total_size))
+        if version < DTB_VERSION:
+            # The structure size is only in the header since version 17, its end is found walking it
+            structure_size = strings_position - structure_position if strings_position > structure_position else total_size - structure_position
+        strings = bytes(data[strings_position:strings_position + strings_size])
+
+        self.memory_reservations = []
+        for address, size in DTB_MEMORY_RESERVATION_STRUCT.iter_unpack(data[memory_reservation_position:structure_position if structure_position > memory_reservation_position else total_size]):
+            if address == 0 and size == 0:
+                break
+            self.memory_reservations.append((address, size))
+
+        structure = bytes(data[structure_position:structure_position + structure_size])
+        position = 0
+        parents = []
+        node = None
+        root = None
+        while True:
+            if position + DTB_TOKEN_STRUCT.size > len(structure):
+                raise ValueError('DTB structure block without end')
+            token, = DTB_TOKEN_STRUCT.unpack_from(structure, position)
+            position += DTB_TOKEN_STRUCT.size
+            if token == DTB_BEGIN_NODE:
+                name_end = structure.find(b'\0', position)
+                if name_end < 0:
+                    raise ValueError('DTB node name without end')
+                child = DtbNode(structure[position:name_end].decode('utf-8'))
+                if node is None:
+                    if root is not None:
+                        raise ValueError('DTB with more than one root node')
+                    root = child
+                else:
+                    node.children.append(child)
+                    parents.append(node)
+                node = child
+                position = name_end + 1 + (-(name_end + 1) % DTB_TOKEN_STRUCT.size)
+            elif token == DTB_PROP:
+                if node is None:
+                    raise ValueError('DTB property outside of a node')
+                length, name_position = DTB_PROP_STRUCT.unpack_from(structure, position)
+                position += DTB_PROP_STRUCT.size
+                name_end = strings.find(b'\0', name_position)
+                if name_end < 0 or position + length > len(structure):
+                    raise ValueError('Invalid DTB property')
+                node.properties.append((strings[name_position:name_end].decode('utf-8'), structure[position:position + length]))
+                position += length + (-length % DTB_TOKEN_STRUCT.size)
+            elif token == DTB_END_NODE:
+                if node is None:
+                    raise ValueError('DTB node end without node')
+                node = parents.pop() if len(parents) > 0 else None
+            elif token == DTB_END:
+                if node is not None or root is None:
+                    raise ValueError('DTB nodes without end')
+                break
+            elif token != DTB_NOP:
+                raise ValueError('Invalid DTB token 0x{:08x}'.format(token))
+        self.root = root
+        return self
+
+    def guess_boot_cpu(self):
+        # The reg of the first cpu like dtc does when it compiles a DTS
+        for cpus in self.root.children:
+            if cpus.name == 'cpus' and len(cpus.children) > 0:
+                reg = cpus.children[0].property('reg')
+                if reg is not None and len(reg) == DTB_TOKEN_STRUCT.size:
+                    return DTB_TOKEN_STRUCT.unpack(reg)[0]
+        return 0
+
+    def blob(self, size=0):
+        # Version 17 blob laid out like dtc does, padded with zeros up to size like dtc -S does
+        structure = bytearray()
+        strings = bytearray()
+
+        def add_node(node):
+            name = node.name.encode('utf-8') + b'\0'
+            structure.extend(DTB_TOKEN_STRUCT.pack(DTB_BEGIN_NODE) + name + bytes(-len(name) % DTB_TOKEN_STRUCT.size))
+            for property_name, value in node.properties:
+                # dtc reuses any string of the block the name is a suffix of
+                property_name = property_name.encode('utf-8') + b'\0'
+                name_position = strings.find(property_name)
+                if name_position < 0:
+                    name_position = len(strings)
+                    strings.extend(property_name)
+                structure.extend(DTB_TOKEN_STRUCT.pack(DTB_PROP) + DTB_PROP_STRUCT.pack(len(value), name_position) + value + bytes(-len(value) % DTB_TOKEN_STRUCT.size))
+            for child in node.children:
+                add_node(child)
+            structure.extend(DTB_TOKEN_STRUCT.pack(DTB_END_NODE))
+
+        add_node(self.root)
+        structure.extend(DTB_TOKEN_STRUCT.pack(DTB_END))
+        memory_reservations = b''.join(DTB_MEMORY_RESERVATION_STRUCT.pack(address, size) for address, size in self.memory_reservations + [(0, 0)])
+        memory_reservation_position = DTB_HEADER_STRUCT.size + (-DTB_HEADER_STRUCT.size % DTB_MEMORY_RESERVATION_ALIGNMENT)
+        structure_position = memory_reservation_position + len(memory_reservations)
+        strings_position = structure_position + len(structure)
+        total_size = max(size, strings_position + len(strings))
+        header = DTB_HEADER_STRUCT.pack(int.from_bytes(DTB_MAGIC_NUMBER, 'big'), total_size, structure_position, strings_position,
+                                        memory_reservation_position, DTB_VERSION, DTB_LAST_COMPATIBLE_VERSION,
+                                        self.boot_cpu if self.boot_cpu is not None else self.guess_boot_cpu(), len(strings), len(structure))
+        dtb = header.ljust(memory_reservation_position, b'\0') + memory_reservations + structure + strings
+        return dtb.ljust(total_size, b'\0')
+
+    def format_value(self, value):
+        # Strings, cells or bytes guessed the same way dtc does
+        printable = all(0x20 <= c < 0x7F or 7 <= c <= 13 or c == 0 for c in value)
+        nul_count = value.count(0)
+        if value[-1] == 0 and printable and nul_count <= len(value) - nul_count:
+            escapes = {c: '\\' + escape for escape, c in DTS_STRING_ESCAPES.items() if escape != "'"}
+            return ', '.join('"' + ''.join(escapes.get(c, chr(c)) for c in string) + '"' for string in value[:-1].split(b'\0'))
+        elif len(value) % DTB_TOKEN_STRUCT.size == 0:
+            return '<' + ' '.join('0x{:02x}'.format(cell) for cell, in DTB_TOKEN_STRUCT.iter_unpack(value)) + '>'
+        else:
+            return '[' + ' '.join('{:02x}'.format(c) for c in value) + ']'
+
+    def source(self):
+        # DTS written the way dtc -O dts does
+        lines = ['/dts-v1/;', '']
+        for address, size in self.memory_reservations:
+            lines.append('/memreserve/\t0x{:016x} 0x{:016x};'.format(address, size))
+
+        def add_node(node, depth):
+            indent = '\t' * depth
+            lines.append(indent + (node.name if depth > 0 else '/') + ' {')
+            for property_name, value in node.properties:
+                lines.append(indent + '\t' + property_name + (' = ' + self.format_value(value) if len(value) > 0 else '') + ';')
+            for child in node.children:
+                lines.append('')
+                add_node(child, depth + 1)
+            lines.append(indent + '};')
+
+        add_node(self.root, 0)
+        return '\n'.join(lines) + '\n'
+
+    def parse_integer(self, text):
+        # C integer literals like dtc reads them, a leading 0 is octal
+        if len(text) > 1 and text[0] == '0' and text[1] not in 'xX':
+            return int(text, 8)
+        return int(text, 0)
+
+    def parse_string(self, text):
+        value = bytearray()
+        position = 0
+        while position < len(text):
+            c = text[position]
+            position += 1
+            if c != '\\':
+                value.extend(c.encode('utf-8'))
+            elif text[position] in DTS_STRING_ESCAPES:
+                value.append(DTS_STRING_ESCAPES[text[position]])
+                position += 1
+            elif text[position] == 'x':
+                digits = re.match(r'[0-9A-Fa-f]{1,2}', text[position + 1:]).group()
+                value.append(int(digits, 16))
+                position += 1 + len(digits)
+            else:
+                digits = re.match(r'[0-7]{1,3}', text[position:])
+                if digits is None:
+                    raise ValueError('Invalid escape \\{} in DTS string'.format(text[position]))
+                value.append(int(digits.group(), 8) & 0xFF)
+                position += len(digits.group())
+        return bytes(value) + b'\0'
+
+    def read_source(self, text):
+        # Parse the DTS subset written by dtc -O dts: memory reservations, nodes and properties with strings, cells
+        # and bytes values. Labels, references and expressions are not supported
+        tokens = []
+        position = 0
+        while position < len(text):
+            match = DTS_TOKEN.match(text, position)
+            if match is None:
+                raise ValueError('Unsupported DTS syntax at line {:d}'.format(text.count('\n', 0, position) + 1))
+            if match.lastgroup != 'skip':
+                tokens.append((match.lastgroup, match.group(), text.count('\n', 0, position) + 1))
+            position = match.end()
+        tokens.append(('end', '', text.count('\n') + 1))
+        index = 0
+
+        def next_token(expected=None):
+            nonlocal index
+            kind, value, line = tokens[index]
+            if expected is not None and value != expected:
+                raise ValueError('Expected {} at line {:d} but found {}'.format(expected, line, value or 'the end'))
+            index += 1
+            return kind, value, line
+
+        def parse_value():
+            kind, value, line = next_token()
+            try:
+                if kind == 'string':
+                    return self.parse_string(value[1:-1])
+                elif kind == 'cells':
+                    return b''.join(DTB_TOKEN_STRUCT.pack(self.parse_integer(cell)) for cell in value[1:-1].split())
+                elif kind == 'bytes':
+                    return bytes.fromhex(value[1:-1])
+            except (ValueError, IndexError, AttributeError, struct.error):
+                pass
+            raise ValueError('Unsupported DTS value {} at line {:d}'.format(value, line))
+
+        def parse_node(node):
+            while tokens[index][1] != '}':
+                kind, name, line = next_token()
+                if kind != 'word':
+                    raise ValueError('Expected a node or property name at line {:d} but found {}'.format(line, name or 'the end'))
+                if tokens[index][1] == '{':
+                    next_token('{')
+                    parse_node(node.child(name))
+                    continue
+                value = b''
+                if tokens[index][1] == '=':
+                    next_token('=')
+                    value = parse_value()
+                    while tokens[index][1] == ',':
+                        next_token(',')
+                        value += parse_value()
+                next_token(';')
+                node.set_property(name, value)
+            next_token('}')
+            next_token(';')
+
+        next_token('/dts-v1/')
+        next_token(';')
+        self.root = DtbNode('')
+        self.memory_reservations = []
+        self.boot_cpu = None
+        while tokens[index][1] == '/memreserve/':
+            next_token()
+            address = self.parse_integer(next_token()[1])
+            size = self.parse_integer(next_token()[1])
+            next_token(';')
+            self.memory_reservations.append((address, size))
+        while tokens[index][0] != 'end':
+            next_token('/')
+            next_token('{')
+            parse_node(self.root)
+        return self
+
+    @profiled('dtb.extract')
+    def extract(self, source, target):
+        # Convert a DTB file to DTS
+        self.read(Path(source).read_bytes())
+        replace_file(target)
+        write(target, self.source().encode('utf-8'))
+
+    @profiled('dtb.write')
+    def write(self, source, output):
+        # Convert a DTS file to a DTB padded to the size of the DTB it replaces
+        self.read_source(Path(source).read_text(encoding='utf-8'))
+        original_size = os.path.getsize(output) if os.path.exists(output) else 0
+        dtb = self.blob(original_size)
+        # The section keeps its size, a bigger DTB doesn't fit
+        if original_size > 0 and len(dtb) > original_size:
+            raise ValueError('DTB of {:d} bytes is bigger than the original {:d} bytes'.format(len(dtb), original_size))
+        replace_file(output)
+        write(output, dtb)
+
+
+class Blob:
+    # A known format found in the firmware, size is None when the format doesn't tell where it ends
+    def __init__(self, blob_type, start, size):
+        self.type = blob_type
+        self.start = start
+        self.size = size
+
+
+def scan_header(mm, start, end):
+    if read(mm, start + FIRMWARE_HEADER_ZEROS_POSITION, FIRMWARE_HEADER_ZEROS_SIZE).strip(b'\0') != b'':
+        raise ValueError('Firmware header without zeros')
+    return FIRMWARE_HEADER_SIZE
+
+
+def scan_section(mm, start, end):
+    # Section header, counted with the section after it
+    if read(mm, start + SECTION_HEADER_MAGIC_NUMBER_POSITION + SECTION_HEADER_MAGIC_NUMBER_SIZE, SECTION_HEADER_ZEROS_SIZE).strip(b'\0') != b'':
+        raise ValueError('Section header without zeros')
+    return SECTION_HEADER_SIZE + int.from_bytes(read(mm, start + SECTION_HEADER_LENGTH_POSITION, SECTION_HEADER_LENGTH_SIZE), 'little')
+
+
+def scan_rtos(mm, start, end):
+    return None
+
+
+def scan_romfs(mm, start, end):
+    # The files go from the end of the header to the end of the block of the last one
+    table = RomFs().read_table(mm[start:min(start + ROMFS_HEADER_SIZE, end)])
+    if table is None or len(table) == 0 or len(table) > ROMFS_MAX_FILE_COUNT or min(table.offsets) < ROMFS_HEADER_SIZE:
+        raise ValueError('Invalid ROMFS table')
+    size = max(offset + length + ROMFS_BLOCK_SIZE - length % ROMFS_BLOCK_SIZE for length, offset in zip(table.lengths, table.offsets))
+    if size > end - start:
+        raise ValueError('ROMFS bigger than the data')
+    return size
+
+
+def scan_kernel(mm, start, end):
+    # ARM64 Image, the image size is 0 in old kernels
+    code0, code1, text_offset, image_size, flags = KERNEL_HEADER_STRUCT.unpack(read(mm, start, KERNEL_HEADER_STRUCT.size))
+    return image_size if 0 < image_size <= end - start else None
+
+
+def scan_ext2(mm, start, end):
+    (inodes_count, blocks_count, r_blocks_count, free_blocks_count, free_inodes_count, first_data_block,
+     log_block_size, *fields) = EXT2_SUPERBLOCK_STRUCT.unpack(read(mm, start + EXT2_SUPERBLOCK_POSITION, EXT2_SUPERBLOCK_STRUCT.size))
+    if inodes_count == 0 or blocks_count == 0 or free_blocks_count > blocks_count or free_inodes_count > inodes_count or log_block_size > 6 or first_data_block > 1:
+        raise ValueError('Invalid ext2 superblock')
+    return blocks_count * (1024 << log_block_size)
+
+
+def scan_dtb(mm, start, end):
+    (magic_number, total_size, structure_position, strings_position, memory_reservation_position, version,
+     last_compatible_version, boot_cpu, strings_size, structure_size) = DTB_HEADER_STRUCT.unpack(read(mm, start, DTB_HEADER_STRUCT.size))
+    if last_compatible_version > DTB_VERSION or version < last_compatible_version or max(structure_position, strings_position, memory_reservation_position) > total_size:
+        raise ValueError('Invalid DTB header')
+    return total_size
+
+
+def scan_gzip(mm, start, end, chunk_size=HASH_CHUNK_SIZE):
+    # The end is only known once the stream is decompressed
+    if read(mm, start + len(GZIP_MAGIC_NUMBER), 1)[0] & 0xE0:
+        raise ValueError('Invalid gzip flags')
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    position = start
+    with memoryview(mm) as view:
+        while not decompressor.eof and position < end:
+            # The output is limited to a chunk at a time and thrown away, only where the stream ends matters
+            with view[position:min(position + chunk_size, end)] as chunk:
+                position += len(chunk)
+                decompressor.decompress(chunk, chunk_size)
+                while decompressor.unconsumed_tail and not decompressor.eof:
+                    decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    if not decompressor.eof:
+        raise ValueError('gzip stream without end')
+    return position - len(decompressor.unused_data) - start
+
+
+def scan_lz4(mm, start, end):
+    # The frame descriptor says which optional fields there are, and the blocks are skipped by their sizes
+    flags, block_descriptor = read(mm, start + len(LZ4_MAGIC_NUMBER), 2)
+    if flags >> 6 != 1 or flags & 0x02 or block_descriptor & 0x8F:
+        raise ValueError('Invalid LZ4 frame descriptor')
+    position = start + len(LZ4_MAGIC_NUMBER) + 2 + (8 if flags & 0x08 else 0) + (4 if flags & 0x01 else 0) + 1
+    while True:
+        if position + 4 > end:
+            raise ValueError('LZ4 frame without end')
+        block_size = int.from_bytes(read(mm, position, 4), 'little')
+        position += 4
+        if block_size == 0:
+            break
+        position += (block_size & ~LZ4_BLOCK_UNCOMPRESSED) + (4 if flags & 0x10 else 0)
+    position += 4 if flags & 0x04 else 0
+    if position > end:
+        raise ValueError('LZ4 frame bigger than the data')
+    return position - start
+
+
+def scan_elf(mm, start, end):
+    # The file ends with the section headers or with the last segment, whatever is further
+    identification = read(mm, start, ELF_IDENTIFICATION_SIZE)
+    elf_class, data, version = identification[4:7]
+    if elf_class not in ELF_HEADER_FORMATS or data not in (1, 2) or version != 1:
+        raise ValueError('Invalid ELF identification')
+    byte_order = '<' if data == 1 else '>'
+    header_struct = struct.Struct(byte_order + ELF_HEADER_FORMATS[elf_class])
+    (elf_type, machine, version, entry, program_headers_position, section_headers_position, flags, header_size,
+     program_header_size, program_headers_count, section_header_size, section_headers_count, section_names_index) = header_struct.unpack(read(mm, start + ELF_IDENTIFICATION_SIZE, header_struct.size))
+    if version != 1 or header_size != ELF_IDENTIFICATION_SIZE + header_struct.size:
+        raise ValueError('Invalid ELF header')
+    size = max(header_size, section_headers_position + section_header_size * section_headers_count)
+    program_header_struct = struct.Struct(byte_order + ELF_PROGRAM_HEADER_FORMATS[elf_class])
+    if program_headers_count > 0 and program_header_size < program_header_struct.size:
+        raise ValueError('Invalid ELF program header size')
+    for i in range(0, program_headers_count):
+        fields = program_header_struct.unpack(read(mm, start + program_headers_position + i * program_header_size, program_header_struct.size))
+        offset, file_size = (fields[1], fields[4]) if elf_class == 1 else (fields[2], fields[5])
+        size = max(size, offset + file_size, program_headers_position + (i + 1) * program_header_size)
+    if size > end - start:
+        raise ValueError('ELF bigger than the data')
+    return size
+
+
+def scan_uimage(mm, start, end):
+    header = bytearray(read(mm, start, UIMAGE_HEADER_STRUCT.size))
+    magic_number, header_crc32, time, data_size, *fields = UIMAGE_HEADER_STRUCT.unpack(header)
+    patch(header, len(UIMAGE_MAGIC_NUMBER), bytes(CRC32_SIZE))
+    if zlib.crc32(header) != header_crc32:
+        raise ValueError('Invalid uImage header CRC32')
+    return UIMAGE_HEADER_STRUCT.size + data_size
+
+
+def scan_squashfs(mm, start, end):
+    (magic_number, inodes, time, block_size, fragments, compression, block_log, flags, ids, major_version,
+     minor_version, root_inode, bytes_used) = SQUASHFS_SUPERBLOCK_STRUCT.unpack(read(mm, start, SQUASHFS_SUPERBLOCK_STRUCT.size))
+    if major_version != 4 or block_size != 1 << block_log or not 1 <= compression <= 6:
+        raise ValueError('Invalid squashfs superblock')
+    return bytes_used
+
+
+# Type, magic number, position of the magic number from the start and the function getting the size of every format
+# the scanner knows, the section types first in the order they are checked
+SCAN_SIGNATURES = [('RTOS', RTOS_MAGIC_NUMBER, RTOS_MAGIC_NUMBER_POSITION, scan_rtos),
+                   ('ROMFS', ROMFS_MAGIC_NUMBER, ROMFS_MAGIC_NUMBER_POSITION, scan_romfs),
+                   ('KERNEL', KERNEL_MAGIC_NUMBER, KERNEL_MAGIC_NUMBER_POSITION, scan_kernel),
+                   ('EXT2', EXT2_MAGIC_NUMBER, EXT2_MAGIC_NUMBER_POSITION, scan_ext2),
+                   ('DTB', DTB_MAGIC_NUMBER, DTB_MAGIC_NUMBER_POSITION, scan_dtb),
+                   ('HEADER', HEADER_MAGIC_NUMBER, FIRMWARE_HEADER_MAGIC_NUMBER_POSITION, scan_header),
+                   ('SECTION', SECTION_MAGIC_NUMBER, SECTION_HEADER_MAGIC_NUMBER_POSITION, scan_section),
+                   ('GZIP', GZIP_MAGIC_NUMBER, 0x00, scan_gzip),
+                   ('LZ4', LZ4_MAGIC_NUMBER, 0x00, scan_lz4),
+                   ('ELF', ELF_MAGIC_NUMBER, 0x00, scan_elf),
+                   ('UIMAGE', UIMAGE_MAGIC_NUMBER, 0x00, scan_uimage),
+                   ('SQUASHFS', SQUASHFS_MAGIC_NUMBER, 0x00, scan_squashfs)]
+SCAN_MAGIC_NUMBERS = {}  # Signatures by magic number
+for scan_signature in SCAN_SIGNATURES:
+    SCAN_MAGIC_NUMBERS.setdefault(scan_signature[1], []).append(scan_signature)
+SCAN_PATTERN = re.compile(b'|'.join(re.escape(magic_number) for magic_number in SCAN_MAGIC_NUMBERS))
+
+
+def scan_blob(mm, start, end, signature):
+    # The blob of a signature starting at start, or None if the magic number is not there or the rest doesn't match
+    blob_type, magic_number, position, size_function = signature
+    if start < 0 or not has_magic_number(mm, start, end - start, magic_number, position):
+        return None
+    try:
+        return Blob(blob_type, start, size_function(mm, start, end))
+    except (ValueError, IndexError, struct.error, zlib.error):
+        return None
+
+
+def identify(mm, start, end, types=SECTION_TYPES):
+    # Type of what starts at start from its magic number alone, the signatures of the given types are checked in order
+    for blob_type, magic_number, position, size_function in SCAN_SIGNATURES:
+        if blob_type in types and has_magic_number(mm, start, end - start, magic_number, position):
+            return blob_type
+    return 'UNKNOWN'
+
+
+def scan(mm, start=0, end=None, chunk_size=SCAN_CHUNK_SIZE, progress=None):
+    # Every known format between start and end in a single pass: the magic numbers are alternatives of one regular
+    # expression, so each byte is only looked at once by the C matcher instead of once per magic number. The
+    # candidates are checked afterwards, in order
+    end = len(mm) if end is None else end
+    overlap = max(len(magic_number) for blob_type, magic_number, position, size_function in SCAN_SIGNATURES) - 1
+    candidates = []
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        # Magic numbers starting at the end of the chunk are found in this one, they can't be found in the next
+        for match in SCAN_PATTERN.finditer(mm, chunk_start, min(chunk_end + overlap, end)):
+            if match.start() >= chunk_end:
+                break
+            for signature in SCAN_MAGIC_NUMBERS[match.group()]:
+                candidates.append((match.start() - signature[2], signature))
+        profile_bytes(chunk_end - chunk_start)
+        if progress is not None:
+            progress(chunk_end - start, end - start)
+    blobs = []
+    for blob_start, signature in sorted(candidates, key=lambda candidate: candidate[0]):
+        if blob_start >= start:
+            blob = scan_blob(mm, blob_start, end, signature)
+            if blob is not None:
+                blobs.append(blob)
+    return blobs
+
+
+class Manifest:
+    # Size, modification time, CRC32 and MD5 of the unpacked files and the inputs each section is generated from,
+    # so pack only regenerates and hashes what has changed since the last unpack or pack
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.files = {}
+        self.sections = {}
+        self.layout = {}  # Type of every section file, as found by the scan when unpacking
+
+    def load(self):
+        try:
+            manifest_file = open(self.folder / MANIFEST_FILENAME, 'r')
+            manifest = json.load(manifest_file)
+            manifest_file.close()
+        except (OSError, ValueError):
+            return self
+        if manifest.get('version') == MANIFEST_VERSION:
+            self.files = manifest.get('files', {})
+            self.sections = manifest.get('sections', {})
+            self.layout = manifest.get('layout', {})
+        return self
+
+    def save(self):
+        manifest_file = open(self.folder / MANIFEST_FILENAME, 'w')
+        json.dump({'version': MANIFEST_VERSION, 'files': self.files, 'sections': self.sections, 'layout': self.layout}, manifest_file, indent=1, sort_keys=True)
+        manifest_file.close()
+
+    def record(self, file_name, crc32=None, md5=None, object_id=None):
+        file_stat = os.stat(self.folder / file_name)
+        if crc32 is None:
+            crc32 = Crc32()
+            stream_file(self.folder / file_name, hashers=[crc32])
+            crc32 = crc32.value
+        self.files[file_name] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'crc32': crc32, 'md5': md5.hex() if md5 is not None else None}
+        if object_id is not None:
+            self.files[file_name]['object'] = object_id
+
+    def record_section(self, section_name, inputs):
+        self.sections[section_name] = {'inputs': list(inputs)}
+
+    def is_unchanged(self, file_name):
+        entry = self.files.get(file_name)
+        try:
+            file_stat = os.stat(self.folder / file_name)
+        except OSError:
+            return False
+        if entry is None or entry['size'] != file_stat.st_size:
+            return False
+        if entry['mtime'] == file_stat.st_mtime_ns:
+            return True
+        # Same size but touched, compare the content
+        crc32 = Crc32()
+        stream_file(self.folder / file_name, hashers=[crc32])
+        if crc32.value != entry['crc32']:
+            return False
+        entry['mtime'] = file_stat.st_mtime_ns
+        return True
+
+    def changed_files(self, inputs):
+        return [file_name for file_name in inputs if not self.is_unchanged(file_name)]
+
+    def has_section(self, section_name, inputs):
+        entry = self.sections.get(section_name)
+        return entry is not None and entry['inputs'] == list(inputs)
+
+    def crc32(self, file_name):
+        return self.files[file_name]['crc32']
+
+    def md5(self, file_name):
+        md5 = self.files[file_name]['md5']
+        return bytes.fromhex(md5) if md5 is not None else None
+
+    def restore(self, store):
+        # Link the files missing from the folder back from the store they were unpacked to
+        for file_name, entry in self.files.items():
+            if not os.path.lexists(self.folder / file_name) and store.has(entry.get('object')):
+                (self.folder / file_name).parent.mkdir(parents=True, exist_ok=True)
+                store.link(entry['object'], self.folder / file_name)
+                # The link has its own modification time
+                self.files[file_name]['mtime'] = os.stat(self.folder / file_name).st_mtime_ns
+
+
+class Store:
+    # Content addressed store shared by several unpacked firmware folders. Every unpacked file is stored once by its
+    # SHA-256 and the folders get links to it, so the files that don't change between firmware versions take no more
+    # space and are written only once
+    def __init__(self, path):
+        self.path = Path(path)
+        (self.path / STORE_OBJECTS_FOLDER).mkdir(parents=True, exist_ok=True)
+        self.can_clone = True
+
+    def object_path(self, object_id):
+        return self.path / STORE_OBJECTS_FOLDER / object_id[:2] / object_id[2:]
+
+    def has(self, object_id):
+        return object_id is not None and self.object_path(object_id).exists()
+
+    def add(self, content, write_object=None):
+        # Store some content if it's not already there and return its id. write_object(path) writes the content
+        # instead of a plain write when it can be done better, like leaving holes
+        object_id = hashlib.sha256(content).hexdigest()
+        object_path = self.object_path(object_id)
+        if not object_path.exists():
+            object_path.parent.mkdir(exist_ok=True)
+            # Written aside and renamed so an interrupted unpack never leaves a truncated object
+            temporary_path = object_path.with_name(object_path.name + '.' + str(os.getpid()))
+            if write_object is None:
+                write(temporary_path, content)
+            else:
+                write_object(temporary_path)
+            os.chmod(temporary_path, STORE_OBJECT_MODE)
+            os.replace(temporary_path, object_path)
+        return object_id
+
+    def link(self, object_id, target):
+        # A copy on write clone where the file system supports it, a read only hard link otherwise, or a plain copy
+        # when the store is in another file system
+        object_path = self.object_path(object_id)
+        replace_file(target)
+        if self.can_clone:
+            if clone_file(object_path, target):
+                return
+            self.can_clone = False
+        try:
+            os.link(object_path, target)
+        except OSError:
+            shutil.copyfile(object_path, target)
+
+    def add_range(self, mm, start, length, target):
+        # Store part of the firmware read in place from the mmap and link it to the target file
+        with memoryview(mm)[start:min(start + length, len(mm))] as content:
+            object_id = self.add(content, lambda path: copy_range(None, mm, start, length, path))
+        self.link(object_id, target)
+        return object_id
 
 
-class Firmware:
+class FirmwareError(Exception):
+    pass
+
+
+class OperationCancelled(FirmwareError):
+    pass
+
+
+class FirmwareField:
+    # Firmware attribute read from one of its parts, like the footer, which is decoded the first time any of its
+    # fields is used. Like functools.cached_property the value is cached in the instance and can be overwritten
+    def __init__(self, part, key):
+        self.part = part
+        self.key = key
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.part)[self.key]
+        instance.__dict__[self.name] = value
+        return value
+
+
+class Firmware(Observable):
+    # Nothing is read until it's used, so opening a firmware to get its version or its sizes only reads the footer
     firmware_path = None
     file_size = 0
     fw = None
     mm = None
-    firmware_header_name = ''
-    firmware_header_magic_number = None
-    firmware_header_crc32 = None
-    firmware_header_zeros = None
-    header_sections = None
-    sections = None
-    is_go2 = False
-    is_go3 = False
-    is_go3s = False
-    footer_size = 0
-    camera_firmware_middle_md5 = None
-    camera_firmware_size = 0
-    camera_firmware_filename = None
-    camera_firmware_version = None
-    camera_firmware_footer_md5 = None
-    camera_bluetooth_firmware_size = 0
-    camera_bluetooth_firmware_filename = None
-    camera_bluetooth_firmware_version = None
-    camera_bluetooth_firmware_footer_md5 = None
-    box_firmware_size = 0
-    box_firmware_filename = None
-    box_firmware_version = None
-    box_firmware_footer_md5 = None
-    box_bluetooth_firmware_size = 0
-    box_bluetooth_firmware_filename = None
-    box_bluetooth_firmware_version = None
-    box_bluetooth_firmware_footer_md5 = None
-    camera_bluetooth_app_firmware_size = 0
-    camera_bluetooth_app_firmware_filename = None
-    camera_bluetooth_app_firmware_version = None
-    camera_bluetooth_app_firmware_footer_md5 = None
-
-    def __init__(self, firmware_path):
+    firmware_header_name = FirmwareField('header', 'name')
+    firmware_header_magic_number = FirmwareField('header', 'magic_number')
+    firmware_header_crc32 = FirmwareField('header', 'crc32')
+    firmware_header_zeros = FirmwareField('header', 'zeros')
+    header_sections = FirmwareField('sections_table', 'header_sections')
+    sections = FirmwareField('sections_table', 'sections')
+    camera_firmware_size = FirmwareField('footer', 'camera_firmware_size')
+    camera_firmware_filename = FirmwareField('footer', 'camera_firmware_filename')
+    camera_firmware_version = FirmwareField('footer', 'camera_firmware_version')
+    camera_firmware_footer_md5 = FirmwareField('footer', 'camera_firmware_footer_md5')
+    camera_bluetooth_firmware_size = FirmwareField('footer', 'camera_bluetooth_firmware_size')
+    camera_bluetooth_firmware_filename = FirmwareField('footer', 'camera_bluetooth_firmware_filename')
+    camera_bluetooth_firmware_version = FirmwareField('footer', 'camera_bluetooth_firmware_version')
+    camera_bluetooth_firmware_footer_md5 = FirmwareField('footer', 'camera_bluetooth_firmware_footer_md5')
+    box_firmware_size = FirmwareField('footer', 'box_firmware_size')
+    box_firmware_filename = FirmwareField('footer', 'box_firmware_filename')
+    box_firmware_version = FirmwareField('footer', 'box_firmware_version')
+    box_firmware_footer_md5 = FirmwareField('footer', 'box_firmware_footer_md5')
+    box_bluetooth_firmware_size = FirmwareField('footer', 'box_bluetooth_firmware_size')
+    box_bluetooth_firmware_filename = FirmwareField('footer', 'box_bluetooth_firmware_filename')
+    box_bluetooth_firmware_version = FirmwareField('footer', 'box_bluetooth_firmware_version')
+    box_bluetooth_firmware_footer_md5 = FirmwareField('footer', 'box_bluetooth_firmware_footer_md5')
+    camera_bluetooth_app_firmware_size = FirmwareField('footer', 'camera_bluetooth_app_firmware_size')
+    camera_bluetooth_app_firmware_filename = FirmwareField('footer', 'camera_bluetooth_app_firmware_filename')
+    camera_bluetooth_app_firmware_version = FirmwareField('footer', 'camera_bluetooth_app_firmware_version')
+    camera_bluetooth_app_firmware_footer_md5 = FirmwareField('footer', 'camera_bluetooth_app_firmware_footer_md5')
+
+    def __init__(self, firmware_path, mm=None):
+        # The firmware can also be given already read, like the parts kept from a streamed firmware
         self.firmware_path = firmware_path
-        if os.path.exists(firmware_path):
-            self.file_size = os.path.getsize(self.firmware_path)
-            self.fw = open(self.firmware_path, 'r+b')
-            self.mm = mmap.mmap(self.fw.fileno(), 0)
-            self.mm.seek(0)
-            self.sections = []
-            self.header_sections = []
-            self.get_insta360_go_version()
-            self.read_header()
-            self.read_footer()
-            self.read_middle_md5()
+        if mm is None and os.path.exists(firmware_path):
+            self.fw = open(self.firmware_path, 'rb')
+            mm = mmap.mmap(self.fw.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm is not None:
+            self.file_size = mm.size()
+            self.mm = mm
 
     def __del__(self):
         if self.fw is not None:
             self.fw.close()
 
-    def get_insta360_go_version(self):
-        # Is it an Insta360 GO 2 firmware?
-        footer_signature = read(self.mm, self.file_size - FIRMWARE_FOOTER_GO2_SIGNATURE_SIZE, FIRMWARE_FOOTER_GO2_SIGNATURE_SIZE)
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO2_SIGNATURE[:8]:
-            self.is_go2 = True
-            self.footer_size = FIRMWARE_FOOTER_GO2_SIZE
-        # Is it an Insta360 GO 3 firmware?
-        footer_signature = read(self.mm, self.file_size - FIRMWARE_FOOTER_GO3_SIGNATURE_SIZE, FIRMWARE_FOOTER_GO3_SIGNATURE_SIZE)
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO3_SIGNATURE[:8]:
-            self.is_go3 = True
-            self.footer_size = FIRMWARE_FOOTER_GO3_SIZE
-        # Is it an Insta360 GO 3S firmware?
-        footer_signature = read(self.mm, self.file_size - FIRMWARE_FOOTER_GO3S_SIGNATURE_SIZE, FIRMWARE_FOOTER_GO3S_SIGNATURE_SIZE)
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO3S_SIGNATURE[:8]:
-            self.is_go3s = True
-            self.footer_size = FIRMWARE_FOOTER_GO3S_SIZE
-        # Is it none?
-        if not self.is_go2 and not self.is_go3 and not self.is_go3s:
-            print('Only Insta360 GO 2, Insta360 GO 3 and Insta360 GO 3S cameras are supported')
-            sys.exit(1)
-
-    def read_header(self):
-        self.firmware_header_name = read(self.mm, FIRMWARE_HEADER_NAME_POSITION, FIRMWARE_HEADER_NAME_SIZE).decode('utf-8').rstrip('\0')
-        self.firmware_header_magic_number = read(self.mm, FIRMWARE_HEADER_MAGIC_NUMBER_POSITION, FIRMWARE_HEADER_MAGIC_NUMBER_SIZE)
-        self.firmware_header_crc32 = read(self.mm, FIRMWARE_HEADER_CRC32_POSITION, FIRMWARE_HEADER_CRC32_SIZE)
-        self.firmware_header_zeros = read(self.mm, FIRMWARE_HEADER_ZEROS_POSITION, FIRMWARE_HEADER_ZEROS_SIZE)
-        self.read_header_sections()
-
-    def read_header_sections(self):
+    @functools.cached_property
+    def footer_model(self):
+        # Model name and footer layout from the signature at the end of the firmware
+        signature = read(self.mm, max(0, self.file_size - FIRMWARE_FOOTER_SIGNATURE_SIZE), FIRMWARE_FOOTER_SIGNATURE_SIZE)
+        if signature[:8] not in FIRMWARE_FOOTER_MODELS:
+            raise FirmwareError('Only Insta360 GO 2, Insta360 GO 3 and Insta360 GO 3S cameras are supported')
+        return FIRMWARE_FOOTER_MODELS[signature[:8]]
+
+    @functools.cached_property
+    def is_go2(self):
+        return self.footer_model[0] == 'GO 2'
+
+    @functools.cached_property
+    def is_go3(self):
+        return self.footer_model[0] == 'GO 3'
+
+    @functools.cached_property
+    def is_go3s(self):
+        return self.footer_model[0] == 'GO 3S'
+
+    @functools.cached_property
+    def footer_size(self):
+        return self.footer_model[1].size
+
+    @functools.cached_property
+    def header(self):
+        fields = FIRMWARE_HEADER_STRUCT.unpack(read(self.mm, 0, FIRMWARE_HEADER_STRUCT.size))
+        return {'name': fields[0].decode('utf-8').rstrip('\0'),
+                'magic_number': fields[1],
+                'crc32': fields[2],
+                'zeros': fields[3],
+                'sections': [fields[4 + i * 2:6 + i * 2] for i in range(0, FIRMWARE_HEADER_SECTIONS_COUNT)]}
+
+    @functools.cached_property
+    def sections_table(self):
+        header_sections = []
+        sections = []
         start = FIRMWARE_HEADER_SIZE
         end = 0
-        for i in range(0, FIRMWARE_HEADER_SECTIONS_COUNT):
-            # Section length
-            section_length = read(self.mm,
-                                  FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + i * FIRMWARE_HEADER_SECTIONS_SIZE,
-                                  FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE)
-            # Section crc32
-            section_crc32 = read(self.mm,
-                                 FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + i * FIRMWARE_HEADER_SECTIONS_SIZE + FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE,
-                                 FIRMWARE_HEADER_SECTIONS_CRC32_SIZE)
+        for i, (section_length, section_crc32) in enumerate(self.header['sections']):
             # CRC32 has to be inverted to compare it later with running CRC32 (a running CRC32 uses the previous CRC32 as base value)
             section_crc32_inverse = 0xffffffff ^ int.from_bytes(section_crc32, 'big')
             section_crc32_inverse = section_crc32_inverse.to_bytes(FIRMWARE_HEADER_SECTIONS_CRC32_SIZE, 'little')
@@ -455,6 +2643,8 @@ class Firmware:
             # The section 5 has crc32 but no length, so we get it from the section's header itself
             if section_crc32 != b'\x00\x00\x00\x00' and section_length == b'\x00\x00\x00\x00':
                 offset = self.mm.find(SECTION_MAGIC_NUMBER, end)
+                if offset < 0:
+                    raise FirmwareError('Invalid length in firmware header for section {:d}'.format(i))
                 section_length = read(self.mm,
                                       offset - (SECTION_HEADER_CRC32_SIZE + SECTION_HEADER_VERSION_SIZE + SECTION_HEADER_DATE_SIZE),
                                       SECTION_HEADER_LENGTH_SIZE)
@@ -462,58 +2652,44 @@ class Firmware:
                 section_length = section_length.to_bytes(SECTION_HEADER_LENGTH_SIZE, 'little')
 
             end = start + int.from_bytes(section_length, 'little')
+            # A length going past the end of the file would make the reads below fail
+            if section_length != b'\x00\x00\x00\x00' and (start + SECTION_HEADER_SIZE > self.file_size or end > self.file_size):
+                raise FirmwareError('Invalid length in firmware header for section {:d}'.format(i))
 
             # Store the section's data for later
             if section_crc32 != b'\x00\x00\x00\x00' and section_length != b'\x00\x00\x00\x00':
-                header_section = HeaderSection(start, end, section_length, section_crc32, section_crc32_inverse)
-                self.header_sections.append(header_section)
+                header_sections.append(HeaderSection(start, end, section_length, section_crc32, section_crc32_inverse))
 
-            if section_length.hex() != '00000000':
+            if section_length != b'\x00\x00\x00\x00':
                 # Store section header
-                crc32 = read(self.mm, start + SECTION_HEADER_CRC32_POSITION, SECTION_HEADER_CRC32_SIZE)
-                version = read(self.mm, start + SECTION_HEADER_VERSION_POSITION, SECTION_HEADER_VERSION_SIZE)
-                date = read(self.mm, start + SECTION_HEADER_DATE_POSITION, SECTION_HEADER_DATE_SIZE)
-                length = read(self.mm, start + SECTION_HEADER_LENGTH_POSITION, SECTION_HEADER_LENGTH_SIZE)
-                loading_address = read(self.mm, start + SECTION_HEADER_LOADING_ADDRESS_POSITION, SECTION_HEADER_LOADING_ADDRESS_SIZE)
-                flags = read(self.mm, start + SECTION_HEADER_FLAGS_POSITION, SECTION_HEADER_FLAGS_SIZE)
-                magic_number = read(self.mm, start + SECTION_HEADER_MAGIC_NUMBER_POSITION, SECTION_HEADER_MAGIC_NUMBER_SIZE)
-                self.sections.append(Section(i, start + SECTION_HEADER_SIZE, end, crc32, version, date, length, loading_address, flags, magic_number))
+                section_header = read(self.mm, start, SECTION_HEADER_STRUCT.size)
+                crc32, version, date, length, loading_address, flags, magic_number = SECTION_HEADER_STRUCT.unpack(section_header)
+                sections.append(Section(i, start + SECTION_HEADER_SIZE, end, crc32, version, date, length, loading_address, flags, magic_number))
 
             start = end
-
-    def read_middle_md5(self):
+        return {'header_sections': header_sections, 'sections': sections}
+
+    @functools.cached_property
+    def footer(self):
+        # Every firmware described in the footer, the ones the model doesn't have are left empty
+        if self.file_size < self.footer_size:
+            raise FirmwareError('Invalid file size')
+        fields = self.footer_model[1].unpack(read(self.mm, self.file_size - self.footer_size, self.footer_size))
+        footer = {}
+        for i, name in enumerate(FIRMWARE_FOOTER_FIRMWARE_NAMES):
+            size, filename, version, md5 = fields[i * 4:i * 4 + 4] if i * 4 + 4 < len(fields) else (0, None, None, None)
+            footer[name + '_firmware_size'] = size
+            footer[name + '_firmware_filename'] = filename
+            footer[name + '_firmware_version'] = version
+            footer[name + '_firmware_footer_md5'] = md5
+        return footer
+
+    @functools.cached_property
+    def camera_firmware_middle_md5(self):
         # There is an MD5 hash of the camera firmware between the camera and the box firmware
-        self.camera_firmware_middle_md5 = read(self.mm, self.camera_firmware_size - MD5_SIZE, MD5_SIZE)
-        print(self.camera_firmware_middle_md5.hex())
-
-    def read_footer(self):
-        # Get camera and box firmware size from the footer
-        self.camera_firmware_size = int.from_bytes(
-            read(self.mm,
-                 self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_POSITION,
-                 FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_SIZE), 'little')
-        self.box_firmware_size = int.from_bytes(
-            read(self.mm,
-                 self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_POSITION,
-                 FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_SIZE), 'little')
-        self.camera_bluetooth_firmware_size = 0
-        self.box_bluetooth_firmware_size = 0
-        self.camera_bluetooth_app_firmware_size = 0
-        if self.is_go3 or self.is_go3s:
-            self.camera_bluetooth_firmware_size = int.from_bytes(
-                read(self.mm,
-                     self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_POSITION,
-                     FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_SIZE), 'little')
-            self.box_bluetooth_firmware_size = int.from_bytes(
-                read(self.mm,
-                     self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_POSITION,
-                     FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_SIZE), 'little')
-        if self.is_go3s:
-            self.camera_bluetooth_app_firmware_size = int.from_bytes(
-                read(self.mm,
-                     self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_POSITION,
-                     FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_SIZE), 'little')
+        return read(self.mm, self.camera_firmware_size - MD5_SIZE, MD5_SIZE)
 
+    def print_info(self):
         print('Camera firmware size: ' + str(self.camera_firmware_size))
         print('Box firmware size: ' + str(self.box_firmware_size))
         if self.is_go3 or self.is_go3s:
@@ -523,89 +2699,71 @@ class Firmware:
             print('Camera Bluetooth App firmware size: ' + str(self.camera_bluetooth_app_firmware_size))
         print('Footer size: ' + str(self.footer_size))
         print('Total size: ' + str(self.camera_firmware_size + self.box_firmware_size + self.camera_bluetooth_firmware_size + self.box_bluetooth_firmware_size + self.footer_size))
+        for name in FIRMWARE_FOOTER_FIRMWARE_NAMES:
+            if getattr(self, name + '_firmware_filename') is not None:
+                print(getattr(self, name + '_firmware_filename').decode('utf-8').rstrip('\0'))
+                print(getattr(self, name + '_firmware_version').decode('utf-8').rstrip('\0'))
+                print(getattr(self, name + '_firmware_footer_md5').hex())
+        print(self.camera_firmware_middle_md5.hex())
 
-        self.camera_firmware_filename = read(self.mm,
-                                             self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_FILE_NAME_POSITION,
-                                             FIRMWARE_FOOTER_CAMERA_FILE_NAME_SIZE)
-        print(self.camera_firmware_filename.decode('utf-8').rstrip('\0'))
-        self.camera_firmware_version = read(self.mm,
-                                            self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_VERSION_POSITION,
-                                            FIRMWARE_FOOTER_CAMERA_VERSION_SIZE)
-        print(self.camera_firmware_version.decode('utf-8').rstrip('\0'))
-        self.camera_firmware_footer_md5 = read(self.mm,
-                                               self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_MD5_POSITION,
-                                               FIRMWARE_FOOTER_CAMERA_MD5_SIZE)
-        print(self.camera_firmware_footer_md5.hex())
-
-        self.box_firmware_filename = read(self.mm,
-                                          self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_FILE_NAME_POSITION,
-                                          FIRMWARE_FOOTER_BOX_FILE_NAME_SIZE)
-        print(self.box_firmware_filename.decode('utf-8').rstrip('\0'))
-        self.box_firmware_version = read(self.mm,
-                                         self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_VERSION_POSITION,
-                                         FIRMWARE_FOOTER_BOX_VERSION_SIZE)
-        print(self.box_firmware_version.decode('utf-8').rstrip('\0'))
-        self.box_firmware_footer_md5 = read(self.mm,
-                                            self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_MD5_POSITION,
-                                            FIRMWARE_FOOTER_BOX_MD5_SIZE)
-        print(self.box_firmware_footer_md5.hex())
-
-        if self.is_go3 or self.is_go3s:
-            self.camera_bluetooth_firmware_filename = read(self.mm,
-                                                 self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FILE_NAME_POSITION,
-                                                 FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FILE_NAME_SIZE)
-            print(self.camera_bluetooth_firmware_filename.decode('utf-8').rstrip('\0'))
-            self.camera_bluetooth_firmware_version = read(self.mm,
-                                                self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_VERSION_POSITION,
-                                                FIRMWARE_FOOTER_CAMERA_BLUETOOTH_VERSION_SIZE)
-            print(self.camera_bluetooth_firmware_version.decode('utf-8').rstrip('\0'))
-            self.camera_bluetooth_firmware_footer_md5 = read(self.mm,
-                                                   self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_MD5_POSITION,
-                                                   FIRMWARE_FOOTER_CAMERA_BLUETOOTH_MD5_SIZE)
-            print(self.camera_bluetooth_firmware_footer_md5.hex())
-
-            self.box_bluetooth_firmware_filename = read(self.mm,
-                                              self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_BLUETOOTH_FILE_NAME_POSITION,
-                                              FIRMWARE_FOOTER_BOX_BLUETOOTH_FILE_NAME_SIZE)
-            print(self.box_bluetooth_firmware_filename.decode('utf-8').rstrip('\0'))
-            self.box_bluetooth_firmware_version = read(self.mm,
-                                             self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_BLUETOOTH_VERSION_POSITION,
-                                             FIRMWARE_FOOTER_BOX_BLUETOOTH_VERSION_SIZE)
-            print(self.box_bluetooth_firmware_version.decode('utf-8').rstrip('\0'))
-            self.box_bluetooth_firmware_footer_md5 = read(self.mm,
-                                                self.file_size - self.footer_size + FIRMWARE_FOOTER_BOX_BLUETOOTH_MD5_POSITION,
-                                                FIRMWARE_FOOTER_BOX_BLUETOOTH_MD5_SIZE)
-            print(self.box_bluetooth_firmware_footer_md5.hex())
-
-        if self.is_go3s:
-            self.camera_bluetooth_app_firmware_filename = read(self.mm,
-                                                 self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FILE_NAME_POSITION,
-                                                 FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FILE_NAME_SIZE)
-            print(self.camera_bluetooth_app_firmware_filename.decode('utf-8').rstrip('\0'))
-            self.camera_bluetooth_app_firmware_version = read(self.mm,
-                                                self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_VERSION_POSITION,
-                                                FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_VERSION_SIZE)
-            print(self.camera_bluetooth_app_firmware_version.decode('utf-8').rstrip('\0'))
-            self.camera_bluetooth_app_firmware_footer_md5 = read(self.mm,
-                                                   self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_MD5_POSITION,
-                                                   FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_MD5_SIZE)
-            print(self.camera_bluetooth_app_firmware_footer_md5.hex())
-
-    def validate(self):
-        sections_running_crc32 = bytes(0x0)
+    def validation_ranges(self):
+        # The CRC32 and MD5 values checked by validate, by name, with the ranges of the firmware they are calculated from
+        camera_crc32_end = max(FIRMWARE_HEADER_SIZE, self.camera_firmware_size - MD5_SIZE)
+        running_crc32_end = max([camera_crc32_end] + [header_section.end for header_section in self.header_sections])
+        # A running CRC32 uses the previous CRC32 as base value, so it's the CRC32 from the first section up to the end of each section
+        running_crc32 = HashRange(FIRMWARE_HEADER_SIZE,
+                                  running_crc32_end,
+                                  Crc32(),
+                                  [header_section.end for header_section in self.header_sections] + [camera_crc32_end])
+        # The camera firmware internal MD5 is the camera firmware MD5 without the internal MD5 itself
+        camera_md5 = HashRange(0x0, self.camera_firmware_size, hashlib.md5(), [camera_crc32_end])
+        sections_crc32 = {}
+        for i in range(0, len(self.header_sections)):
+            if self.header_sections[i].length.hex() != '00000000':
+                sections_crc32[i] = HashRange(self.header_sections[i].start + SECTION_HEADER_SIZE, self.header_sections[i].end, Crc32())
+        box_md5 = HashRange(self.camera_firmware_size, self.camera_firmware_size + self.box_firmware_size, hashlib.md5())
+        camera_bluetooth_start = self.camera_firmware_size + self.box_firmware_size
+        camera_bluetooth_md5 = HashRange(camera_bluetooth_start, camera_bluetooth_start + self.camera_bluetooth_firmware_size, hashlib.md5())
+        box_bluetooth_start = camera_bluetooth_start + self.camera_bluetooth_firmware_size
+        box_bluetooth_md5 = HashRange(box_bluetooth_start, box_bluetooth_start + self.box_bluetooth_firmware_size, hashlib.md5())
+        camera_bluetooth_app_start = box_bluetooth_start + self.box_bluetooth_firmware_size
+        camera_bluetooth_app_md5 = HashRange(camera_bluetooth_app_start, camera_bluetooth_app_start + self.camera_bluetooth_app_firmware_size, hashlib.md5())
+        return {'running_crc32': running_crc32,
+                'camera_md5': camera_md5,
+                'sections_crc32': sections_crc32,
+                'box_md5': box_md5,
+                'camera_bluetooth_md5': camera_bluetooth_md5,
+                'box_bluetooth_md5': box_bluetooth_md5,
+                'camera_bluetooth_app_md5': camera_bluetooth_app_md5}
+
+    @profiled('firmware.validate')
+    def validate(self, jobs=1):
+        # All the CRC32 and MD5 values are calculated in a single pass over the firmware or concurrently with several jobs
+        ranges = self.validation_ranges()
+        all_ranges = [ranges[name] for name in ranges if name != 'sections_crc32'] + list(ranges['sections_crc32'].values())
+        self.emit('start', 'validate')
+        with profile_span('hash', jobs=jobs):
+            if jobs > 1:
+                hash_ranges_parallel(self.mm, all_ranges, jobs, progress=self.progress('validate'))
+            else:
+                hash_ranges(self.mm, all_ranges, progress=self.progress('validate'))
+        self.emit('end', 'validate')
+        with profile_span('check'):
+            return self.check(ranges)
+
+    def check(self, ranges):
+        # Compare the calculated CRC32 and MD5 values with the ones in the firmware
+        self.print_info()
+        camera_crc32_end = max(FIRMWARE_HEADER_SIZE, self.camera_firmware_size - MD5_SIZE)
+        running_crc32 = ranges['running_crc32']
+        camera_md5 = ranges['camera_md5']
+        sections_crc32 = ranges['sections_crc32']
         for i in range(0, len(self.header_sections)):
             header_section = self.header_sections[i]
-            start = header_section.start
-            # end = header_section.end
             section_length = header_section.length
             section_crc32 = header_section.crc32
             section_crc32_inverse = header_section.crc32_inverse
-
-            # A running CRC32 uses the previous CRC32 as base value
-            sections_running_crc32 = calculate_crc32(self.mm,
-                                                     start,
-                                                     int.from_bytes(section_length, 'little'),
-                                                     int.from_bytes(sections_running_crc32, 'little'))
+            sections_running_crc32 = running_crc32.snapshots[header_section.end]
 
             if section_crc32.hex() != '00000000':
                 section_crc32_formatted = '0x{:08x}'.format(int.from_bytes(section_crc32, 'big'))
@@ -618,423 +2776,1611 @@ class Firmware:
                       ' - crc32 running: ' + section_running_crc32_formatted +
                       ' - length: ' + section_length_formatted + ' (' + str(int.from_bytes(section_length, 'little')) + ' bytes)')
                 if section_crc32_inverse_formatted != section_running_crc32_formatted:
-                    print('Invalid CRC32 in firmware header for section {:d}'.format(i))
-                    exit(1)
+                    raise FirmwareError('Invalid CRC32 in firmware header for section {:d}'.format(i))
 
-            if section_length.hex() != '00000000':
+            if i in sections_crc32:
                 # Check CRC32 for section content
                 crc32 = self.sections[i].crc32
-                calculated_crc32 = calculate_crc32(self.mm,
-                                                   start + SECTION_HEADER_SIZE,
-                                                   int.from_bytes(section_length, 'little') - SECTION_HEADER_SIZE)
+                calculated_crc32 = sections_crc32[i].digest()
                 if calculated_crc32 != crc32:
-                    print('Invalid CRC32 for content in section {:d}'.format(i))
-                    exit(1)
+                    raise FirmwareError('Invalid CRC32 for content in section {:d}'.format(i))
 
         # Check the sizes of the firmwares and the footer add up to the actual file size
         if self.camera_firmware_size + self.box_firmware_size + self.camera_bluetooth_firmware_size + self.box_bluetooth_firmware_size + self.camera_bluetooth_app_firmware_size + self.footer_size != self.file_size:
-            print('Invalid file size')
-            exit(1)
+            raise FirmwareError('Invalid file size')
 
         if self.firmware_header_name != '':
-            print('Invalid firmware header name')
-            exit(1)
+            raise FirmwareError('Invalid firmware header name')
 
         if self.firmware_header_magic_number != HEADER_MAGIC_NUMBER:
-            print('Invalid firmware header magic number')
-            exit(1)
+            raise FirmwareError('Invalid firmware header magic number')
 
         # Check the firmware header CRC32
         firmware_crc32 = read(self.mm, FIRMWARE_HEADER_CRC32_POSITION, FIRMWARE_HEADER_CRC32_SIZE)
         # print(firmware_crc32.hex())
         # Calculate the CRC32 from where the firmware header ends up to the end of the camera firmware (without the MD5 at the end)
-        firmware_crc32_calculated = calculate_crc32(self.mm,
-                                                    FIRMWARE_HEADER_SIZE,
-                                                    self.camera_firmware_size - FIRMWARE_HEADER_SIZE - MD5_SIZE)
+        firmware_crc32_calculated = running_crc32.snapshots[camera_crc32_end]
         # print(firmware_crc32_calculated.hex())
         if firmware_crc32.hex() != firmware_crc32_calculated.hex():
-            print('Invalid firmware header CRC32')
-            exit(1)
+            raise FirmwareError('Invalid firmware header CRC32')
 
         if self.firmware_header_zeros.decode('utf-8').rstrip('\0') != '':
-            print('Invalid firmware header zeros')
-            exit(1)
-
-        # Check that the firmware ends with an appropriate signature
-        if self.is_go2 is False and self.is_go3 is False and self.is_go3s is False:
-            print('Invalid footer signature')
-            exit(1)
+            raise FirmwareError('Invalid firmware header zeros')
 
         # Check the camera firmware internal MD5
-        camera_firmware_middle_md5_calculated = calculate_md5(self.mm, 0x0, self.camera_firmware_size - MD5_SIZE)
+        camera_firmware_middle_md5_calculated = camera_md5.snapshots[camera_crc32_end]
         if self.camera_firmware_middle_md5 != camera_firmware_middle_md5_calculated:
-            print('Invalid camera firmware internal MD5')
-            exit(1)
+            raise FirmwareError('Invalid camera firmware internal MD5')
 
         # Check the camera firmware MD5
-        camera_firmware_footer_md5_calculated = calculate_md5(self.mm, 0x0, self.camera_firmware_size)
+        camera_firmware_footer_md5_calculated = camera_md5.digest()
         if self.camera_firmware_footer_md5 != camera_firmware_footer_md5_calculated:
-            print('Invalid camera firmware MD5')
-            exit(1)
+            raise FirmwareError('Invalid camera firmware MD5')
 
         # Check the box firmware MD5
-        box_firmware_footer_md5_calculated = calculate_md5(self.mm, self.camera_firmware_size, self.box_firmware_size)
+        box_firmware_footer_md5_calculated = ranges['box_md5'].digest()
         if self.box_firmware_footer_md5 != box_firmware_footer_md5_calculated:
-            print('Invalid box firmware MD5')
-            exit(1)
+            raise FirmwareError('Invalid box firmware MD5')
 
         if self.is_go3 is True or self.is_go3s is True:
             # Check the camera bluetooth firmware MD5
-            camera_bluetooth_firmware_footer_md5_calculated = calculate_md5(self.mm, self.camera_firmware_size + self.box_firmware_size, self.camera_bluetooth_firmware_size)
+            camera_bluetooth_firmware_footer_md5_calculated = ranges['camera_bluetooth_md5'].digest()
             if self.camera_bluetooth_firmware_footer_md5 != camera_bluetooth_firmware_footer_md5_calculated:
-                print('Invalid camera bluetooth firmware MD5')
-                exit(1)
+                raise FirmwareError('Invalid camera bluetooth firmware MD5')
 
             # Check the box bluetooth firmware MD5
-            box_bluetooth_firmware_footer_md5_calculated = calculate_md5(self.mm, self.camera_firmware_size + self.box_firmware_size + self.camera_bluetooth_firmware_size, self.box_bluetooth_firmware_size)
+            box_bluetooth_firmware_footer_md5_calculated = ranges['box_bluetooth_md5'].digest()
             if self.box_bluetooth_firmware_footer_md5 != box_bluetooth_firmware_footer_md5_calculated:
-                print('Invalid box bluetooth firmware MD5')
-                exit(1)
+                raise FirmwareError('Invalid box bluetooth firmware MD5')
 
         if self.is_go3s is True:
             # Check the camera bluetooth app firmware MD5
-            camera_bluetooth_app_firmware_footer_md5_calculated = calculate_md5(self.mm, self.camera_firmware_size + self.box_firmware_size + self.camera_bluetooth_firmware_size + self.box_bluetooth_firmware_size, self.camera_bluetooth_app_firmware_size)
+            camera_bluetooth_app_firmware_footer_md5_calculated = ranges['camera_bluetooth_app_md5'].digest()
             if self.camera_bluetooth_app_firmware_footer_md5 != camera_bluetooth_app_firmware_footer_md5_calculated:
-                print('Invalid camera bluetooth app firmware MD5')
-                exit(1)
+                raise FirmwareError('Invalid camera bluetooth app firmware MD5')
         print('Firmware OK!')
 
         return 0
 
-    def unpack(self, folder):
+    @profiled('firmware.unpack')
+    def unpack(self, folder, extract_ext2=False, store=None):
         print('Unpacking...')
 
         folder = Path(folder)
         folder.mkdir()
+        manifest = Manifest(folder)
+        objects = {}
+        self.emit('start', 'unpack', total=self.file_size)
+
+        def export(start, length, file_name):
+            # Files go to the store if there is one and are linked from there
+            if store is not None:
+                objects[file_name] = store.add_range(self.mm, start, length, folder / file_name)
+            else:
+                copy_range(self.fw, self.mm, start, length, folder / file_name, progress=self.progress('unpack', file_name))
+
+        # The section types are found once and saved in the manifest for pack
+        layout = self.scan(blobs=False)
 
         # Sections from header
         for i in range(0, len(self.sections)):
-            print('Exporting section ' + str(i))
-            section_name = 'section_' + str(i)
-            section_bin_filename = section_name + '.bin'
-            section_header_filename = section_name + '.header'
-            content = read(self.mm, self.sections[i].start - SECTION_HEADER_SIZE, SECTION_HEADER_SIZE)
-            write(folder / section_header_filename, content)
-            content = read(self.mm, self.sections[i].start, int.from_bytes(self.sections[i].length, 'little'))
-            write(folder / section_bin_filename, content)
-            if content.startswith(ROMFS_MAGIC_NUMBER):
-                romfs = RomFs()
-                source = folder / section_bin_filename
-                target = folder / section_name
-                romfs.extract(source, target)
-            elif content.startswith(DTB_MAGIC_NUMBER):
-                print('Detected DTB section...')
-                # args = type('args', (object,), {'extract': True, 'filename': str(folder / section_bin_filename), 'output_dir': 'dtb'})()
-                # extract_dtb.split(args)
-                if shutil.which('dtc') is not None:
+            with profile_span('section_' + str(i)):
+                section_name = 'section_' + str(i)
+                section_bin_filename = section_name + '.bin'
+                section_header_filename = section_name + '.header'
+                start = self.sections[i].start
+                length = int.from_bytes(self.sections[i].length, 'little')
+                self.emit('start', 'unpack', section_name, total=length, description='Exporting section ' + str(i))
+                export(start - SECTION_HEADER_SIZE, SECTION_HEADER_SIZE, section_header_filename)
+                export(start, length, section_bin_filename)
+                section_type = layout['sections'][i]['type']
+                manifest.layout[section_bin_filename] = section_type
+                if section_type == 'ROMFS':
+                    romfs = self.observe(RomFs())
+                    source = folder / section_bin_filename
+                    target = folder / section_name
+                    extracted = romfs.extract(source, target, store)
+                    if len(extracted) > 0:
+                        section_files_filename = section_name + '.files'
+                        manifest.record(section_files_filename)
+                        for file_name, file_crc32, object_id in extracted:
+                            manifest.record(section_name + '/' + file_name, file_crc32, object_id=object_id)
+                        manifest.record_section(section_name, [section_files_filename] + [section_name + '/' + file_name for file_name, file_crc32, object_id in extracted])
+                elif section_type == 'DTB':
+                    print('Detected DTB section...')
+                    # args = type('args', (object,), {'extract': True, 'filename': str(folder / section_bin_filename), 'output_dir': 'dtb'})()
+                    # extract_dtb.split(args)
                     print('Unpacking dtb...')
                     section_dts_filename = section_name + '.dts'
-                    os.system('dtc -q -I dtb -O dts -o - "' + str(folder / section_bin_filename) + '" > "' + str(folder / section_dts_filename) + '"')
+                    try:
+                        Dtb().extract(folder / section_bin_filename, folder / section_dts_filename)
+                    except (ValueError, struct.error) as e:
+                        print('Invalid DTB ({}), skipping...'.format(e))
+                    else:
+                        manifest.record(section_dts_filename)
+                        manifest.record_section(section_name, [section_dts_filename])
+                elif section_type == 'EXT2':
+                    print('Detected Linux EXT2 filesystem section... ')
+                    if extract_ext2:
+                        # Extracted in process, no need to mount it so no root privileges are needed
+                        print('Extracting ext2...')
+                        section_ext2_folder_name = section_name + '.ext2'
+                        ext2 = Ext2(memoryview(self.mm)[start:start + length])
+                        ext2.extract(folder / section_ext2_folder_name)
+                        ext2.view.release()
+                self.emit('end', 'unpack', section_name, done=length, total=length)
+
+        with profile_span('firmwares'):
+            # Firmware header
+            export(0, FIRMWARE_HEADER_SIZE, 'firmware.header')
+
+            # Firmware footer
+            export(self.file_size - self.footer_size, self.footer_size, 'firmware.footer')
+
+            # Box and bluetooth firmwares
+            for file_name, start, size in self.firmwares():
+                self.emit('start', 'unpack', file_name, total=size)
+                export(start, size, file_name)
+                self.emit('end', 'unpack', file_name, done=size, total=size)
+
+        # Record the CRC32 of the sections and the MD5 of the other firmwares in the manifest for later packs
+        with profile_span('manifest'):
+            print('Writing manifest...')
+            sections_crc32 = [HashRange(section.start, section.start + int.from_bytes(section.length, 'little'), Crc32()) for section in self.sections]
+            firmwares_crc32 = [HashRange(start, start + size, Crc32()) for file_name, start, size in self.firmwares()]
+            firmwares_md5 = [HashRange(start, start + size, hashlib.md5()) for file_name, start, size in self.firmwares()]
+            hash_ranges(self.mm, sections_crc32 + firmwares_crc32 + firmwares_md5, progress=self.progress('unpack', MANIFEST_FILENAME))
+            for i in range(0, len(self.sections)):
+                manifest.record('section_' + str(i) + '.bin', sections_crc32[i].hasher.value, object_id=objects.get('section_' + str(i) + '.bin'))
+            for i, (file_name, start, size) in enumerate(self.firmwares()):
+                manifest.record(file_name, firmwares_crc32[i].hasher.value, firmwares_md5[i].digest(), objects.get(file_name))
+            # The headers and the footer are only recorded to be restored from the store
+            for file_name in objects:
+                if file_name not in manifest.files:
+                    manifest.record(file_name, object_id=objects[file_name])
+            manifest.save()
+        self.emit('end', 'unpack', done=self.file_size, total=self.file_size)
+
+    def romfs_sections(self):
+        # ROMFS sections by section name, read in place from the firmware
+        romfs_sections = {}
+        for i in range(0, len(self.sections)):
+            start = self.sections[i].start
+            length = int.from_bytes(self.sections[i].length, 'little')
+            if has_magic_number(self.mm, start, length, ROMFS_MAGIC_NUMBER, ROMFS_MAGIC_NUMBER_POSITION):
+                romfs_sections['section_' + str(i)] = RomFsSection(self.mm, start, length)
+        return romfs_sections
+
+    def ext2_sections(self):
+        # Ext2 file systems by section name, read in place from the firmware
+        ext2_sections = {}
+        for i in range(0, len(self.sections)):
+            start = self.sections[i].start
+            length = int.from_bytes(self.sections[i].length, 'little')
+            if has_magic_number(self.mm, start, length, EXT2_MAGIC_NUMBER, EXT2_MAGIC_NUMBER_POSITION):
+                ext2_sections['section_' + str(i)] = Ext2(memoryview(self.mm)[start:start + length])
+        return ext2_sections
+
+    def list_files(self):
+        for section_name, romfs_section in self.romfs_sections().items():
+            for file_name, file_length, file_offset, file_crc32 in romfs_section.table:
+                print('{}/{}\t{:d}\t0x{:08x}'.format(section_name, file_name, file_length, file_crc32))
+            romfs_section.close()
+        for section_name, ext2 in self.ext2_sections().items():
+            for file_path, inode in ext2.walk():
+                print('{}{}\t{:d}\t{}'.format(section_name, file_path, inode.size, stat.filemode(inode.mode)))
+            ext2.view.release()
+
+    def read_file(self, path, output=None):
+        # Write a ROMFS or ext2 file, named as it's unpacked (section_N/file_name), to the output file or to stdout
+        section_name, _, file_name = path.partition('/')
+        romfs_sections = self.romfs_sections()
+        ext2_sections = self.ext2_sections()
+        content = None
+        inode = None
+        if section_name in romfs_sections and file_name in romfs_sections[section_name].index:
+            content = romfs_sections[section_name].get(file_name, verify=True)
+            if content is not None:
+                if output is None:
+                    sys.stdout.buffer.write(content)
+                    sys.stdout.buffer.flush()
                 else:
-                    print('device-tree-compiler is not installed, skipping...')
-            elif content[EXT2_MAGIC_NUMBER_POSITION:EXT2_MAGIC_NUMBER_POSITION + len(EXT2_MAGIC_NUMBER)] == EXT2_MAGIC_NUMBER:
-                print('Detected Linux EXT2 filesystem section... ')
-                # if sys.platform == 'linux' or sys.platform == 'linux2':
-                #     print('Mounting...')
-                #     section_ext2_folder_name = section_name + '.ext2'
-                #     if (folder / section_ext2_folder_name).exists():
-                #         print(section_ext2_folder_name + ' folder already exists, mount skipped...')
-                #     else:
-                #         os.mkdir(folder / section_ext2_folder_name)
-                #         # os.system('sudo mount -o rw,loop ' + str(folder / section_bin_filename) + ' ' + str(folder /section_ext2_folder_name)
-                #         mount.mount(folder / section_bin_filename, folder / section_ext2_folder_name, 'ext2', 'rw')
-                # else:
-                #     print('Non Linux system detected, mount skipped...')
-
-        # Firmware header
-        firmware_header = read(self.mm, 0, FIRMWARE_HEADER_SIZE)
-        write(folder / 'firmware.header', firmware_header)
-
-        # Firmware footer
-        footer = read(self.mm, self.file_size - self.footer_size, self.footer_size)
-        write(folder / 'firmware.footer', footer)
-
-        # Box firmware
-        firmware_box = read(self.mm, self.camera_firmware_size, self.box_firmware_size)
-        write(folder / self.box_firmware_filename.decode("utf-8").rstrip('\0'), firmware_box)
+                    write(output, content)
+                content.release()
+        elif section_name in ext2_sections:
+            ext2 = ext2_sections[section_name]
+            inode = ext2.lookup(file_name)
+            if inode is not None and stat.S_ISREG(inode.mode):
+                if output is None:
+                    ext2.read(inode, sys.stdout.buffer)
+                    sys.stdout.buffer.flush()
+                else:
+                    output_file = open(output, 'wb')
+                    ext2.read(inode, output_file)
+                    output_file.close()
+            else:
+                print('File {} not found'.format(path), file=sys.stderr)
+                inode = None
+        else:
+            print('File {} not found'.format(path), file=sys.stderr)
+        for romfs_section in romfs_sections.values():
+            romfs_section.close()
+        for ext2 in ext2_sections.values():
+            ext2.view.release()
+        return 0 if content is not None or inode is not None else 1
+
+    @profiled('firmware.patch')
+    def patch_file(self, path, source, output):
+        # Replace a ROMFS file, named as it's unpacked (section_N/file_name), in a copy of the firmware when the new
+        # content fits in the blocks of the old one. Only the changed bytes are written: the ROMFS entry, the section
+        # header, the sections table and the camera firmware CRC32s are updated from the changes with crc32_combine,
+        # and the camera firmware MD5s need the only pass over the firmware
+        section_name, _, file_name = path.partition('/')
+        romfs_sections = self.romfs_sections()
+        if section_name not in romfs_sections or file_name not in romfs_sections[section_name].index:
+            for romfs_section in romfs_sections.values():
+                romfs_section.close()
+            raise FirmwareError('ROMFS file {} not found'.format(path))
+        table = romfs_sections[section_name].table
+        for romfs_section in romfs_sections.values():
+            romfs_section.close()
+        section = self.sections[int(section_name[len('section_'):])]
+        section_length = section.end - section.start
+        index = table.names.index(file_name)
+        file_offset = table.offsets[index]
+        # The file can grow up to where the next one starts
+        file_end = min([offset for offset in table.offsets if offset > file_offset] + [section_length])
+        content = Path(source).read_bytes()
+        if len(content) > file_end - file_offset:
+            raise FirmwareError('{} of {:d} bytes does not fit in the {:d} bytes of {}'.format(source, len(content), file_end - file_offset, path))
+
+        # Changed bytes of the copy as position, old and new bytes
+        self.emit('start', 'patch', description='Patching {}...'.format(path))
+        start = section.start + file_offset
+        changes = [(start, read(self.mm, start, file_end - file_offset), content + bytes(file_end - file_offset - len(content)))]
+        entry_position = section.start + ROMFS_FILECOUNT_POSITION + ROMFS_FILECOUNT_SIZE + index * ROMFS_FILE_ENTRY_SIZE
+        entry = read(self.mm, entry_position, ROMFS_FILE_ENTRY_SIZE)
+        changes.append((entry_position, entry, ROMFS_FILE_ENTRY_STRUCT.pack(entry[:ROMFS_FILE_FILENAME_SIZE], len(content), file_offset, zlib.crc32(content))))
+
+        # Section content CRC32 in the section header
+        section_crc32 = int.from_bytes(section.crc32, 'little')
+        for position, old, new in changes:
+            section_crc32 = crc32_replace(section_crc32, old, new, section.end - position - len(old))
+        section_crc32_position = section.start - SECTION_HEADER_SIZE + SECTION_HEADER_CRC32_POSITION
+        changes.append((section_crc32_position, section.crc32, section_crc32.to_bytes(SECTION_HEADER_CRC32_SIZE, 'little')))
+
+        # Running CRC32s of the sections table from the first section up to the end of each section, and the camera
+        # firmware CRC32 up to the end of the last one
+        header = bytearray(read(self.mm, 0, FIRMWARE_HEADER_SIZE))
+        header_sections = iter(self.header_sections)
+        for i, (length, crc32) in enumerate(self.header['sections']):
+            if crc32 == b'\x00\x00\x00\x00':
+                continue
+            end = next(header_sections).end
+            if end < section.end:
+                continue
+            running_crc32 = 0xffffffff ^ int.from_bytes(crc32, 'little')
+            for position, old, new in changes:
+                running_crc32 = crc32_replace(running_crc32, old, new, end - position - len(old))
+            patch(header, FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + i * FIRMWARE_HEADER_SECTIONS_SIZE + FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE,
+                  (0xffffffff ^ running_crc32).to_bytes(FIRMWARE_HEADER_SECTIONS_CRC32_SIZE, 'little'))
+        camera_crc32_end = self.camera_firmware_size - MD5_SIZE
+        camera_crc32 = int.from_bytes(self.firmware_header_crc32, 'little')
+        for position, old, new in changes:
+            camera_crc32 = crc32_replace(camera_crc32, old, new, camera_crc32_end - position - len(old))
+        patch(header, FIRMWARE_HEADER_CRC32_POSITION, camera_crc32.to_bytes(FIRMWARE_HEADER_CRC32_SIZE, 'little'))
+        changes.append((0, read(self.mm, 0, FIRMWARE_HEADER_SIZE), bytes(header)))
+
+        # Copy on write clone where the file system supports it, so only the changed blocks take space
+        with profile_span('copy'):
+            if not clone_file(self.firmware_path, output):
+                shutil.copyfile(self.firmware_path, output)
+        output_file = open(output, 'r+b')
+        output_mm = mmap.mmap(output_file.fileno(), 0)
+        for position, old, new in changes:
+            output_mm[position:position + len(new)] = new
+        profile_bytes(written=sum(len(new) for position, old, new in changes))
+
+        # The header changed, so the MD5s can't reuse anything and are calculated again from the start
+        with profile_span('md5'):
+            camera_md5 = HashRange(0, camera_crc32_end, hashlib.md5())
+            hash_ranges(output_mm, [camera_md5], progress=self.progress('patch', path))
+            middle_md5 = camera_md5.digest()
+            camera_md5.hasher.update(middle_md5)
+        output_mm[camera_crc32_end:camera_crc32_end + MD5_SIZE] = middle_md5
+        footer_md5_position = self.file_size - self.footer_size + FIRMWARE_FOOTER_CAMERA_MD5_POSITION
+        output_mm[footer_md5_position:footer_md5_position + MD5_SIZE] = camera_md5.digest()
+        output_mm.close()
+        output_file.close()
+        self.emit('end', 'patch')
+        print('Patched {} ({:d} bytes)'.format(path, len(content)))
+        return 0
 
+    def model_name(self):
+        if self.is_go2:
+            return 'GO 2'
+        elif self.is_go3:
+            return 'GO 3'
+        return 'GO 3S'
+
+    def section_type(self, i):
+        # Section type from its magic number, checked in the same order as when packing
+        start = self.sections[i].start
+        return identify(self.mm, start, start + int.from_bytes(self.sections[i].length, 'little'))
+
+    def layout(self):
+        # Name, start and end of every part of the firmware file, named as they are unpacked, in order and covering
+        # the whole file
+        regions = [('firmware.header', 0, FIRMWARE_HEADER_SIZE)]
+        for i in range(0, len(self.sections)):
+            section_start = self.sections[i].start
+            regions.append(('section_' + str(i) + '.header', section_start - SECTION_HEADER_SIZE, section_start))
+            regions.append(('section_' + str(i), section_start, section_start + int.from_bytes(self.sections[i].length, 'little')))
+        regions.append(('firmware.md5', self.camera_firmware_size - MD5_SIZE, self.camera_firmware_size))
+        for file_name, start, size in self.firmwares():
+            regions.append((file_name, start, start + size))
+        regions.append(('firmware.footer', self.file_size - self.footer_size, self.file_size))
+        layout = []
+        position = 0
+        for name, start, end in regions:
+            start = max(start, position)
+            if start > position:
+                layout.append((layout[-1][0] + '.gap' if len(layout) > 0 else 'gap', position, start))
+            layout.append((name, start, max(start, end)))
+            position = max(start, end)
+        return layout
+
+    @profiled('firmware.scan')
+    def scan(self, blobs=True):
+        # Every known format in the whole file from a single pass, with the part of the firmware it's in, and the type
+        # of every section from the format found at its start. Without blobs only the starts of the sections are
+        # checked, which is all unpack needs
+        self.emit('start', 'scan', total=self.file_size)
+        sections = [(self.sections[i].start, self.sections[i].start + int.from_bytes(self.sections[i].length, 'little')) for i in range(0, len(self.sections))]
+        if blobs:
+            found = scan(self.mm, progress=self.progress('scan'))
+        else:
+            found = [scan_blob(self.mm, start, end, signature) for start, end in sections for signature in SCAN_SIGNATURES if signature[0] in SECTION_TYPES]
+            found = [blob for blob in found if blob is not None]
+        layout = {'file': str(self.firmware_path), 'model': self.model_name(), 'size': self.file_size, 'sections': []}
+        for i, (start, end) in enumerate(sections):
+            types = [blob.type for blob in found if blob.start == start and blob.type in SECTION_TYPES]
+            layout['sections'].append({'name': 'section_' + str(i), 'start': start, 'size': end - start,
+                                       'type': types[0] if len(types) > 0 else identify(self.mm, start, end)})
+        if blobs:
+            regions = self.layout()
+            region_starts = [start for name, start, end in regions]
+            layout['blobs'] = [{'type': blob.type, 'start': blob.start, 'size': blob.size,
+                                'region': regions[bisect.bisect_right(region_starts, blob.start) - 1][0]} for blob in found]
+        self.emit('end', 'scan', done=self.file_size, total=self.file_size)
+        return layout
+
+    def firmwares_md5(self):
+        # Footer MD5 of the box and bluetooth firmwares by file name
+        md5s = [self.box_firmware_footer_md5]
         if self.is_go3 or self.is_go3s:
-            # Camera Bluetooth Firmware
-            firmware_camera_bt = read(self.mm, self.camera_firmware_size + self.box_firmware_size, self.camera_bluetooth_firmware_size)
-            write(folder / self.camera_bluetooth_firmware_filename.decode("utf-8").rstrip('\0'), firmware_camera_bt)
-
-            # Box Bluetooth Firmware
-            firmware_box_bt = read(self.mm, self.camera_firmware_size + self.box_firmware_size + self.camera_bluetooth_firmware_size, self.box_bluetooth_firmware_size)
-            write(folder / self.box_bluetooth_firmware_filename.decode("utf-8").rstrip('\0'), firmware_box_bt)
-
+            md5s += [self.camera_bluetooth_firmware_footer_md5, self.box_bluetooth_firmware_footer_md5]
         if self.is_go3s:
-            # Camera Bluetooth App Firmware
-            firmware_camera_bt_app = read(self.mm, self.camera_firmware_size + self.box_firmware_size + + self.camera_bluetooth_firmware_size + self.box_bluetooth_firmware_size, self.camera_bluetooth_app_firmware_size)
-            write(folder / self.camera_bluetooth_app_firmware_filename.decode("utf-8").rstrip('\0'), firmware_camera_bt_app)
-
-    def pack(self, folder):
-        print('Packing...')
-
-        folder = Path(folder)
-
-        # Get camera version from footer file
-        footer_file_size = os.path.getsize(folder / 'firmware.footer')
-        footer_file = open(folder / 'firmware.footer', 'r+b')
-        # Is it an Insta360 GO 2 firmware?
-        footer_file.seek(footer_file_size - FIRMWARE_FOOTER_GO2_SIGNATURE_SIZE)
-        footer_signature = footer_file.read(FIRMWARE_FOOTER_GO2_SIGNATURE_SIZE)
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO2_SIGNATURE[:8]:
-            self.is_go2 = True
-        # Is it an Insta360 GO 3 firmware?
-        footer_file.seek(footer_file_size - FIRMWARE_FOOTER_GO3_SIGNATURE_SIZE)
-        footer_signature = footer_file.read(FIRMWARE_FOOTER_GO3_SIGNATURE_SIZE)
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO3_SIGNATURE[:8]:
-            self.is_go3 = True
-        if footer_signature[:8] == FIRMWARE_FOOTER_GO3S_SIGNATURE[:8]:
-            self.is_go3s = True
-        # Is it none?
-        if self.is_go2 is False and self.is_go3 is False and self.is_go3s is False:
-            print('Only Insta360 GO 2, Insta360 GO 3 and Insta360 GO 3S cameras are supported')
-            sys.exit(1)
-
-        # Get the firmware file names from the firmware.footer file
-        footer_file.seek(FIRMWARE_FOOTER_BOX_FILE_NAME_POSITION)
-        self.box_firmware_filename = footer_file.read(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FILE_NAME_SIZE)
-        self.box_firmware_filename = self.box_firmware_filename.decode("utf-8").rstrip("\0")
+            md5s.append(self.camera_bluetooth_app_firmware_footer_md5)
+        return {file_name: md5 for (file_name, start, size), md5 in zip(self.firmwares(), md5s)}
+
+    def romfs_delta(self, other, old_romfs, new_romfs, old_start, new_start):
+        # ROMFS sections are compared file by file, so files that moved are copied from their old offset and only
+        # changed files are compared byte by byte
+        def file_ranges(romfs, size):
+            # Each file goes up to the next one, padding included, and the header up to the first file
+            table = sorted(romfs.table, key=lambda entry: entry[2])
+            ranges = {None: (0, table[0][2] if len(table) > 0 else size, 0, 0)}
+            for i, (file_name, file_length, file_offset, file_crc32) in enumerate(table):
+                if i > 0 and table[i - 1][2] == file_offset:
+                    ranges[file_name] = (file_offset, file_offset, file_length, file_crc32)
+                else:
+                    next_offsets = [entry[2] for entry in table[i + 1:] if entry[2] > file_offset]
+                    ranges[file_name] = (file_offset, next_offsets[0] if len(next_offsets) > 0 else size, file_length, file_crc32)
+            return ranges
+        old_ranges = file_ranges(old_romfs, len(old_romfs.view))
+        new_ranges = file_ranges(new_romfs, len(new_romfs.view))
+        operations = []
+        files = []
+        for file_name, (start, end, file_length, file_crc32) in sorted(new_ranges.items(), key=lambda item: item[1][0]):
+            if file_name not in old_ranges:
+                file_operations = [(new_start + start, end - start, None)]
+            else:
+                old_file_start, old_file_end, old_file_length, old_file_crc32 = old_ranges[file_name]
+                if file_name is not None and old_file_crc32 == file_crc32 and old_file_length == file_length and old_file_end - old_file_start == end - start:
+                    file_operations = [(new_start + start, end - start, old_start + old_file_start)]
+                else:
+                    file_operations = delta(self.mm, old_start + old_file_start, old_start + old_file_end, other.mm, new_start + start, new_start + end)
+            operations += file_operations
+            if file_name is None:
+                continue
+            changed_bytes = sum(length for offset, length, old_offset in file_operations if old_offset is None)
+            if file_name not in old_ranges:
+                files.append({'name': file_name, 'status': 'added', 'new_size': file_length, 'new_crc32': file_crc32, 'changed_bytes': changed_bytes})
+            elif old_ranges[file_name][3] != file_crc32 or old_ranges[file_name][2] != file_length:
+                files.append({'name': file_name, 'status': 'changed', 'old_size': old_ranges[file_name][2], 'new_size': file_length,
+                              'old_crc32': old_ranges[file_name][3], 'new_crc32': file_crc32, 'changed_bytes': changed_bytes})
+        for file_name, (start, end, file_length, file_crc32) in old_ranges.items():
+            if file_name is not None and file_name not in new_ranges:
+                files.append({'name': file_name, 'status': 'removed', 'old_size': file_length, 'old_crc32': file_crc32})
+        return merge_operations(operations), files
+
+    def diff(self, other):
+        # Compare this firmware with a newer one part by part. Sections with the same CRC32 and firmwares with the same
+        # MD5 are not read at all. Returns the report and the operations to build the other firmware file from this one
+        old_layout = {name: (start, end) for name, start, end in self.layout()}
+        old_sections = {'section_' + str(i): i for i in range(0, len(self.sections))}
+        new_sections = {'section_' + str(i): i for i in range(0, len(other.sections))}
+        old_md5 = self.firmwares_md5()
+        new_md5 = other.firmwares_md5()
+        old_romfs = self.romfs_sections()
+        new_romfs = other.romfs_sections()
+        report = {
+            'old': {'file': str(self.firmware_path), 'model': self.model_name(), 'version': self.camera_firmware_version.decode('utf-8').rstrip('\0'), 'size': self.file_size},
+            'new': {'file': str(other.firmware_path), 'model': other.model_name(), 'version': other.camera_firmware_version.decode('utf-8').rstrip('\0'), 'size': other.file_size},
+            'identical': True,
+            'changed_bytes': 0,
+            'regions': []
+        }
+        operations = []
+        for name, start, end in other.layout():
+            region = {'name': name}
+            if name in new_sections:
+                region['type'] = other.section_type(new_sections[name])
+            if name not in old_layout:
+                region_operations = [(start, end - start, None)]
+                region['status'] = 'added'
+            else:
+                old_start, old_end = old_layout[name]
+                region['old_size'] = old_end - old_start
+                if name in new_sections and name in old_sections and \
+                        self.sections[old_sections[name]].length == other.sections[new_sections[name]].length and \
+                        self.sections[old_sections[name]].crc32 == other.sections[new_sections[name]].crc32:
+                    region_operations = [(start, end - start, old_start)]
+                elif name in new_md5 and old_md5.get(name) == new_md5[name] and old_end - old_start == end - start:
+                    region_operations = [(start, end - start, old_start)]
+                elif name in new_romfs and name in old_romfs and new_romfs[name].table is not None and old_romfs[name].table is not None:
+                    region_operations, region['files'] = self.romfs_delta(other, old_romfs[name], new_romfs[name], old_start, start)
+                else:
+                    region_operations = delta(self.mm, old_start, old_end, other.mm, start, end)
+                region['status'] = 'identical' if region_operations == [(start, end - start, old_start)] or old_end - old_start == end - start == 0 else 'changed'
+            region['new_size'] = end - start
+            changes = [(offset - start, length) for offset, length, old_offset in region_operations if old_offset is None]
+            region['changed_bytes'] = sum(length for offset, length in changes)
+            if len(changes) > 0:
+                region['changes'] = [{'offset': offset, 'length': length} for offset, length in changes]
+            report['regions'].append(region)
+            report['changed_bytes'] += region['changed_bytes']
+            report['identical'] = report['identical'] and region['status'] == 'identical'
+            operations += region_operations
+        new_layout = set(name for name, start, end in other.layout())
+        for name, (start, end) in old_layout.items():
+            if name not in new_layout:
+                report['regions'].append({'name': name, 'status': 'removed', 'old_size': end - start})
+                report['identical'] = False
+        for romfs_section in list(old_romfs.values()) + list(new_romfs.values()):
+            romfs_section.close()
+        return report, merge_operations(operations)
+
+    def write_patch(self, other, operations, patch_path):
+        # Compact patch to build the other firmware file from this one: a header followed by a compressed list of
+        # copies from this file and inserts with their bytes
+        patch_file = open(patch_path, 'wb')
+        patch_file.write(PATCH_HEADER_STRUCT.pack(PATCH_MAGIC_NUMBER, PATCH_VERSION, self.file_size, other.file_size,
+                                                  self.camera_firmware_footer_md5, other.camera_firmware_footer_md5))
+        compressor = zlib.compressobj(9)
+        for new_offset, length, old_offset in operations:
+            if old_offset is None:
+                patch_file.write(compressor.compress(PATCH_OPERATION_STRUCT.pack(PATCH_INSERT, new_offset, length)))
+                for offset in range(new_offset, new_offset + length, HASH_CHUNK_SIZE):
+                    patch_file.write(compressor.compress(other.mm[offset:min(offset + HASH_CHUNK_SIZE, new_offset + length)]))
+            else:
+                patch_file.write(compressor.compress(PATCH_OPERATION_STRUCT.pack(PATCH_COPY, old_offset, length)))
+        patch_file.write(compressor.flush())
+        patch_file.close()
 
+    def firmwares(self):
+        # File name, start and size of the box and bluetooth firmwares after the camera firmware
+        firmwares = [(self.box_firmware_filename, self.box_firmware_size)]
         if self.is_go3 or self.is_go3s:
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FILE_NAME_POSITION)
-            self.camera_bluetooth_firmware_filename = footer_file.read(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FILE_NAME_SIZE)
-            self.camera_bluetooth_firmware_filename = self.camera_bluetooth_firmware_filename.decode("utf-8").rstrip("\0")
-
-            footer_file.seek(FIRMWARE_FOOTER_BOX_BLUETOOTH_FILE_NAME_POSITION)
-            self.box_bluetooth_firmware_filename = footer_file.read(FIRMWARE_FOOTER_BOX_BLUETOOTH_FILE_NAME_SIZE)
-            self.box_bluetooth_firmware_filename = self.box_bluetooth_firmware_filename.decode("utf-8").rstrip("\0")
-
+            firmwares.append((self.camera_bluetooth_firmware_filename, self.camera_bluetooth_firmware_size))
+            firmwares.append((self.box_bluetooth_firmware_filename, self.box_bluetooth_firmware_size))
         if self.is_go3s:
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FILE_NAME_POSITION)
-            self.camera_bluetooth_app_firmware_filename = footer_file.read(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FILE_NAME_SIZE)
-            self.camera_bluetooth_app_firmware_filename = self.camera_bluetooth_app_firmware_filename.decode("utf-8").rstrip("\0")
+            firmwares.append((self.camera_bluetooth_app_firmware_filename, self.camera_bluetooth_app_firmware_size))
+        start = self.camera_firmware_size
+        result = []
+        for file_name, size in firmwares:
+            result.append((file_name.decode('utf-8').rstrip('\0'), start, size))
+            start += size
+        return result
+
+    @profiled('firmware.pack')
+    def pack(self, folder, store=None):
+        print('Packing...')
 
-        footer_file.close()
+        folder = Path(folder)
+        manifest = Manifest(folder).load()
+        self.emit('start', 'pack')
+        if store is not None:
+            manifest.restore(store)
+
+        # The model and the firmware file names come from firmware.footer, decoded like the footer of a firmware file
+        footer = Firmware(folder / 'firmware.footer')
+        self.footer_model = footer.footer_model
+        for name in FIRMWARE_FOOTER_FIRMWARE_NAMES[1:]:
+            if getattr(footer, name + '_firmware_filename') is not None:
+                setattr(self, name + '_firmware_filename', getattr(footer, name + '_firmware_filename').decode('utf-8').rstrip('\0'))
 
         # Get sections from folder and order them
         self.sections = [f for f in os.listdir(folder) if re.match(r'section_[0-9]+\.bin', f)]
         self.sections.sort()
 
-        temp_directory = Path(tempfile.mkdtemp())
         total_size = 0
+        sections_header = []
+        sections_crc32 = []
+        sections_is_dtb = []
 
-        print('Backing up section data...')
+        print('Preparing section data...')
         for i in range(0, len(self.sections)):
-            section_file = open(folder / self.sections[i], 'rb')
-            section_name = 'section_' + str(i)
-            section_bin_filename = section_name + '.bin'
-            if read(section_file, RTOS_MAGIC_NUMBER_POSITION, len(RTOS_MAGIC_NUMBER)) == RTOS_MAGIC_NUMBER:
-                print(self.sections[i] + ': RTOS')
-                # Nothing
-            elif read(section_file, ROMFS_MAGIC_NUMBER_POSITION, len(ROMFS_MAGIC_NUMBER)) == ROMFS_MAGIC_NUMBER:
-                print(self.sections[i] + ': ROMFS')
-                romfs = RomFs()
-                section_files_filename = section_name + '.files'
-                romfs.write_files(folder / section_files_filename)
-            elif read(section_file, KERNEL_MAGIC_NUMBER_POSITION, len(KERNEL_MAGIC_NUMBER)) == KERNEL_MAGIC_NUMBER:
-                print(self.sections[i] + ': KERNEL')
-                # Nothing
-            elif read(section_file, EXT2_MAGIC_NUMBER_POSITION, len(EXT2_MAGIC_NUMBER)) == EXT2_MAGIC_NUMBER:
-                print(self.sections[i] + ': EXT2')
-                # section_ext2_folder_name = section_name + '.ext2'
-                # if (sys.platform == 'linux' or sys.platform == 'linux2') and (folder / section_ext2_folder_name).exists():
-                #     print('unmounting ext2')
-            elif read(section_file, DTB_MAGIC_NUMBER_POSITION, len(DTB_MAGIC_NUMBER)) == DTB_MAGIC_NUMBER:
-                print(self.sections[i] + ': DTB')
-                section_dts_filename = section_name + '.dts'
-                if shutil.which('dtc') is not None and (folder / section_dts_filename).exists():
-                    print('Packing dts...')
-                    dtb_original_size = os.path.getsize(folder / section_bin_filename)
-                    os.system('dtc -q -I dts -O dtb -o - "' + str(folder / section_dts_filename) + '" -S ' + str(dtb_original_size) + ' > "' + str(folder / section_bin_filename) + '"')
-
-            section_header_filename = section_name + '.header'
-            shutil.copyfile(folder / section_bin_filename, temp_directory / section_bin_filename)
-            shutil.copyfile(folder / section_header_filename, temp_directory / section_header_filename)
-            section_size = os.path.getsize(temp_directory / section_bin_filename)
-            total_size += section_size + SECTION_HEADER_SIZE
-            section_crc32 = calculate_crc32(section_file, 0, section_size)
-            section_file.close()
-            # Update header CRC32 and size
-            header_file = open(temp_directory / section_header_filename, 'r+b')
-            header_file.seek(SECTION_HEADER_CRC32_POSITION)
-            header_file.write(section_crc32)
-            header_file.seek(SECTION_HEADER_LENGTH_POSITION)
-            header_file.write(section_size.to_bytes(SECTION_HEADER_LENGTH_SIZE, 'little'))
-            header_file.close()
-            # Append header and section to firmware
-            header_file = open(temp_directory / section_header_filename, 'rb')
-            section_data_file = open(temp_directory / section_bin_filename, 'rb')
-            section_file = open(temp_directory / section_name, 'wb')
-            section_file.write(header_file.read())
-            section_file.write(section_data_file.read())
-            section_file.close()
-
-        # We start with the original firmware header, and later we'll overwrite the CRC32 and the sections data
+            with profile_span('section_' + str(i)):
+                section_file = open(folder / self.sections[i], 'rb')
+                section_name = 'section_' + str(i)
+                section_bin_filename = section_name + '.bin'
+                # The type found when unpacking holds as long as the section file is the same
+                if section_bin_filename in manifest.layout and manifest.is_unchanged(section_bin_filename):
+                    section_type = manifest.layout[section_bin_filename]
+                else:
+                    section_type = identify(section_file, 0, os.path.getsize(folder / section_bin_filename))
+                is_dtb = section_type == 'DTB'
+                if section_type == 'RTOS':
+                    print(self.sections[i] + ': RTOS')
+                    # Nothing
+                elif section_type == 'ROMFS':
+                    print(self.sections[i] + ': ROMFS')
+                    section_files_filename = section_name + '.files'
+                    files_file = open(folder / section_files_filename, 'r')
+                    inputs = [section_files_filename] + [section_name + '/' + file_name.strip() for file_name in files_file.readlines()]
+                    files_file.close()
+                    changed_inputs = manifest.changed_files(inputs)
+                    if manifest.has_section(section_name, inputs) and len(changed_inputs) == 0 and manifest.is_unchanged(section_bin_filename):
+                        print('ROMFS files unchanged, skipping...')
+                    else:
+                        romfs = self.observe(RomFs())
+                        # Raises before anything is recorded if the files don't fit in a ROMFS
+                        romfs_written = romfs.write_files(folder / section_files_filename)
+                        manifest.record(section_bin_filename, romfs_written[0])
+                        for file_name in changed_inputs:
+                            manifest.record(file_name)
+                        manifest.record_section(section_name, inputs)
+                elif section_type == 'KERNEL':
+                    print(self.sections[i] + ': KERNEL')
+                    # Nothing
+                elif section_type == 'EXT2':
+                    print(self.sections[i] + ': EXT2')
+                    section_ext2_folder_name = section_name + '.ext2'
+                    # An empty folder or a mounted one is the mount point used to modify section_N.bin directly
+                    if (folder / section_ext2_folder_name).is_dir() and not os.path.ismount(folder / section_ext2_folder_name) and any((folder / section_ext2_folder_name).iterdir()):
+                        # The new image is built next to the original one, which is read in place until it's replaced
+                        print('Packing ext2...')
+                        section_new_filename = section_bin_filename + '.new'
+                        section_mm = mmap.mmap(section_file.fileno(), 0, access=mmap.ACCESS_READ)
+                        ext2 = Ext2(memoryview(section_mm))
+                        try:
+                            ext2_written = ext2.write_files(folder / section_ext2_folder_name, folder / section_new_filename)
+                        finally:
+                            ext2.view.release()
+                            section_mm.close()
+                            section_file.close()
+                        if ext2_written:
+                            os.replace(folder / section_new_filename, folder / section_bin_filename)
+                        else:
+                            print('ext2 files unchanged, skipping...')
+                elif is_dtb:
+                    print(self.sections[i] + ': DTB')
+                    section_dts_filename = section_name + '.dts'
+                    if (folder / section_dts_filename).exists():
+                        if manifest.has_section(section_name, [section_dts_filename]) and manifest.is_unchanged(section_dts_filename) and manifest.is_unchanged(section_bin_filename):
+                            print('dts unchanged, skipping...')
+                        else:
+                            print('Packing dts...')
+                            try:
+                                Dtb().write(folder / section_dts_filename, folder / section_bin_filename)
+                            except ValueError as e:
+                                raise FirmwareError('Could not pack {}: {}'.format(section_dts_filename, e))
+                            manifest.record(section_dts_filename)
+                            manifest.record_section(section_name, [section_dts_filename])
+                section_file.close()
+
+                # The section CRC32 is needed in its header before the section can be added to the firmware
+                if manifest.is_unchanged(section_bin_filename):
+                    section_crc32 = Crc32(manifest.crc32(section_bin_filename))
+                    section_size = os.path.getsize(folder / section_bin_filename)
+                else:
+                    with profile_span('crc32', section=i):
+                        section_crc32 = Crc32()
+                        section_size = stream_file(folder / section_bin_filename, hashers=[section_crc32], progress=self.progress('pack', section_bin_filename))
+                    manifest.record(section_bin_filename, section_crc32.value)
+                manifest.layout[section_bin_filename] = section_type
+                total_size += section_size + SECTION_HEADER_SIZE
+
+                # Update header CRC32 and size
+                section_header_filename = section_name + '.header'
+                header_file = open(folder / section_header_filename, 'rb')
+                header = bytearray(header_file.read())
+                header_file.close()
+                patch(header, SECTION_HEADER_CRC32_POSITION, section_crc32.digest())
+                patch(header, SECTION_HEADER_LENGTH_POSITION, section_size.to_bytes(SECTION_HEADER_LENGTH_SIZE, 'little'))
+                sections_header.append(header)
+                # The CRC32 of the header and the section together is derived from the section CRC32 without reading the section again
+                sections_crc32.append(crc32_combine(zlib.crc32(header), section_crc32.value, section_size))
+                sections_is_dtb.append(is_dtb)
+
+        # We start with the original firmware header and update the CRC32 and the sections data before writing anything
         print('Creating firmware...')
-        shutil.copyfile(folder / 'firmware.header', self.firmware_path)
-        firmware_file = open(self.firmware_path, 'r+b')
-        sections_running_crc32 = bytes(0x0)
+        header_file = open(folder / 'firmware.header', 'rb')
+        firmware_header = bytearray(header_file.read())
+        header_file.close()
+        sections_running_crc32 = 0
         for i in range(0, len(self.sections)):
-            print('Adding section {:d} data...'.format(i))
-            section_name = 'section_' + str(i)
-            section_file = open(temp_directory / section_name, 'rb')
-            firmware_file.seek(0, io.SEEK_END)  # Move to the end to append content
-            firmware_file.write(section_file.read())
             print('Updating header info for section {:d}...'.format(i))
-            section_size = os.fstat(section_file.fileno()).st_size
-            sections_running_crc32 = calculate_crc32(section_file, 0, section_size, int.from_bytes(sections_running_crc32, 'little'))
-            sections_running_crc32_inverse = 0xffffffff ^ int.from_bytes(sections_running_crc32, 'little')
+            section_size = len(sections_header[i]) + int.from_bytes(sections_header[i][SECTION_HEADER_LENGTH_POSITION:SECTION_HEADER_LENGTH_POSITION + SECTION_HEADER_LENGTH_SIZE], 'little')
+            # A running CRC32 uses the previous CRC32 as base value
+            sections_running_crc32 = crc32_combine(sections_running_crc32, sections_crc32[i], section_size)
+            sections_running_crc32_inverse = 0xffffffff ^ sections_running_crc32
             section_crc32 = sections_running_crc32_inverse.to_bytes(FIRMWARE_HEADER_SECTIONS_CRC32_SIZE, 'little')
-            firmware_file.seek(FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + (i * FIRMWARE_HEADER_SECTIONS_SIZE))
-            if read(section_file, DTB_MAGIC_NUMBER_POSITION + SECTION_HEADER_SIZE, len(DTB_MAGIC_NUMBER)) != DTB_MAGIC_NUMBER:
-                firmware_file.write(section_size.to_bytes(FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, 'little'))
+            position = FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + (i * FIRMWARE_HEADER_SECTIONS_SIZE)
+            if not sections_is_dtb[i]:
+                patch(firmware_header, position, section_size.to_bytes(FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, 'little'))
             else:
-                firmware_file.write(0x00000000.to_bytes(FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, 'little'))  # Section 5 (DTB) size is stored always as 0x00000000
-            firmware_file.write(section_crc32)
-            firmware_file.flush()
-
-        firmware_file.flush()
+                patch(firmware_header, position, 0x00000000.to_bytes(FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, 'little'))  # Section 5 (DTB) size is stored always as 0x00000000
+            patch(firmware_header, position + FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, section_crc32)
 
         print('Adding camera firmware CRC32...')
-        firmware_crc32 = calculate_crc32(firmware_file, FIRMWARE_HEADER_SIZE, total_size)
-        firmware_file.seek(FIRMWARE_HEADER_CRC32_POSITION)
-        firmware_file.write(firmware_crc32)
-
-        firmware_file.flush()
+        # The camera firmware CRC32 covers all the sections, so it's the last running CRC32
+        patch(firmware_header, FIRMWARE_HEADER_CRC32_POSITION, sections_running_crc32.to_bytes(FIRMWARE_HEADER_CRC32_SIZE, 'little'))
+
+        with profile_span('write'):
+            # Everything is written once and in order while the MD5s are calculated
+            firmware_file = open(self.firmware_path, 'wb')
+            firmware_md5 = hashlib.md5(firmware_header)
+            firmware_file.write(firmware_header)
+            for i in range(0, len(self.sections)):
+                self.emit('start', 'pack', 'section_' + str(i), description='Adding section {:d} data...'.format(i))
+                firmware_md5.update(sections_header[i])
+                firmware_file.write(sections_header[i])
+                section_size = stream_file(folder / self.sections[i], firmware_file, [firmware_md5], progress=self.progress('pack', 'section_' + str(i)))
+                self.emit('end', 'pack', 'section_' + str(i), done=section_size, total=section_size)
 
         print('Adding whole firmware MD5...')
-        firmware_md5 = calculate_md5(firmware_file, 0, FIRMWARE_HEADER_SIZE + total_size)
-        firmware_file.seek(0, io.SEEK_END)
-        firmware_file.write(firmware_md5)
-
-        firmware_file.flush()
+        firmware_file.write(firmware_md5.digest())
 
-        # Calculate all camera firmware MD5 for later in the footer
-        firmware_footer_size = os.path.getsize(self.firmware_path)
-        firmware_footer_md5 = calculate_md5(firmware_file, 0, firmware_footer_size)
+        # Calculate all camera firmware MD5 for later in the footer, it's the same data plus the MD5 just added
+        firmware_footer_size = FIRMWARE_HEADER_SIZE + total_size + MD5_SIZE
+        firmware_md5.update(firmware_md5.digest())
+        firmware_footer_md5 = firmware_md5.digest()
 
-        # Add box firmware
-        print('Adding box firmware...')
-        shutil.copyfile(folder / self.box_firmware_filename, temp_directory / self.box_firmware_filename)
-        box_file = open(temp_directory / self.box_firmware_filename, 'rb')
-        firmware_file.seek(0, io.SEEK_END)
-        firmware_file.write(box_file.read())
+        with profile_span('firmwares'):
+            # Add box firmware
+            box_footer_size, self.box_firmware_footer_md5 = self.append_firmware(folder, self.box_firmware_filename, firmware_file, manifest, 'Adding box firmware...')
 
-        firmware_file.flush()
-
-        # Calculate all box firmware MD5 for later in the footer
-        box_footer_size = os.path.getsize(temp_directory / self.box_firmware_filename)
-        self.box_firmware_footer_md5 = calculate_md5(box_file, 0, box_footer_size)
-
-        if self.is_go3 or self.is_go3s:
-            # Add camera bluetooth firmware
-            print('Adding camera bluetooth firmware...')
-            shutil.copyfile(folder / self.camera_bluetooth_firmware_filename, temp_directory / self.camera_bluetooth_firmware_filename)
-            camera_bluetooth_file = open(temp_directory / self.camera_bluetooth_firmware_filename, 'rb')
-            firmware_file.seek(0, io.SEEK_END)
-            firmware_file.write(camera_bluetooth_file.read())
-
-            # Calculate camera bluetooth firmware MD5 for later in the footer
-            self.camera_bluetooth_firmware_size = os.path.getsize(temp_directory / self.camera_bluetooth_firmware_filename)
-            self.camera_bluetooth_firmware_footer_md5 = calculate_md5(camera_bluetooth_file, 0, self.camera_bluetooth_firmware_size)
-
-            # Add box bluetooth firmware
-            print('Adding box bluetooth firmware...')
-            shutil.copyfile(folder / self.box_bluetooth_firmware_filename, temp_directory / self.box_bluetooth_firmware_filename)
-            box_bluetooth_file = open(temp_directory / self.box_bluetooth_firmware_filename, 'rb')
-            firmware_file.seek(0, io.SEEK_END)
-            firmware_file.write(box_bluetooth_file.read())
-
-            # Calculate box bluetooth firmware MD5 for later in the footer
-            self.box_bluetooth_firmware_size = os.path.getsize(temp_directory / self.box_bluetooth_firmware_filename)
-            self.box_bluetooth_firmware_footer_md5 = calculate_md5(box_bluetooth_file, 0, self.box_bluetooth_firmware_size)
+            if self.is_go3 or self.is_go3s:
+                # Add camera bluetooth firmware
+                self.camera_bluetooth_firmware_size, self.camera_bluetooth_firmware_footer_md5 = self.append_firmware(folder, self.camera_bluetooth_firmware_filename, firmware_file, manifest, 'Adding camera bluetooth firmware...')
 
-        if self.is_go3s:
-            # Add camera bluetooth app firmware
-            print('Adding camera bluetooth app firmware...')
-            shutil.copyfile(folder / self.camera_bluetooth_app_firmware_filename, temp_directory / self.camera_bluetooth_app_firmware_filename)
-            camera_bluetooth_app_file = open(temp_directory / self.camera_bluetooth_app_firmware_filename, 'rb')
-            firmware_file.seek(0, io.SEEK_END)
-            firmware_file.write(camera_bluetooth_app_file.read())
+                # Add box bluetooth firmware
+                self.box_bluetooth_firmware_size, self.box_bluetooth_firmware_footer_md5 = self.append_firmware(folder, self.box_bluetooth_firmware_filename, firmware_file, manifest, 'Adding box bluetooth firmware...')
 
-            # Calculate camera bluetooth app firmware MD5 for later in the footer
-            self.camera_bluetooth_app_firmware_size = os.path.getsize(temp_directory / self.camera_bluetooth_app_firmware_filename)
-            self.camera_bluetooth_app_firmware_footer_md5 = calculate_md5(camera_bluetooth_app_file, 0, self.camera_bluetooth_app_firmware_size)
+            if self.is_go3s:
+                # Add camera bluetooth app firmware
+                self.camera_bluetooth_app_firmware_size, self.camera_bluetooth_app_firmware_footer_md5 = self.append_firmware(folder, self.camera_bluetooth_app_firmware_filename, firmware_file, manifest, 'Adding camera bluetooth app firmware...')
 
         # Firmware footer
         print('Adding footer...')
-        shutil.copyfile(folder / 'firmware.footer', temp_directory / 'firmware.footer')
-        footer_file = open(temp_directory / 'firmware.footer', 'r+b')
-
-        # Set camera firmware size
-        footer_file.seek(FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_POSITION)
-        footer_file.write(firmware_footer_size.to_bytes(FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_SIZE, 'little'))
-
-        # Set camera firmware MD5
-        footer_file.seek(FIRMWARE_FOOTER_CAMERA_MD5_POSITION)
-        footer_file.write(firmware_footer_md5)
+        footer_file = open(folder / 'firmware.footer', 'rb')
+        footer = bytearray(footer_file.read())
+        footer_file.close()
 
-        # Set box firmware size
-        footer_file.seek(FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_POSITION)
-        footer_file.write(box_footer_size.to_bytes(FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_SIZE, 'little'))
+        # Set camera firmware size and MD5
+        patch(footer, FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_POSITION, firmware_footer_size.to_bytes(FIRMWARE_FOOTER_CAMERA_FIRMWARE_LENGTH_SIZE, 'little'))
+        patch(footer, FIRMWARE_FOOTER_CAMERA_MD5_POSITION, firmware_footer_md5)
 
-        # Set box firmware MD5
-        footer_file.seek(FIRMWARE_FOOTER_BOX_MD5_POSITION)
-        footer_file.write(self.box_firmware_footer_md5)
+        # Set box firmware size and MD5
+        patch(footer, FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_POSITION, box_footer_size.to_bytes(FIRMWARE_FOOTER_BOX_FIRMWARE_LENGTH_SIZE, 'little'))
+        patch(footer, FIRMWARE_FOOTER_BOX_MD5_POSITION, self.box_firmware_footer_md5)
 
         if self.is_go3 or self.is_go3s:
-            # Set camera bluetooth firmware size
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_POSITION)
-            footer_file.write(self.camera_bluetooth_firmware_size.to_bytes(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_SIZE, 'little'))
+            # Set camera bluetooth firmware size and MD5
+            patch(footer, FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_POSITION, self.camera_bluetooth_firmware_size.to_bytes(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_FIRMWARE_LENGTH_SIZE, 'little'))
+            patch(footer, FIRMWARE_FOOTER_CAMERA_BLUETOOTH_MD5_POSITION, self.camera_bluetooth_firmware_footer_md5)
 
-            # Set camera bluetooth firmware MD5
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_MD5_POSITION)
-            footer_file.write(self.camera_bluetooth_firmware_footer_md5)
-
-            # Set box bluetooth firmware size
-            footer_file.seek(FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_POSITION)
-            footer_file.write(self.box_bluetooth_firmware_size.to_bytes(FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_SIZE, 'little'))
-
-            # Set box bluetooth firmware MD5
-            footer_file.seek(FIRMWARE_FOOTER_BOX_BLUETOOTH_MD5_POSITION)
-            footer_file.write(self.box_bluetooth_firmware_footer_md5)
+            # Set box bluetooth firmware size and MD5
+            patch(footer, FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_POSITION, self.box_bluetooth_firmware_size.to_bytes(FIRMWARE_FOOTER_BOX_BLUETOOTH_FIRMWARE_LENGTH_SIZE, 'little'))
+            patch(footer, FIRMWARE_FOOTER_BOX_BLUETOOTH_MD5_POSITION, self.box_bluetooth_firmware_footer_md5)
 
         if self.is_go3s:
-            # Set camera bluetooth app firmware size
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_POSITION)
-            footer_file.write(self.camera_bluetooth_app_firmware_size.to_bytes(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_SIZE, 'little'))
-
-            # Set camera bluetooth app firmware MD5
-            footer_file.seek(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_MD5_POSITION)
-            footer_file.write(self.camera_bluetooth_app_firmware_footer_md5)
-
-        footer_file.close()
-
-        footer_file = open(temp_directory / 'firmware.footer', 'rb')
+            # Set camera bluetooth app firmware size and MD5
+            patch(footer, FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_POSITION, self.camera_bluetooth_app_firmware_size.to_bytes(FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_FIRMWARE_LENGTH_SIZE, 'little'))
+            patch(footer, FIRMWARE_FOOTER_CAMERA_BLUETOOTH_APP_MD5_POSITION, self.camera_bluetooth_app_firmware_footer_md5)
 
         # Append footer
-        firmware_file.seek(0, io.SEEK_END)
-        firmware_file.write(footer_file.read())
-
+        firmware_file.write(footer)
         firmware_file.close()
-        footer_file.close()
 
-        shutil.rmtree(temp_directory)
+        manifest.save()
+        self.emit('end', 'pack')
 
         print('Finished!')
 
+    def append_firmware(self, folder, file_name, firmware_file, manifest, description=None):
+        # Append one of the box or bluetooth firmwares and get its size and MD5 for the footer
+        self.emit('start', 'pack', file_name, description=description)
+        if manifest.is_unchanged(file_name) and manifest.md5(file_name) is not None:
+            size = append_file(folder / file_name, firmware_file, self.progress('pack', file_name))
+            md5 = manifest.md5(file_name)
+        else:
+            crc32 = Crc32()
+            md5 = hashlib.md5()
+            size = stream_file(folder / file_name, firmware_file, [crc32, md5], progress=self.progress('pack', file_name))
+            md5 = md5.digest()
+            manifest.record(file_name, crc32.value, md5)
+        self.emit('end', 'pack', file_name, done=size, total=size)
+        return size, md5
+
+
+class PartialFile:
+    # The parts of a file kept while it was streamed, read like the mmap of the whole file as long as only the kept
+    # bytes are read
+    def __init__(self, size, parts):
+        self.length = size
+        self.position = 0
+        self.parts = []
+        for start, content in sorted(parts.items()):
+            if len(self.parts) > 0 and start <= self.parts[-1][0] + len(self.parts[-1][1]):
+                last_start, last_content = self.parts[-1]
+                last_content += content[last_start + len(last_content) - start:]
+            else:
+                self.parts.append((start, bytearray(content)))
+
+    def size(self):
+        return self.length
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, length):
+        for start, content in self.parts:
+            if start <= self.position and self.position + length <= start + len(content):
+                content = bytes(content[self.position - start:self.position - start + length])
+                self.position += length
+                return content
+        raise FirmwareError('The firmware can not be validated as a stream, bytes {:d} to {:d} are not kept'.format(self.position, self.position + length))
+
+    def find(self, sub, start=0):
+        for part_start, content in self.parts:
+            if part_start + len(content) > start:
+                offset = content.find(sub, max(0, start - part_start))
+                if offset != -1:
+                    return part_start + offset
+        return -1
+
+
+class StreamHash:
+    # A hasher fed from its start offset while a firmware is streamed, with copies of it at the offsets its digests
+    # are needed from
+    def __init__(self, start, hasher, end=None):
+        self.start = start
+        self.end = end
+        self.hasher = hasher
+        self.snapshots = {start: hasher.copy()}
+
+
+class StreamValidator:
+    # Validates a firmware fed chunk by chunk, like an upload or a pipe, hashing every byte as it passes. The camera
+    # firmware layout is read from the header and the section headers as they arrive, and the checks that depend on
+    # the footer are resolved at the end with the last bytes, kept in a tail buffer
+    def __init__(self, firmware_path, tail_size=STREAM_TAIL_SIZE):
+        self.firmware_path = firmware_path
+        self.tail_size = tail_size
+        self.position = 0
+        self.tail = bytearray()
+        self.parts = {}
+        self.captures = []
+        self.events = {}
+        self.hashes = []
+        self.active = []
+        self.header_table = None
+        self.running_crc32 = None
+        self.add_capture(0, FIRMWARE_HEADER_SIZE)
+        self.add_event(FIRMWARE_HEADER_SIZE, self.read_header)
+        self.md5 = self.add_hash(0, hashlib.md5())
+
+    @property
+    def tail_start(self):
+        return self.position - len(self.tail)
+
+    def add_capture(self, start, end):
+        # Bytes kept to be parsed when they have arrived
+        self.captures.append((start, end))
+        self.parts[start] = bytearray()
+
+    def add_event(self, offset, callback):
+        self.events.setdefault(offset, []).append(callback)
+
+    def add_hash(self, start, hasher, end=None):
+        stream_hash = StreamHash(start, hasher, end)
+        self.hashes.append(stream_hash)
+        self.add_event(start, lambda offset: self.active.append(stream_hash))
+        if end is not None:
+            self.add_snapshot(stream_hash, end)
+            self.add_event(end, lambda offset: self.active.remove(stream_hash))
+        return stream_hash
+
+    def add_snapshot(self, stream_hash, offset):
+        self.add_event(offset, lambda offset: stream_hash.snapshots.__setitem__(offset, stream_hash.hasher.copy()))
+
+    def update(self, data):
+        with memoryview(data) as view:
+            offset = 0
+            while True:
+                self.run_events()
+                if offset == len(view):
+                    break
+                # Fed up to the next event so every hash starts, stops and is copied at the right offset
+                length = len(view) - offset
+                if len(self.events) > 0:
+                    length = min(length, min(self.events) - self.position)
+                with view[offset:offset + length] as chunk:
+                    for stream_hash in self.active:
+                        stream_hash.hasher.update(chunk)
+                    self.keep(chunk)
+                offset += length
+                self.position += length
+
+    def run_events(self):
+        while len(self.events) > 0 and min(self.events) <= self.position:
+            offset = min(self.events)
+            for callback in self.events.pop(offset):
+                callback(offset)
+
+    def keep(self, chunk):
+        end = self.position + len(chunk)
+        for capture_start, capture_end in self.captures:
+            if capture_start < end and self.position < capture_end:
+                self.parts[capture_start] += chunk[max(capture_start, self.position) - self.position:min(capture_end, end) - self.position]
+        self.captures = [(capture_start, capture_end) for capture_start, capture_end in self.captures if capture_end > end]
+        self.tail += chunk
+        if len(self.tail) > self.tail_size:
+            del self.tail[:len(self.tail) - self.tail_size]
+
+    def read_header(self, offset):
+        header = self.parts[0]
+        self.header_table = []
+        for i in range(0, FIRMWARE_HEADER_SECTIONS_COUNT):
+            position = FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + i * FIRMWARE_HEADER_SECTIONS_SIZE
+            section_length = int.from_bytes(header[position:position + FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE], 'little')
+            section_crc32 = int.from_bytes(header[position + FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE:position + FIRMWARE_HEADER_SECTIONS_SIZE], 'little')
+            self.header_table.append((section_length, section_crc32))
+        # A running CRC32 uses the previous CRC32 as base value, so it's the CRC32 from the first section onwards
+        self.running_crc32 = self.add_hash(FIRMWARE_HEADER_SIZE, Crc32())
+        self.next_section(0, FIRMWARE_HEADER_SIZE)
+
+    def next_section(self, i, start):
+        # Sections follow each other from the end of the header, their headers are kept and read as they arrive
+        while i < FIRMWARE_HEADER_SECTIONS_COUNT:
+            section_length, section_crc32 = self.header_table[i]
+            if section_length != 0 or section_crc32 != 0:
+                self.add_capture(start, start + SECTION_HEADER_SIZE)
+                self.add_event(start + SECTION_HEADER_SIZE, functools.partial(self.read_section_header, i, start))
+                return
+            i += 1
+        # The camera firmware MD5 follows the last section
+        self.add_event(start, self.read_sections_end)
+
+    def read_section_header(self, i, start, offset):
+        header = self.parts[start]
+        section_length, section_crc32 = self.header_table[i]
+        # The section 5 has crc32 but no length, so we get it from the section's header itself
+        if section_length == 0:
+            if header[SECTION_HEADER_MAGIC_NUMBER_POSITION:SECTION_HEADER_MAGIC_NUMBER_POSITION + SECTION_HEADER_MAGIC_NUMBER_SIZE] != SECTION_MAGIC_NUMBER:
+                raise FirmwareError('Invalid section header magic number for section {:d}'.format(i))
+            section_length = int.from_bytes(header[SECTION_HEADER_LENGTH_POSITION:SECTION_HEADER_LENGTH_POSITION + SECTION_HEADER_LENGTH_SIZE], 'little') + SECTION_HEADER_SIZE
+        if section_length < SECTION_HEADER_SIZE:
+            raise FirmwareError('Invalid length in firmware header for section {:d}'.format(i))
+        end = start + section_length
+        self.add_hash(offset, Crc32(), end)
+        self.add_snapshot(self.running_crc32, end)
+        self.add_event(end, lambda offset: self.next_section(i + 1, end))
+
+    def read_sections_end(self, offset):
+        # The camera firmware is expected to end with the MD5 right after the last section, the footer tells if
+        # it's so at the end
+        self.active.remove(self.running_crc32)
+        self.running_crc32.snapshots[offset] = self.running_crc32.hasher.copy()
+        self.md5.snapshots[offset] = self.md5.hasher.copy()
+        self.add_capture(offset, offset + MD5_SIZE)
+        self.add_event(offset + MD5_SIZE, self.read_camera_end)
+
+    def read_camera_end(self, offset):
+        # The firmwares after the camera firmware are hashed as one, with copies every few bytes so any of them
+        # can be finished with the tail once the footer tells where each one ends
+        self.active.remove(self.md5)
+        self.md5.snapshots[offset] = self.md5.hasher.copy()
+        firmwares_md5 = self.add_hash(offset, hashlib.md5())
+
+        def snapshot(offset):
+            firmwares_md5.snapshots[offset] = firmwares_md5.hasher.copy()
+            for snapshot_offset in [s for s in firmwares_md5.snapshots if s < offset - self.tail_size]:
+                del firmwares_md5.snapshots[snapshot_offset]
+            self.add_event(offset + STREAM_SNAPSHOT_SIZE, snapshot)
+        self.add_event(offset + STREAM_SNAPSHOT_SIZE, snapshot)
+
+    def resolve(self, hash_range):
+        # Digests of a range at its end and checkpoints from the hash fed from its start while streaming, or from
+        # the tail when it's there
+        stream_hash = next((h for h in self.hashes if h.start == hash_range.start and type(h.hasher) is type(hash_range.hasher)), None)
+        if stream_hash is None:
+            stream_hash = StreamHash(hash_range.start, hash_range.hasher)
+        offsets = sorted({hash_range.end} | {c for c in hash_range.checkpoints if hash_range.start <= c <= hash_range.end})
+        for offset in offsets:
+            # Like a range of the mmap, a range that goes past the end of the firmware stops there
+            offset = min(offset, self.position)
+            if offset in stream_hash.snapshots:
+                hasher = stream_hash.snapshots[offset]
+            else:
+                start = max([s for s in stream_hash.snapshots if self.tail_start <= s <= offset], default=None)
+                if start is None:
+                    raise FirmwareError('The firmware can not be validated as a stream, bytes {:d} to {:d} are not kept'.format(hash_range.start, offset))
+                hasher = stream_hash.snapshots[start].copy()
+                hasher.update(self.tail[start - self.tail_start:offset - self.tail_start])
+            hash_range.snapshots[offset] = hasher.digest()
+        hash_range.hasher = hasher
+        return hash_range
+
+    def finish(self):
+        # Parse the kept parts like a whole firmware and check the hashes resolved from the stream
+        self.run_events()
+        parts = dict(self.parts)
+        parts[self.tail_start] = self.tail
+        firmware = Firmware(self.firmware_path, PartialFile(self.position, parts))
+        ranges = firmware.validation_ranges()
+        for name in ranges:
+            if name == 'sections_crc32':
+                for hash_range in ranges[name].values():
+                    self.resolve(hash_range)
+            else:
+                self.resolve(ranges[name])
+        firmware.check(ranges)
+        return firmware
+
+
+def validate_stream(stream, firmware_path='-', chunk_size=HASH_CHUNK_SIZE):
+    # Validate a firmware from a stream that can't be mapped or seeked, like stdin or a pipe, in a single pass
+    validator = StreamValidator(firmware_path)
+    buffer = bytearray(chunk_size)
+    with memoryview(buffer) as view:
+        while True:
+            length = stream.readinto(buffer)
+            if not length:
+                break
+            with view[:length] as chunk:
+                validator.update(chunk)
+    return validator.finish()
+
+
+def find_firmware_files(patterns):
+    # Firmware files from a list of files, folders (searched recursively) and glob patterns, without duplicates
+    firmware_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            firmware_paths += sorted(str(path) for path in Path(pattern).rglob('*') if path.suffix.lower() == FIRMWARE_FILE_EXTENSION and path.is_file())
+        elif os.path.isfile(pattern):
+            firmware_paths.append(pattern)
+        else:
+            firmware_paths += sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return list(dict.fromkeys(os.path.normpath(firmware_path) for firmware_path in firmware_paths))
+
+
+def batch_process(firmware_path, folder=None, extract_ext2=False, store_path=None):
+    # Validate and optionally unpack a firmware file in a worker process, returning the result instead of printing it
+    result = {'file': firmware_path, 'status': 'ok', 'model': None, 'version': None, 'size': os.path.getsize(firmware_path), 'error': None, 'seconds': {}}
+    start = time.perf_counter()
+    step_start = start
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            firmware = Firmware(firmware_path)
+            result['model'] = firmware.model_name()
+            result['version'] = firmware.camera_firmware_version.decode('utf-8').rstrip('\0')
+            result['seconds']['open'] = round(time.perf_counter() - step_start, 6)
+            step_start = time.perf_counter()
+            firmware.validate()
+            result['seconds']['validate'] = round(time.perf_counter() - step_start, 6)
+            if folder is not None:
+                step_start = time.perf_counter()
+                firmware.unpack(folder, extract_ext2, Store(store_path) if store_path is not None else None)
+                result['output'] = folder
+                result['seconds']['unpack'] = round(time.perf_counter() - step_start, 6)
+    except FirmwareError as e:
+        result['status'] = 'invalid'
+        result['error'] = str(e)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds']['total'] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def batch(patterns, output=None, jobs=None, extract_ext2=False, store_path=None):
+    # Validate (and unpack to a folder per file if there is an output) many firmware files in a pool of processes,
+    # writing a JSON line with the result of each one as soon as it is done
+    firmware_paths = find_firmware_files(patterns)
+    folders = {}
+    if output is not None:
+        Path(output).mkdir(parents=True, exist_ok=True)
+        for firmware_path in firmware_paths:
+            folder_name = Path(firmware_path).stem
+            suffix = 1
+            while folder_name in folders.values() or (Path(output) / folder_name).exists():
+                suffix += 1
+                folder_name = '{}_{:d}'.format(Path(firmware_path).stem, suffix)
+            folders[firmware_path] = folder_name
+    # The biggest files first so the last ones to finish are small
+    firmware_paths.sort(key=os.path.getsize, reverse=True)
+    start = time.perf_counter()
+    counts = {'ok': 0, 'invalid': 0, 'error': 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(batch_process,
+                                   firmware_path,
+                                   str(Path(output) / folders[firmware_path]) if output is not None else None,
+                                   extract_ext2,
+                                   store_path): firmware_path for firmware_path in firmware_paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process died
+                result = {'file': futures[future], 'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)}
+            counts[result['status']] += 1
+            print(json.dumps(result), flush=True)
+    print('{:d} files: {:d} ok, {:d} invalid, {:d} errors in {:.2f} seconds'.format(len(firmware_paths), counts['ok'], counts['invalid'], counts['error'], time.perf_counter() - start), file=sys.stderr)
+    return 0 if counts['ok'] == len(firmware_paths) else 1
+
+
+async def read_body(reader, headers):
+    # Chunks of a request body as they arrive, sent with a length or with chunked transfer encoding
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()).strip() != b'':
+                    pass
+                return
+            while size > 0:
+                chunk = await reader.readexactly(min(size, SERVE_CHUNK_SIZE))
+                size -= len(chunk)
+                yield chunk
+            await reader.readline()
+    else:
+        remaining = int(headers['content-length'])
+        while remaining > 0:
+            chunk = await reader.readexactly(min(remaining, SERVE_CHUNK_SIZE))
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def serve_upload(reader, writer, folder, semaphore, executor):
+    # Validate a firmware uploaded with PUT or POST while it's written to the folder, answering with a JSON result
+    # as soon as the upload ends. Valid uploads are kept with the name in the path, invalid ones are removed
+    loop = asyncio.get_running_loop()
+    result = {'file': None, 'status': 'error', 'model': None, 'version': None, 'size': 0, 'error': None, 'seconds': {}}
+    http_status = '400 Bad Request'
+    part_path = None
+    target = None
+    try:
+        method, path, _ = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line.strip() == '':
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        file_name = urllib.parse.unquote(urllib.parse.urlsplit(path).path).rsplit('/', 1)[-1]
+        result['file'] = file_name
+        if method not in ('PUT', 'POST'):
+            http_status = '405 Method Not Allowed'
+            raise ValueError('Only PUT and POST are supported')
+        if file_name in ('', '.', '..') or file_name.endswith(SERVE_PART_SUFFIX):
+            raise ValueError('Invalid file name {}'.format(file_name))
+        if 'content-length' not in headers and headers.get('transfer-encoding', '').lower() != 'chunked':
+            http_status = '411 Length Required'
+            raise ValueError('Content-Length not provided')
+        file_path = Path(folder) / file_name
+        part_path = Path(folder) / (file_name + SERVE_PART_SUFFIX)
+        if file_path.exists() or part_path.exists():
+            http_status = '409 Conflict'
+            part_path = None
+            raise ValueError('File {} already exists'.format(file_name))
+        target = open(part_path, 'xb')
+        async with semaphore:
+            if headers.get('expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                await writer.drain()
+            start = time.perf_counter()
+            validator = StreamValidator(file_name)
+
+            def consume(chunk):
+                validator.update(chunk)
+                target.write(chunk)
+
+            # The next chunk is received while the previous one is hashed and written
+            pending = None
+            try:
+                async for chunk in read_body(reader, headers):
+                    if pending is not None:
+                        await pending
+                    pending = loop.run_in_executor(executor, consume, chunk)
+            finally:
+                if pending is not None:
+                    await pending
+            target.close()
+            result['size'] = validator.position
+            result['seconds']['upload'] = round(time.perf_counter() - start, 6)
+            step_start = time.perf_counter()
+            firmware = await loop.run_in_executor(executor, validator.finish)
+            result['seconds']['validate'] = round(time.perf_counter() - step_start, 6)
+        result['model'] = firmware.model_name()
+        result['version'] = firmware.camera_firmware_version.decode('utf-8').rstrip('\0')
+        result['status'] = 'ok'
+        http_status = '200 OK'
+        os.rename(part_path, file_path)
+        part_path = None
+    except FirmwareError as e:
+        result['status'] = 'invalid'
+        result['error'] = str(e)
+        http_status = '422 Unprocessable Entity'
+    except (ValueError, KeyError, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if target is not None:
+            target.close()
+        if part_path is not None and part_path.exists():
+            os.unlink(part_path)
+    print(json.dumps(result), file=sys.stderr, flush=True)
+    body = (json.dumps(result) + '\n').encode('utf-8')
+    try:
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {:d}\r\nConnection: close\r\n\r\n'.format(http_status, len(body)).encode('latin-1') + body)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+
+async def serve_forever(host, port, folder, jobs):
+    semaphore = asyncio.Semaphore(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        server = await asyncio.start_server(lambda reader, writer: serve_upload(reader, writer, folder, semaphore, executor), host, port)
+        print('Serving on {}'.format(', '.join('http://{}:{:d}/'.format(*socket.getsockname()[:2]) for socket in server.sockets)), file=sys.stderr, flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def serve(folder, host=SERVE_HOST, port=SERVE_PORT, jobs=None):
+    # HTTP service validating the firmwares uploaded to it while they are received, at most jobs at the same time
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    # Firmware prints what it reads, the results are written to stderr instead
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            asyncio.run(serve_forever(host, port, folder, jobs or os.cpu_count() or 1))
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def format_crc32(crc32):
+    return '0x{:08x}'.format(int.from_bytes(crc32, 'little'))
+
+
+def index_process(firmware_path):
+    # Metadata of a firmware file for the catalog, read in a worker process. Only the footer, the headers and the
+    # ROMFS tables are read
+    firmware = Firmware(firmware_path)
+    record = {'model': firmware.model_name(),
+              'version': firmware.camera_firmware_version.decode('utf-8').rstrip('\0'),
+              'header_crc32': format_crc32(firmware.firmware_header_crc32),
+              'firmwares': [],
+              'sections': [],
+              'files': []}
+    for name in FIRMWARE_FOOTER_FIRMWARE_NAMES:
+        if getattr(firmware, name + '_firmware_filename') is not None:
+            record['firmwares'].append((name,
+                                        getattr(firmware, name + '_firmware_filename').decode('utf-8').rstrip('\0'),
+                                        getattr(firmware, name + '_firmware_version').decode('utf-8').rstrip('\0'),
+                                        getattr(firmware, name + '_firmware_size'),
+                                        getattr(firmware, name + '_firmware_footer_md5').hex()))
+    for i, section in enumerate(firmware.sections):
+        # Version is minor and major number, date is day, month and year
+        version_minor, version_major = struct.unpack('<HH', section.version)
+        day, month, year = struct.unpack('<BBH', section.date)
+        record['sections'].append(('section_' + str(i),
+                                   firmware.section_type(i),
+                                   section.start,
+                                   int.from_bytes(section.length, 'little'),
+                                   format_crc32(section.crc32),
+                                   '{:d}.{:d}'.format(version_major, version_minor),
+                                   '{:04d}-{:02d}-{:02d}'.format(year, month, day),
+                                   int.from_bytes(section.loading_address, 'little'),
+                                   int.from_bytes(section.flags, 'little')))
+    for section_name, romfs_section in firmware.romfs_sections().items():
+        if romfs_section.table is not None:
+            for file_name, file_length, file_offset, file_crc32 in romfs_section.table:
+                record['files'].append((section_name, file_name, file_length, file_offset, '0x{:08x}'.format(file_crc32)))
+        romfs_section.close()
+    return record
+
+
+def index_process_safe(firmware_path):
+    # Failures are recorded too, so the file isn't read again until it changes
+    try:
+        return index_process(firmware_path)
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def open_catalog(catalog_path):
+    connection = sqlite3.connect(catalog_path)
+    connection.execute('PRAGMA foreign_keys = ON')
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version != CATALOG_VERSION:
+        # The catalog can always be built again from the firmware files
+        connection.executescript(CATALOG_DROP_SCHEMA)
+        connection.executescript(CATALOG_SCHEMA)
+        connection.execute('PRAGMA user_version = {:d}'.format(CATALOG_VERSION))
+    return connection
+
+
+def index(patterns, catalog_path, jobs=None):
+    # Record the metadata of many firmware files in a SQLite catalog. Files are only read again when their size or
+    # modification time changed, and files that don't exist anymore are removed
+    firmware_paths = find_firmware_files(patterns)
+    connection = open_catalog(catalog_path)
+    indexed = {path: (firmware_id, size, mtime_ns) for firmware_id, path, size, mtime_ns in connection.execute('SELECT id, path, size, mtime_ns FROM firmwares')}
+    changed = {}
+    for firmware_path in firmware_paths:
+        firmware_stat = os.stat(firmware_path)
+        absolute_path = os.path.abspath(firmware_path)
+        if indexed.get(absolute_path, (None,))[1:] != (firmware_stat.st_size, firmware_stat.st_mtime_ns):
+            changed[absolute_path] = firmware_stat
+    removed = [path for path in indexed if not os.path.exists(path)]
+    start = time.perf_counter()
+    with connection:
+        connection.executemany('DELETE FROM firmwares WHERE path = ?', [(path,) for path in removed + list(changed)])
+    counts = {'unchanged': len(firmware_paths) - len(changed), 'indexed': 0, 'errors': 0, 'removed': len(removed)}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(index_process_safe, path): path for path in changed}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # The worker process died
+                record = {'error': '{}: {}'.format(type(e).__name__, e)}
+            with connection:
+                firmware_id = connection.execute('INSERT INTO firmwares (path, size, mtime_ns, model, version, header_crc32, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                                 (path, changed[path].st_size, changed[path].st_mtime_ns, record.get('model'), record.get('version'), record.get('header_crc32'), record.get('error'))).lastrowid
+                connection.executemany('INSERT INTO firmware_parts VALUES ({:d}, ?, ?, ?, ?, ?)'.format(firmware_id), record.get('firmwares', []))
+                connection.executemany('INSERT INTO sections VALUES ({:d}, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(firmware_id), record.get('sections', []))
+                connection.executemany('INSERT INTO romfs_files VALUES ({:d}, ?, ?, ?, ?, ?)'.format(firmware_id), record.get('files', []))
+            counts['errors' if 'error' in record else 'indexed'] += 1
+    connection.close()
+    print('{:d} files: {:d} indexed, {:d} unchanged, {:d} errors, {:d} removed in {:.2f} seconds'.format(len(firmware_paths), counts['indexed'], counts['unchanged'], counts['errors'], counts['removed'], time.perf_counter() - start), file=sys.stderr)
+    return 0 if counts['errors'] == 0 else 1
+
+
+def query(catalog_path, sql):
+    # Run a read only SQL query on the catalog, writing a JSON line for each row
+    connection = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(catalog_path))), uri=True)
+    connection.row_factory = sqlite3.Row
+    try:
+        for row in connection.execute(sql):
+            print(json.dumps(dict(row)))
+    except sqlite3.Error as e:
+        print('Invalid query: {}'.format(e), file=sys.stderr)
+        return 1
+    finally:
+        connection.close()
+    return 0
+
+
+def generate_content(rng, size, data_share=1.0, fill=b'\0'):
+    # Pseudo random data followed by a run of a constant byte, like the padding found at the end of the real parts
+    data_size = int(size * data_share)
+    return rng.randbytes(data_size) + fill * (size - data_size)
+
+
+def generate_shares(rng, total, weights):
+    # Split a size in parts proportional to the weights, the last part takes the rounding
+    sizes = [int(total * weight / sum(weights)) for weight in weights]
+    sizes[-1] += total - sum(sizes)
+    return sizes
+
+
+def generate_dtb(size, model_name):
+    # Flattened device tree like the ones of the cameras, padded with zeros to the size of the section like dtc -S does
+    cell = DTB_TOKEN_STRUCT.pack
+    dtb = Dtb()
+    dtb.root = DtbNode('', [('compatible', b'ambarella,s5l\0'), ('model', model_name.encode('utf-8') + b'\0'),
+                            ('#address-cells', cell(1)), ('#size-cells', cell(1))], [
+        DtbNode('chosen', [('bootargs', b'console=ttyS0 root=/dev/mtdblock4 rootfstype=ext2 ro\0')]),
+        DtbNode('memory@0', [('device_type', b'memory\0'), ('reg', cell(0) + cell(0x20000000))]),
+        DtbNode('cpus', [('#address-cells', cell(1)), ('#size-cells', cell(0))],
+                [DtbNode('cpu@{:d}'.format(i), [('device_type', b'cpu\0'), ('compatible', b'arm,cortex-a53\0'), ('reg', cell(i))]) for i in range(0, 4)]),
+        DtbNode('apb@e4000000', [('compatible', b'simple-bus\0'), ('#address-cells', cell(1)), ('#size-cells', cell(1)), ('ranges', b'')],
+                [DtbNode('{}@{:08x}'.format(name, 0xe4000000 + i * 0x1000),
+                         [('compatible', 'ambarella,{}\0'.format(name).encode('utf-8')), ('reg', cell(0xe4000000 + i * 0x1000) + cell(0x1000)),
+                          ('interrupts', cell(0) + cell(32 + i) + cell(4)), ('status', b'okay\0' if i % 3 else b'disabled\0')])
+                 for i, name in enumerate(['uart', 'i2c', 'spi', 'gpio', 'pwm', 'adc', 'wdt', 'rtc', 'sdmmc', 'usb', 'dma', 'ir'] * 4)])])
+    return dtb.blob(size)
+
+
+def generate_ext2(size):
+    # Empty ext2 file system in a single group with only the root directory, filled later with Ext2.write_files
+    block_size = GENERATE_EXT2_BLOCK_SIZE
+    blocks_per_group = block_size * 8
+    # A single group can't have more blocks than bits in its block bitmap, bigger sizes are capped
+    blocks_count = max(0x40, min(size // block_size, blocks_per_group))
+    inode_table_blocks = GENERATE_EXT2_INODES * EXT2_GOOD_OLD_INODE_SIZE // block_size
+    block_bitmap = 2
+    inode_bitmap = 3
+    inode_table = 4
+    root_block = inode_table + inode_table_blocks
+    used_blocks = root_block + 1
+    reserved_inodes = EXT2_GOOD_OLD_FIRST_INODE - 1
+    image = bytearray(blocks_count * block_size)
+    EXT2_SUPERBLOCK_STRUCT.pack_into(image, EXT2_SUPERBLOCK_POSITION,
+                                     GENERATE_EXT2_INODES, blocks_count, 0, blocks_count - used_blocks, GENERATE_EXT2_INODES - reserved_inodes,
+                                     0, (block_size >> 10).bit_length() - 1, (block_size >> 10).bit_length() - 1, blocks_per_group, blocks_per_group, GENERATE_EXT2_INODES,
+                                     0, GENERATE_TIME, 0, 0xFFFF, int.from_bytes(EXT2_MAGIC_NUMBER, 'little'), 1, 1, 0,
+                                     GENERATE_TIME, 0, 0, 1,
+                                     0, 0,
+                                     EXT2_GOOD_OLD_FIRST_INODE,
+                                     EXT2_GOOD_OLD_INODE_SIZE, 0,
+                                     0, EXT2_FEATURE_INCOMPAT_FILETYPE, 0)
+    EXT2_GROUP_DESCRIPTOR_STRUCT.pack_into(image, block_size, block_bitmap, inode_bitmap, inode_table,
+                                           blocks_count - used_blocks, GENERATE_EXT2_INODES - reserved_inodes, 1)
+    # The bits past the end of each bitmap are set
+    for number, used, count in [(block_bitmap, used_blocks, blocks_count), (inode_bitmap, reserved_inodes, GENERATE_EXT2_INODES)]:
+        bits = b'\1' * used + b'\0' * (count - used) + b'\1' * (blocks_per_group - count)
+        image[number * block_size:(number + 1) * block_size] = bytes(EXT2_BITMAP_VALUES[bits[i:i + 8]] for i in range(0, blocks_per_group, 8))
+    block = [root_block] + [0] * (EXT2_BLOCK_POINTERS - 1)
+    EXT2_INODE_STRUCT.pack_into(image, inode_table * block_size + (EXT2_ROOT_INODE - 1) * EXT2_GOOD_OLD_INODE_SIZE,
+                                stat.S_IFDIR | 0o755, 0, block_size, GENERATE_TIME, GENERATE_TIME, GENERATE_TIME, 0, 0, 2, block_size // 512, 0, 0,
+                                *block, 0, 0, 0, 0, bytes(12))
+    dot = EXT2_DIRECTORY_ENTRY_STRUCT.pack(EXT2_ROOT_INODE, 12, 1, EXT2_FILE_TYPES[stat.S_IFDIR]) + b'.\0\0\0'
+    dot_dot = EXT2_DIRECTORY_ENTRY_STRUCT.pack(EXT2_ROOT_INODE, block_size - 12, 2, EXT2_FILE_TYPES[stat.S_IFDIR]) + b'..\0\0'
+    patch(image, root_block * block_size, dot + dot_dot)
+    return image
+
+
+def generate_ext2_tree(rng, folder, size):
+    # Directories, files and symbolic links of a small Linux root file system using part of the given size
+    files = {'etc/hostname': b'insta360\n',
+             'etc/inittab': b'::sysinit:/etc/init.d/rcS\n::respawn:-/bin/sh\n',
+             'etc/init.d/rcS': b'#!/bin/sh\nmount -a\n',
+             'bin/busybox': rng.randbytes(min(size // 16, GENERATE_EXT2_MAX_FILE_SIZE))}
+    links = {'bin/' + name: 'busybox' for name in ['sh', 'ls', 'cat', 'mount', 'umount']}
+    links['lib/libc.so.6'] = 'libc-2.31.so'
+    budget = int(size * GENERATE_EXT2_USAGE) - sum(len(content) for content in files.values())
+    folders = ['lib', 'usr/bin', 'usr/lib', 'usr/share']
+    # Leave enough inodes for the directories
+    while budget > 0 and len(files) + len(links) < GENERATE_EXT2_INODES // 2:
+        i = len(files)
+        file_size = min(budget, int(rng.random() ** 3 * GENERATE_EXT2_MAX_FILE_SIZE) + 1)
+        file_name = folders[i % len(folders)] + ('/lib{:03d}.so' if i % len(folders) in (0, 2) else '/file{:03d}').format(i)
+        files[file_name] = generate_content(rng, file_size, rng.uniform(0.5, 1.0))
+        budget -= file_size + GENERATE_EXT2_BLOCK_SIZE
+    for directory in ['lost+found', 'var', 'tmp'] + folders:
+        (folder / directory).mkdir(parents=True, exist_ok=True)
+    for file_name, content in files.items():
+        (folder / file_name).parent.mkdir(parents=True, exist_ok=True)
+        write(folder / file_name, content)
+        os.chmod(folder / file_name, 0o755 if file_name.startswith(('bin/', 'usr/bin/', 'etc/init.d/')) else 0o644)
+    for file_name, target in links.items():
+        os.symlink(target, folder / file_name)
+    # Same modes and times every time so the same seed gives the same image
+    for path in sorted(folder.rglob('*'), reverse=True) + [folder]:
+        if path.is_dir() and not path.is_symlink():
+            os.chmod(path, 0o755)
+        os.utime(path, (GENERATE_TIME, GENERATE_TIME), follow_symlinks=False)
+
+
+def generate(firmware_path, model='go3', scale=1.0, seed=0):
+    # Build a synthetic firmware with the layout, section types and sizes of a real one but with pseudo random content,
+    # from an unpacked folder packed with pack like any other
+    rng = random.Random(seed)
+    section_sizes = [max(0x1000, int(size * scale)) for size in GENERATE_SECTION_SIZES[model]]
+    firmware_sizes = GENERATE_FIRMWARE_SIZES[model]
+    firmware_sizes = [max(0x1000, int(firmware_sizes[0] * scale))] + firmware_sizes[1:]
+    version = 'v1.0.{:d}'.format(seed)
+    with tempfile.TemporaryDirectory(prefix='generate-', dir=os.path.dirname(os.path.abspath(firmware_path))) as temporary_folder:
+        folder = Path(temporary_folder) / 'firmware'
+        folder.mkdir()
+        write(folder / 'firmware.header', FIRMWARE_HEADER_STRUCT.pack(b'', HEADER_MAGIC_NUMBER, bytes(4), bytes(8), *[bytes(4)] * FIRMWARE_HEADER_SECTIONS_COUNT * 2).ljust(FIRMWARE_HEADER_SIZE, b'\0'))
+        for i, section_size in enumerate(section_sizes):
+            section_name = 'section_' + str(i)
+            header = SECTION_HEADER_STRUCT.pack(bytes(4), struct.pack('<HH', seed & 0xFFFF, 1), struct.pack('<BBH', 1 + i, 1 + seed % 12, 2023),
+                                                bytes(4), GENERATE_LOADING_ADDRESSES[i].to_bytes(4, 'little'), bytes(4), SECTION_MAGIC_NUMBER)
+            write(folder / (section_name + '.header'), header.ljust(SECTION_HEADER_SIZE, b'\0'))
+            if i == 0:
+                write(folder / (section_name + '.bin'), RTOS_MAGIC_NUMBER + generate_content(rng, section_size - len(RTOS_MAGIC_NUMBER), 0.9, b'\xFF'))
+            elif i == 1 or i == 2:
+                # The sizes of the files are chosen so the ROMFS is about the size of the section
+                if i == 1:
+                    file_names = [file_name for file_name, share in GENERATE_DSP_FILES]
+                    weights = [share for file_name, share in GENERATE_DSP_FILES]
+                else:
+                    file_names = GENERATE_ROMFS_FILES + ['res_{:03d}.bin'.format(j) for j in range(0, GENERATE_ROMFS_FILE_COUNT - len(GENERATE_ROMFS_FILES))]
+                    weights = [8.0] * len(GENERATE_ROMFS_FILES) + [rng.random() ** 2 for j in range(len(GENERATE_ROMFS_FILES), GENERATE_ROMFS_FILE_COUNT)]
+                content_size = max(len(file_names), section_size - ROMFS_HEADER_SIZE - len(file_names) * ROMFS_BLOCK_SIZE)
+                (folder / section_name).mkdir()
+                for file_name, file_size in zip(file_names, generate_shares(rng, content_size, weights)):
+                    write(folder / section_name / file_name, generate_content(rng, max(1, file_size), rng.uniform(0.3, 1.0)))
+                write(folder / (section_name + '.files'), ''.join(file_name + '\n' for file_name in file_names).encode('utf-8'))
+                RomFs().write_files(folder / (section_name + '.files'))
+            elif i == 3:
+                kernel = rng.randbytes(KERNEL_MAGIC_NUMBER_POSITION) + KERNEL_MAGIC_NUMBER
+                write(folder / (section_name + '.bin'), kernel + generate_content(rng, section_size - len(kernel), 0.95))
+            elif i == 4:
+                image = generate_ext2(section_size)
+                tree = Path(temporary_folder) / 'ext2'
+                generate_ext2_tree(rng, tree, len(image))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    written = Ext2(memoryview(image)).write_files(tree, folder / (section_name + '.bin'))
+                if not written:
+                    raise FirmwareError('Could not generate the ext2 file system')
+            else:
+                write(folder / (section_name + '.bin'), generate_dtb(section_size, 'Insta360 ' + model.upper().replace('GO', 'GO ')))
+
+        # The footer only needs the file names and versions, the sizes and MD5s are set when packing
+        fields = [0, b'InstaGoFW.bin', version.encode('utf-8'), bytes(MD5_SIZE)]
+        for name, firmware_size in zip(FIRMWARE_FOOTER_FIRMWARE_NAMES[1:], firmware_sizes):
+            file_name = name + '.bin'
+            if name == 'box':
+                # Box firmware data followed by the erased flash
+                write(folder / file_name, generate_content(rng, firmware_size, 0.4 if firmware_size > 0x100000 else 0.95, b'\xFF'))
+            else:
+                write(folder / file_name, rng.randbytes(firmware_size))
+            fields += [0, file_name.encode('utf-8'), version.encode('utf-8'), bytes(MD5_SIZE)]
+        write(folder / 'firmware.footer', GENERATE_FOOTER_STRUCTS[model].pack(*fields, GENERATE_SIGNATURES[model]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            Firmware(firmware_path).pack(folder)
+
+
+def benchmark_run(function, setup=None, repeat=BENCHMARK_REPEAT):
+    # Best wall and CPU times of some runs, and the peak of the memory allocated by Python in one more run as tracing
+    # it slows everything down. The setup runs before each run and is not measured
+    seconds = []
+    cpu_seconds = []
+    peak_memory = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(0, repeat + 1):
+            if setup is not None:
+                setup()
+            if i == repeat:
+                tracemalloc.start()
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            function()
+            if i == repeat:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                seconds.append(time.perf_counter() - start)
+                cpu_seconds.append(time.process_time() - cpu_start)
+    return min(seconds), min(cpu_seconds), peak_memory
+
+
+def benchmark_machine():
+    # What the timings depend on: Python version, architecture, processor and number of CPUs. Linux only tells the
+    # processor model in /proc/cpuinfo
+    processor = platform.processor()
+    try:
+        with open('/proc/cpuinfo', 'r') as cpuinfo:
+            processor = next((line.partition(':')[2].strip() for line in cpuinfo if line.startswith('model name')), processor)
+    except OSError:
+        pass
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'processor': processor, 'cpus': os.cpu_count()}
+
+
+def benchmark(models, scales, repeat=BENCHMARK_REPEAT, tolerance=BENCHMARK_TOLERANCE, baseline_path=BENCHMARK_BASELINE, output=None, seed=0, save_baseline=False):
+    # Time validate, unpack, pack and the ROMFS extraction and writing on generated firmwares. The results are compared
+    # with the baseline file, a missing or different baseline fails like a regression unless the results are saved
+    # to it as the new baseline
+    results = {}
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as temporary_folder:
+        folder = Path(temporary_folder)
+        work = folder / 'work'
+
+        def clean():
+            if work.is_dir():
+                shutil.rmtree(work)
+            for path in [work, work.with_suffix('.files')]:
+                if path.is_file():
+                    path.unlink()
+
+        for model in models:
+            for scale in scales:
+                name = '{}@{:g}'.format(model, scale)
+                firmware_path = folder / (name + '.pkg')
+                unpacked = folder / name
+                generate(firmware_path, model, scale, seed)
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    Firmware(firmware_path).unpack(unpacked)
+                firmware_size = os.path.getsize(firmware_path)
+                romfs_size = os.path.getsize(unpacked / 'section_2.bin')
+
+                def clean_pack():
+                    # Without a manifest everything is packed again
+                    clean()
+                    if (unpacked / MANIFEST_FILENAME).exists():
+                        (unpacked / MANIFEST_FILENAME).unlink()
+
+                for operation, size, function, setup in [('validate', firmware_size, lambda: Firmware(firmware_path).validate(), None),
+                                                         ('unpack', firmware_size, lambda: Firmware(firmware_path).unpack(work), clean),
+                                                         ('pack', firmware_size, lambda: Firmware(work).pack(unpacked), clean_pack),
+                                                         ('romfs_extract', romfs_size, lambda: RomFs().extract(unpacked / 'section_2.bin', work), clean),
+                                                         ('romfs_write', romfs_size, lambda: RomFs().write_files(unpacked / 'section_2.files'), None)]:
+                    seconds, cpu_seconds, peak_memory = benchmark_run(function, setup, repeat)
+                    result = {'model': model, 'scale': scale, 'operation': operation, 'bytes': size,
+                              'seconds': round(seconds, 6), 'cpu_seconds': round(cpu_seconds, 6),
+                              'mb_per_second': round(size / seconds / 1000000, 3), 'peak_memory': peak_memory}
+                    results[name + '/' + operation] = result
+                    print('{:<12} {:<14} {:8.3f} s {:8.3f} s CPU {:9.1f} MB/s {:8.1f} MiB peak'.format(name, operation, seconds, cpu_seconds, result['mb_per_second'], peak_memory / 0x100000), flush=True)
+                clean_pack()
+                shutil.rmtree(unpacked)
+                firmware_path.unlink()
+
+    report = {'version': BENCHMARK_VERSION, 'seed': seed, 'repeat': repeat, **benchmark_machine(), 'results': results}
+    status = 0
+    if save_baseline:
+        baseline_file = open(baseline_path, 'w')
+        json.dump(report, baseline_file, indent=1)
+        baseline_file.close()
+        print('Baseline saved to {}'.format(baseline_path), file=sys.stderr)
+    elif not os.path.exists(baseline_path):
+        print('Baseline {} does not exist, use --save-baseline to create it'.format(baseline_path), file=sys.stderr)
+        status = 1
+    else:
+        baseline_file = open(baseline_path, 'r')
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+        # Timings from another machine or Python can't be compared, they would all be regressions or hide them
+        different = [field for field in ['version', 'seed'] + list(benchmark_machine()) if baseline.get(field) != report[field]]
+        if len(different) > 0:
+            print('Baseline {} was made with another {}, use --save-baseline to replace it'.format(baseline_path, ', '.join(different)), file=sys.stderr)
+            status = 1
+        else:
+            compared = 0
+            for key, result in results.items():
+                old_result = baseline['results'].get(key)
+                if old_result is None:
+                    print('MISSING {} is not in the baseline'.format(key), file=sys.stderr)
+                    status = 1
+                    continue
+                compared += 1
+                for field, minimum in [('seconds', BENCHMARK_MIN_SECONDS), ('peak_memory', BENCHMARK_MIN_MEMORY)]:
+                    if result[field] > old_result[field] * (1 + tolerance) and result[field] - old_result[field] > minimum:
+                        print('REGRESSION {} {}: {} -> {} ({:+.0%})'.format(key, field, old_result[field], result[field], result[field] / old_result[field] - 1), file=sys.stderr)
+                        status = 1
+            print('{:d} benchmarks compared with {}: {}'.format(compared, baseline_path, 'regressions found' if status else 'no regressions'), file=sys.stderr)
+    if output is not None:
+        output_file = open(output, 'w')
+        json.dump(report, output_file, indent=1)
+        output_file.close()
+    print('{:d} benchmarks in {:.2f} seconds'.format(len(results), time.perf_counter() - start), file=sys.stderr)
+    return status
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -1044,24 +4390,134 @@ if __name__ == '__main__':
         epilog=textwrap.dedent('''\
                 Examples:
                 $ %(prog)s validate --input=InstaGo2FW.pkg
+                $ %(prog)s validate --input=InstaGo2FW.pkg --jobs=4
+                $ curl -s https://example.com/InstaGo2FW.pkg | %(prog)s validate --input=-
                 $ %(prog)s unpack --input=InstaGo2FW.pkg --output=firmware_folder
-                $ %(prog)s pack --input=firmware_folder --output=InstaGo2FW.pkg''')
+                $ %(prog)s pack --input=firmware_folder --output=InstaGo2FW.pkg
+                $ %(prog)s ls --input=InstaGo2FW.pkg
+                $ %(prog)s scan --input=InstaGo2FW.pkg --output=layout.json
+                $ %(prog)s unpack --input=InstaGo2FW.pkg --output=firmware_folder --ext2
+                $ %(prog)s unpack --input=InstaGo2FW.pkg --output=firmware_folder --store=firmware_store
+                $ %(prog)s cat --input=InstaGo2FW.pkg --file=section_2/calib6.bin --output=calib6.bin
+                $ %(prog)s cat --input=InstaGo2FW.pkg --file=section_4/etc/hostname
+                $ %(prog)s patch --input=InstaGo2FW.pkg --file=section_2/calib6.bin --new=calib6.bin --output=InstaGo2FW_patched.pkg
+                $ %(prog)s diff --input=InstaGo2FW_old.pkg --new=InstaGo2FW.pkg --output=report.json --patch=update.patch
+                $ %(prog)s batch firmware_archive/ 'downloads/*.pkg' --jobs=8 > results.jsonl
+                $ %(prog)s batch firmware_archive/ --output=unpacked_archive --store=firmware_store
+                $ %(prog)s serve --output=uploads --port=8360 --jobs=4
+                $ %(prog)s index firmware_archive/ --output=catalog.sqlite
+                $ %(prog)s query --input=catalog.sqlite "SELECT path, version FROM firmwares WHERE model = 'GO 3'"
+                $ %(prog)s generate --output=synthetic.pkg --model=go3s --scale=0.5 --seed=1
+                $ %(prog)s benchmark
+                $ %(prog)s benchmark --model=go3 --scale=1 --baseline=go3.benchmark.json --save-baseline
+                $ %(prog)s pack --input=firmware_folder --output=InstaGo2FW.pkg --profile=pack.profile.json''')
     )
-    parser.add_argument('action', choices=['validate', 'unpack', 'pack'])
-    parser.add_argument('-i', '--input', help='Firmware file for validate and unpack actions, folder with the unpacked firmware for pack action')
-    parser.add_argument('-o', '--output', help='Folder to unpack the firmware to for unpack action, file to pack to for pack action')
-
-    args = parser.parse_args()
+    parser.add_argument('action', choices=['validate', 'unpack', 'pack', 'ls', 'scan', 'cat', 'patch', 'diff', 'batch', 'serve', 'index', 'query', 'generate', 'benchmark'])
+    parser.add_argument('inputs', nargs='*', help='Firmware files, folders with firmware files and glob patterns for batch and index actions, SQL query for query action')
+    parser.add_argument('-i', '--input', help='Firmware file for validate (- for stdin), unpack, ls, scan, cat and patch actions, folder with the unpacked firmware for pack action, old firmware file for diff action, firmware file, folder or glob pattern for batch and index actions, catalog file for query action')
+    parser.add_argument('-o', '--output', help='Folder to unpack the firmware to for unpack action, file to pack to for pack action, file to write to for scan, cat and diff actions (stdout if not provided), patched copy of the firmware for patch action, folder to unpack every firmware to a folder inside for batch action (only validated if not provided), folder to save the valid uploads to for serve action, catalog file to create or update for index action, file to generate for generate action, file to write the results to for benchmark action')
+    parser.add_argument('-n', '--new', help='New firmware file to compare the input with for diff action, new content of the file for patch action')
+    parser.add_argument('--patch', help='File to write the patch from the input to the new firmware to for diff action')
+    parser.add_argument('-f', '--file', help='ROMFS or ext2 file to read for cat action, ROMFS file to replace for patch action, as it is unpacked (section_N/file_name)')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of threads used to calculate the hashes for validate action (1 by default), number of processes for batch and index actions and of uploads validated at the same time for serve action (number of CPUs by default)')
+    parser.add_argument('--ext2', action='store_true', help='Extract the ext2 file system to section_N.ext2 for unpack and batch actions')
+    parser.add_argument('--host', default=SERVE_HOST, help='Address to listen on for serve action ({} by default)'.format(SERVE_HOST))
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help='Port to listen on for serve action ({:d} by default)'.format(SERVE_PORT))
+    parser.add_argument('--model', action='append', choices=BENCHMARK_MODELS, help='Camera model of the firmware for generate action (go3 by default), can be repeated for benchmark action (all by default)')
+    parser.add_argument('--scale', action='append', type=float, help='Size of the firmware relative to a real one for generate action (1 by default), can be repeated for benchmark action ({} by default)'.format(', '.join('{:g}'.format(scale) for scale in BENCHMARK_SCALES)))
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the pseudo random content for generate and benchmark actions (0 by default)')
+    parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT, help='Runs of each benchmark, the best one is kept, for benchmark action ({:d} by default)'.format(BENCHMARK_REPEAT))
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE, help='Slowdown over the baseline reported as a regression for benchmark action ({:g} by default)'.format(BENCHMARK_TOLERANCE))
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE, help='Results to compare with for benchmark action ({} by default)'.format(os.path.basename(BENCHMARK_BASELINE)))
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results to the baseline instead of comparing them for benchmark action')
+    parser.add_argument('--progress', action='store_true', help='Show the progress, throughput and time left on stderr for validate, unpack, pack, scan and patch actions')
+    parser.add_argument('--profile', help='File to write the time, CPU time, bytes read and written and peak memory of every phase of the action to, as JSON in Chrome trace event format')
+    parser.add_argument('--store', help='Content addressed store folder to unpack the files to and link them from for unpack and batch actions, and to restore missing files from for pack action')
+
+    args = parser.parse_intermixed_args()
     action = args.action
 
+    if args.profile is not None:
+        # The whole action is a span, saved when the program exits whatever the exit status
+        profiler = Profiler()
+        Profiler.active = profiler
+        profiler.begin(action, {'argv': sys.argv[1:]})
+        atexit.register(profiler.save, args.profile)
+
+    if action == 'batch' or action == 'index':
+        patterns = ([args.input] if args.input is not None else []) + args.inputs
+        if len(patterns) == 0:
+            print('Input not provided')
+            sys.exit(1)
+        if action == 'index':
+            if args.output is None:
+                print('Output not provided')
+                sys.exit(1)
+            sys.exit(index(patterns, args.output, args.jobs))
+        sys.exit(batch(patterns, args.output, args.jobs, args.ext2, args.store))
+
+    if action == 'query':
+        if args.input is None or not os.path.isfile(args.input):
+            print('Catalog not provided' if args.input is None else 'Catalog {} does not exist'.format(args.input))
+            sys.exit(1)
+        if len(args.inputs) == 0:
+            print('Query not provided')
+            sys.exit(1)
+        sys.exit(query(args.input, ' '.join(args.inputs)))
+
+    if action == 'serve':
+        if args.output is None:
+            print('Output not provided')
+            sys.exit(1)
+        sys.exit(serve(args.output, args.host, args.port, args.jobs))
+
+    if action == 'generate':
+        if args.output is None:
+            print('Output not provided')
+            sys.exit(1)
+        elif os.path.exists(args.output):
+            print('Output {} already exists'.format(args.output))
+            sys.exit(1)
+        generate(args.output, (args.model or ['go3'])[-1], (args.scale or [1.0])[-1], args.seed)
+        sys.exit(0)
+
+    if action == 'benchmark':
+        if args.repeat < 1:
+            print('Repeat must be at least 1')
+            sys.exit(1)
+        sys.exit(benchmark(args.model or BENCHMARK_MODELS, args.scale or BENCHMARK_SCALES, args.repeat, args.tolerance, args.baseline, args.output, args.seed, args.save_baseline))
+
     if args.input is None:
         print('Input not provided')
         sys.exit(1)
-    elif not os.path.exists(args.input):
+    elif args.input == '-' and action != 'validate':
+        print('Input from stdin is only supported for validate action')
+        sys.exit(1)
+    elif args.input != '-' and not os.path.exists(args.input):
         print('Input {} does not exist'.format(args.input))
         sys.exit(1)
 
-    if action == 'unpack' or action == 'pack':
+    if (action == 'cat' or action == 'patch') and args.file is None:
+        print('File not provided')
+        sys.exit(1)
+
+    if action == 'patch':
+        if args.new is None:
+            print('New file content not provided')
+            sys.exit(1)
+        elif not os.path.isfile(args.new):
+            print('New file content {} does not exist'.format(args.new))
+            sys.exit(1)
+
+    if action == 'diff':
+        if args.new is None:
+            print('New firmware not provided')
+            sys.exit(1)
+        elif not os.path.exists(args.new):
+            print('New firmware {} does not exist'.format(args.new))
+            sys.exit(1)
+
+    if action == 'unpack' or action == 'pack' or action == 'patch':
         if args.output is None:
             print('Output not provided')
             sys.exit(1)
@@ -1079,11 +4535,57 @@ if __name__ == '__main__':
         main_firmware_file = args.input
         main_folder = ''
 
-    firmware = Firmware(main_firmware_file)
-
-    if action == 'unpack':
-        firmware.unpack(main_folder)
-    elif action == 'pack':
-        firmware.pack(main_folder)
-    else:
-        firmware.validate()
+    try:
+        if action == 'validate' and (args.input == '-' or not os.path.isfile(args.input)):
+            # Stdin, pipes and devices can't be mapped, they are validated as they are read
+            stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+            validate_stream(stream, args.input)
+            stream.close()
+            sys.exit(0)
+        firmware = Firmware(main_firmware_file)
+        # The command line is just another observer, and a TERM signal stops the action between two chunks
+        firmware.subscribe(ConsoleObserver(args.progress))
+        firmware.cancellation = CancellationToken()
+        signal.signal(signal.SIGTERM, lambda signum, frame: firmware.cancellation.cancel())
+        if action == 'diff':
+            new_firmware = Firmware(args.new)
+
+        store = Store(args.store) if args.store is not None and (action == 'unpack' or action == 'pack') else None
+        if action == 'unpack':
+            firmware.print_info()
+            firmware.unpack(main_folder, args.ext2, store)
+        elif action == 'pack':
+            firmware.pack(main_folder, store)
+        elif action == 'ls':
+            firmware.list_files()
+        elif action == 'scan':
+            layout = firmware.scan()
+            if args.output is None:
+                json.dump(layout, sys.stdout, indent=1)
+                print()
+            else:
+                output_file = open(args.output, 'w')
+                json.dump(layout, output_file, indent=1)
+                output_file.close()
+        elif action == 'cat':
+            sys.exit(firmware.read_file(args.file, args.output))
+        elif action == 'patch':
+            sys.exit(firmware.patch_file(args.file, args.new, args.output))
+        elif action == 'diff':
+            report, operations = firmware.diff(new_firmware)
+            if args.patch is not None:
+                firmware.write_patch(new_firmware, operations, args.patch)
+            if args.output is None:
+                json.dump(report, sys.stdout, indent=1)
+                print()
+            else:
+                output_file = open(args.output, 'w')
+                json.dump(report, output_file, indent=1)
+                output_file.close()
+            # Like diff, the exit status is 1 when the firmwares are different
+            sys.exit(0 if report['identical'] else 1)
+        else:
+            firmware.validate(args.jobs or 1)
+    except FirmwareError as e:
+        print(e, file=sys.stderr if action == 'ls' or action == 'scan' or action == 'cat' or action == 'diff' else sys.stdout)
+        sys.exit(1)
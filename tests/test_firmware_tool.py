@@ -0,0 +1,93 @@
+# Round trips of generated firmwares and ROMFS files, run with python -m unittest or pytest from the repository root
+import contextlib
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+import zlib
+from pathlib import Path
+
+TOOL_PATH = Path(__file__).resolve().parent.parent / 'insta360-go-firmware-tool.py'
+TEST_SCALE = 0.05  # Small generated firmwares, a few MiB each
+TEST_SEED = 1
+
+spec = importlib.util.spec_from_file_location('insta360_go_firmware_tool', TOOL_PATH)
+tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tool)
+
+
+class FirmwareRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.temporary_folder = tempfile.TemporaryDirectory(prefix='test-')
+        self.folder = Path(self.temporary_folder.name)
+
+    def tearDown(self):
+        self.temporary_folder.cleanup()
+
+    def round_trip(self, model):
+        firmware_path = self.folder / (model + '.pkg')
+        packed_path = self.folder / (model + '.packed.pkg')
+        unpacked = self.folder / model
+        with contextlib.redirect_stdout(io.StringIO()):
+            tool.generate(firmware_path, model, TEST_SCALE, TEST_SEED)
+            firmware = tool.Firmware(firmware_path)
+            firmware.validate()
+            firmware.unpack(unpacked)
+            # Without a manifest every section is built again from the unpacked files
+            os.unlink(unpacked / tool.MANIFEST_FILENAME)
+            tool.Firmware(packed_path).pack(unpacked)
+            tool.Firmware(packed_path).validate()
+        self.assertEqual(firmware_path.read_bytes(), packed_path.read_bytes())
+
+    def test_go2(self):
+        self.round_trip('go2')
+
+    def test_go3(self):
+        self.round_trip('go3')
+
+    def test_go3s(self):
+        self.round_trip('go3s')
+
+    def test_section_length_past_end(self):
+        firmware_path = self.folder / 'go3.pkg'
+        with contextlib.redirect_stdout(io.StringIO()):
+            tool.generate(firmware_path, 'go3', TEST_SCALE, TEST_SEED)
+        content = bytearray(firmware_path.read_bytes())
+        position = tool.FIRMWARE_HEADER_SECTIONS_TABLE_POSITION + tool.FIRMWARE_HEADER_SECTIONS_SIZE
+        content[position:position + tool.FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE] = (0x0FFFFFFF).to_bytes(tool.FIRMWARE_HEADER_SECTIONS_LENGTH_SIZE, 'little')
+        firmware_path.write_bytes(content)
+        for jobs in (1, 4):
+            with self.assertRaisesRegex(tool.FirmwareError, 'Invalid length in firmware header for section 1'):
+                tool.Firmware(firmware_path).validate(jobs)
+        with self.assertRaisesRegex(tool.FirmwareError, 'Invalid length in firmware header for section 1'):
+            tool.Firmware(firmware_path).scan()
+
+
+class RomFsTest(unittest.TestCase):
+    def test_write_extract(self):
+        files = {'empty.bin': b'', 'block.bin': bytes(range(256)) * 8, 'odd.bin': b'\x01' * 3001}
+        with tempfile.TemporaryDirectory(prefix='test-') as temporary_folder:
+            folder = Path(temporary_folder)
+            romfs = tool.RomFs()
+            for file_name, content in files.items():
+                romfs.add_file(file_name, content)
+            crc32, size = romfs.write(folder / 'romfs.bin')
+            self.assertEqual(size, os.path.getsize(folder / 'romfs.bin'))
+            self.assertEqual(crc32, zlib.crc32((folder / 'romfs.bin').read_bytes()))
+            extracted = tool.RomFs().extract(folder / 'romfs.bin', folder / 'romfs')
+            self.assertEqual([file_name for file_name, file_crc32, object_id in extracted], list(files))
+            for file_name, file_crc32, object_id in extracted:
+                self.assertEqual((folder / 'romfs' / file_name).read_bytes(), files[file_name])
+                self.assertEqual(file_crc32, zlib.crc32(files[file_name]))
+
+    def test_file_name_too_long(self):
+        with tempfile.TemporaryDirectory(prefix='test-') as temporary_folder:
+            romfs = tool.RomFs()
+            romfs.add_file('a' * (tool.ROMFS_FILE_FILENAME_SIZE + 1), b'content')
+            with self.assertRaises(tool.FirmwareError):
+                romfs.write(Path(temporary_folder) / 'romfs.bin')
+
+
+if __name__ == '__main__':
+    unittest.main()